@@ -57,6 +57,9 @@ if __name__ == "__main__":
                    help='The healpix resolution.')
     p.add_argument('--bg_trials', type=int, default=0,
                    help='if nonzero, run this number of background trials.')
+    p.add_argument('--cache', action='store_true', default=False,
+                   help=('Build the background trial LLH once and reseed it '
+                         'for every trial (load_dataset cache=True).'))
     p.add_argument("--job", type=int, default=0,
                    help='job number if running background trials.')
     p.add_argument('--extension', type=float, default=0,
@@ -72,7 +75,8 @@ if __name__ == "__main__":
             args.seed = np.random.randint(0, 10**6)
             ps_llh = utils.load_dataset('point_source', ncpu=args.ncpu,
                                         seed=args.seed,
-                                        llh_args={'scramble':True})
+                                        llh_args={'scramble':True},
+                                        cache=args.cache)
             for i, scan in enumerate(ps_llh.all_sky_scan()):
                 if i > 0:
                     ts_list[trial] = scan[1]['South']['fit']['TS']
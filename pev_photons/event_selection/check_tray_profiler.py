@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+########################################################################
+# Check the frame counts of TrayProfiler on a tray of hand-made frames
+########################################################################
+
+import os
+import csv
+import sys
+import json
+import argparse
+import tempfile
+
+from I3Tray import I3Tray
+from icecube import icetray
+
+from pev_photons.event_selection.tray_profiler import TrayProfiler
+
+class FrameSource(icetray.I3Module):
+    """ Pushes ndaq DAQ frames, each followed by nphysics Physics frames.
+        Every frame holds its position in the stream as I3Int 'index'."""
+
+    def __init__(self,ctx):
+        icetray.I3Module.__init__(self,ctx)
+        self.AddParameter('NDAQ','Number of DAQ frames',
+                          10)
+        self.AddParameter('NPhysics','Number of Physics frames per DAQ frame',
+                          3)
+
+    def Configure(self):
+        self.frames = []
+        for daq in range(self.GetParameter('NDAQ')):
+            self.frames.append(icetray.I3Frame.DAQ)
+            self.frames.extend([icetray.I3Frame.Physics]*self.GetParameter('NPhysics'))
+        self.index = 0
+
+    def Process(self):
+        if self.index == len(self.frames):
+            self.RequestSuspension()
+            return
+        frame = icetray.I3Frame(self.frames[self.index])
+        frame['index'] = icetray.I3Int(self.index)
+        self.index += 1
+        self.PushFrame(frame)
+
+class CheckTags(icetray.I3Module):
+    """ Counts the physics frames without the tag tag_frame puts with value."""
+
+    def __init__(self,ctx):
+        icetray.I3Module.__init__(self,ctx)
+        self.AddParameter('Key','Tag of tag_frame',
+                          'tag')
+        self.AddParameter('Value','Value tag_frame was added with',
+                          1)
+        self.AddParameter('Missing','List the number of untagged frames is appended to at Finish',
+                          None)
+
+    def Configure(self):
+        self.key = self.GetParameter('Key')
+        self.value = self.GetParameter('Value')
+        self.missing = 0
+
+    def Physics(self,frame):
+        if self.key not in frame or frame[self.key].value != self.value:
+            self.missing += 1
+        self.PushFrame(frame)
+
+    def Finish(self):
+        self.GetParameter('Missing').append(self.missing)
+
+def tag_frame(frame, key='tag', value=1):
+    frame[key] = icetray.I3Int(value)
+
+def even_index(frame):
+    return frame['index'].value%2 == 0
+
+def read_summary(filename):
+    """ Frames per module of a summary written by TrayProfiler.write_summary."""
+    if filename.endswith('.csv'):
+        with open(filename) as f:
+            return dict((row['module'], int(row['frames'])) for row in csv.DictReader(f))
+    with open(filename) as f:
+        return dict((row['module'], row['frames']) for row in json.load(f))
+
+def check(outdir, ndaq=10, nphysics=3):
+    """ Runs a profiled tray of a driving class module, three function modules (one with
+        Streams, two added without a name, one with If) and a class module with Physics
+        and Finish, writes the JSON and CSV summaries to outdir and compares their frame
+        counts with the frames each module got.
+        Output: list of differences, empty if all counts are right."""
+
+    missing = []
+    tray = TrayProfiler(I3Tray())
+    tray.AddModule(FrameSource, 'source', NDAQ=ndaq, NPhysics=nphysics)
+    tray.AddModule(tag_frame, Streams=[icetray.I3Frame.DAQ], key='daq_tag')
+    tray.AddModule(tag_frame, Streams=[icetray.I3Frame.Physics], value=2)
+    tray.AddModule(tag_frame, 'even', If=even_index, key='even_tag')
+    tray.AddModule(CheckTags, Value=2, Missing=missing)
+    tray.AddModule('TrashCan', 'Done')
+    tray.Execute()
+    tray.Finish()
+
+    nframes = ndaq*(1+nphysics)
+    expected = {'source':nframes+1, # once more to request the suspension
+                'tag_frame':ndaq,
+                'tag_frame_1':ndaq*nphysics,
+                'even':len([i for i in range(nframes) if i%(1+nphysics)>0 and i%2==0]),
+                'CheckTags':ndaq*nphysics}
+
+    differences = []
+    if missing != [0]:
+        differences.append('untagged physics frames: %s'%missing)
+    for extension in ['json','csv']:
+        filename = os.path.join(outdir, 'profile.'+extension)
+        tray.write_summary(filename)
+        counts = read_summary(filename)
+        if sorted(counts.keys()) != sorted(expected.keys()):
+            differences.append('%s modules: %s'%(extension, sorted(counts.keys())))
+            continue
+        for module in expected:
+            if counts[module] != expected[module]:
+                differences.append('%s %s: %i frames, expected %i'%(extension, module, counts[module], expected[module]))
+    return differences
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Check the frame counts of TrayProfiler on hand-made frames.')
+    p.add_argument('--outdir', default=None, help='Directory of the summaries (default: temporary).')
+    args = p.parse_args()
+
+    outdir = args.outdir if args.outdir != None else tempfile.mkdtemp()
+    differences = check(outdir)
+    for difference in differences:
+        print difference
+    print '%i differences'%len(differences)
+    sys.exit(1 if differences else 0)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+########################################################################
+# Throughput of the LLH Ratio stages on synthetic events
+########################################################################
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+from collections import OrderedDict
+
+from llh_ratio_test_globals import globalhistbins as histbins
+from llh_ratio_test_globals import globalhistrange as histrange
+from llh_ratio_test_library import llh_ratio_test
+from synthetic_events import write_geometry, write_events, write_random_store
+
+def benchmark(hdffile,geofile,store,highE=True,include_slc_time=True):
+    """ Times the stages of scoring the events of hdffile.
+        Output: number of events and seconds per 10^4 events of each stage."""
+
+    seconds = OrderedDict()
+    def timed(name,call):
+        start = time.time()
+        result = call()
+        seconds[name] = time.time()-start
+        return result
+
+    llh = llh_ratio_test()
+    llh.load_geometry(geofile)
+    llh.load_shared_heatmaps(store,store=True,smearedthumbplot=False,normradialbins=False)
+    llh.set_analysis_bins(highE)
+
+    timed('load_hdf_file',lambda: llh.load_hdf_file(hdffile))
+    nevents = len(llh.events['laputop_x'])
+    timed('load_pulses',lambda: llh.load_pulses(include_slc_time=include_slc_time))
+
+    def no_hit_doms():
+        for i in range(nevents):
+            string = np.concatenate((llh.events['slc_string'][i],llh.events['hlc_string'][i]))
+            om = np.concatenate((llh.events['slc_om'][i],llh.events['hlc_om'][i]))
+            llh.no_hit_doms(np.column_stack((string,om,np.zeros_like(om))),llh.events['laputop_azi'][i],
+                            llh.events['laputop_zen'][i],llh.events['laputop_x'][i],llh.events['laputop_y'][i])
+    timed('no_hit_doms',no_hit_doms)
+
+    def histograms():
+        for key in ['q_r','q_t','t_r']:
+            llh.histogram2d(key,histbins[key],histrange[key])
+    timed('histogram2d',histograms)
+
+    # All events in the heatmaps of one bin, as the per bin scripts score them
+    s125_key = llh.s125_keys[len(llh.s125_keys)//2]
+    zen_key = llh.zen_keys[0]
+    timed('calc_llh_values_new',lambda: llh.calc_llh_values_new(histbins,histrange,s125_key,zen_key,True,False,None,
+                                                                trace_tanks=False))
+    timed('calc_llh_values_new_trace_tanks',lambda: llh.calc_llh_values_new(histbins,histrange,s125_key,zen_key,True,False,None,
+                                                                            trace_tanks=True))
+
+    # Every event in its own s125/zen bin, as IceTop_LLH_Ratio and rescore_llh score them
+    s125_bin, zen_bin, s125_index, zen_index = llh.locate_heatmap_bins(llh.events['log_s125'],llh.events['cos_zen'])
+    r, q, t, offsets = llh.flatten_events()
+    timed('calc_llh_values_batch',lambda: llh.calc_llh_values_batch(r,q,t,offsets,s125_index,zen_index,histbins,histrange))
+
+    llh.f.close()
+    per_events = OrderedDict((name,1e4*value/max(nevents,1)) for name,value in seconds.items())
+    return nevents, per_events
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Time the LLH Ratio stages on synthetic events.')
+    p.add_argument('--events', type=int, default=10000, help='Number of synthetic events.')
+    p.add_argument('--seed', type=int, default=0, help='Random seed of the events and heatmaps.')
+    p.add_argument('--workdir', default=None,
+                   help='Directory for the synthetic files, kept and reused if given, else a temporary one.')
+    p.add_argument('--output', default=None, help='Write the timings to this JSON file.')
+    p.add_argument('--compare', default=None, help='JSON file of an earlier run to compare with.')
+    args = p.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    geofile = os.path.join(workdir,'geometry.h5')
+    hdffile = os.path.join(workdir,'synthetic_%i_%i.h5'%(args.events,args.seed))
+    store = os.path.join(workdir,'heatmaps_%i'%args.seed)
+    if not os.path.exists(geofile):
+        write_geometry(geofile,seed=args.seed)
+    if not os.path.exists(hdffile):
+        write_events(hdffile,geofile,args.events,seed=args.seed)
+    if not os.path.exists(store+'.npy'):
+        write_random_store(store,seed=args.seed)
+
+    nevents, timings = benchmark(hdffile,geofile,store)
+    if args.workdir is None:
+        shutil.rmtree(workdir)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)['seconds_per_1e4_events']
+
+    print '%i events, seconds per 10^4 events:'%nevents
+    for name, value in timings.items():
+        if previous is not None and previous.get(name):
+            print '{:35s} {:10.4f}   {:6.2f}x of {}'.format(name,value,value/previous[name],args.compare)
+        else:
+            print '{:35s} {:10.4f}'.format(name,value)
+
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump({'events':nevents,'seed':args.seed,'seconds_per_1e4_events':timings},f,indent=2)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+########################################################################
+# Check that IceTop_LLH_Ratio_Batch gives the outputs of IceTop_LLH_Ratio
+########################################################################
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+
+from I3Tray import I3Tray
+from icecube import icetray, dataio, dataclasses
+from icecube.recclasses import I3LaputopParams, LaputopParameter
+
+from llh_ratio_i3_module import IceTop_LLH_Ratio, IceTop_LLH_Ratio_Batch
+
+# Frames of this stream are neither flushing nor physics frames, the batch module has to buffer them along
+custom_stream = icetray.I3Frame.Stream('X')
+collected_streams = [icetray.I3Frame.Geometry, icetray.I3Frame.Calibration, icetray.I3Frame.DetectorStatus,
+                     icetray.I3Frame.DAQ, icetray.I3Frame.Physics, custom_stream]
+
+class FrameSource(icetray.I3Module):
+    """ Pushes the I3Frames of parameter Frames, in order."""
+
+    def __init__(self,ctx):
+        icetray.I3Module.__init__(self,ctx)
+        self.AddParameter('Frames','I3Frames to push',
+                          [])
+
+    def Configure(self):
+        self.frames = list(self.GetParameter('Frames'))
+
+    def Process(self):
+        if len(self.frames)==0:
+            self.RequestSuspension()
+            return
+        self.PushFrame(self.frames.pop(0))
+
+def synthetic_frames(geofile,nevents,seed=0,track='Laputop',
+                     slcpulses='IceTopLaputopSeededSelectedSLC',hlcpulses='IceTopHLCSeedRTPulses'):
+    """ I3Frames of nevents synthetic showers (synthetic_events.py) on the tanks of geofile:
+        a Geometry frame, then a DAQ frame every 4th event and a Physics frame with
+        I3EventHeader, the track, its Params, <track>_passing (90% pass) and the SLC/HLC
+        pulse maps per event. A frame of custom_stream follows every 7th event and a
+        Calibration frame the middle one, so the frame order is checked too."""
+
+    from llh_ratio_test_library import read_geometry
+    from synthetic_events import tank_table, generate_showers, generate_pulses
+
+    geometry = dataclasses.I3Geometry()
+    for dom in read_geometry(geofile):
+        omgeo = dataclasses.I3OMGeo()
+        omgeo.position = dataclasses.I3Position(dom['x'],dom['y'],dom['z'])
+        omgeo.omtype = dataclasses.I3OMGeo.IceTop
+        geometry.omgeo[icetray.OMKey(int(dom['string']),int(dom['om']),int(dom['pmt']))] = omgeo
+    frame = icetray.I3Frame(icetray.I3Frame.Geometry)
+    frame['I3Geometry'] = geometry
+    frames = [frame]
+
+    rng = np.random.RandomState(seed)
+    tanks = tank_table(geofile)
+    showers = generate_showers(tanks,nevents,rng)
+    pulses = generate_pulses(tanks,showers,rng)
+    passing = rng.uniform(0,1,nevents)>0.1
+
+    for i in range(nevents):
+        header = dataclasses.I3EventHeader()
+        header.run_id = 0
+        header.event_id = i
+        header.sub_event_id = 0
+
+        if i%4 == 0:
+            frame = icetray.I3Frame(icetray.I3Frame.DAQ)
+            frame['I3EventHeader'] = header
+            frames.append(frame)
+
+        frame = icetray.I3Frame(icetray.I3Frame.Physics)
+        frame['I3EventHeader'] = header
+
+        # Pulse times T are measured from the plane front crossing the core at 1e4 ns
+        laputop = dataclasses.I3Particle()
+        laputop.pos = dataclasses.I3Position(showers['x'][i],showers['y'][i],showers['z'][i])
+        laputop.dir = dataclasses.I3Direction(showers['zenith'][i],showers['azimuth'][i])
+        laputop.time = 1e4
+        frame[track] = laputop
+
+        params = I3LaputopParams()
+        params.set_value(LaputopParameter.Log10_S125,showers['log_s125'][i])
+        frame[track+'Params'] = params
+        frame[track+'_passing'] = icetray.I3Bool(bool(passing[i]))
+
+        for pulsename,hit in [(slcpulses,pulses['slc'][i]),(hlcpulses,pulses['hlc'][i])]:
+            pulsemap = dataclasses.I3RecoPulseSeriesMap()
+            for tank in np.flatnonzero(hit):
+                pulse = dataclasses.I3RecoPulse()
+                pulse.charge = pulses['charge'][i,tank]
+                pulse.time = pulses['T'][i,tank]
+                pulsemap[icetray.OMKey(int(tanks['string'][tank]),int(tanks['om'][tank]),int(tanks['pmt'][tank]))] = \
+                    dataclasses.I3RecoPulseSeries([pulse])
+            frame[pulsename] = pulsemap
+        frames.append(frame)
+
+        if i%7 == 0:
+            frames.append(icetray.I3Frame(custom_stream))
+        if i == nevents//2:
+            frames.append(icetray.I3Frame(icetray.I3Frame.Calibration))
+
+    return frames
+
+def run_module(source, module, output, **params):
+    """ Runs module on the frames of source: a list of I3 files, or a function returning
+        I3Frames (called for every run, the modules write into the frames).
+        Output: (stream, run, event, sub event, output map) of every frame of collected_streams
+        after it, in order. The ids are None without I3EventHeader, the map None without output."""
+
+    outputs = []
+    def collect(frame):
+        ids = (None, None, None)
+        if 'I3EventHeader' in frame:
+            header = frame['I3EventHeader']
+            ids = (header.run_id, header.event_id, header.sub_event_id)
+        values = dict(frame[output]) if output in frame else None
+        outputs.append((frame.Stop,)+ids+(values,))
+
+    tray = I3Tray()
+    if callable(source):
+        tray.AddModule(FrameSource, 'Source', Frames=source())
+    else:
+        tray.AddModule('I3Reader', 'Reader', FilenameList=source)
+    tray.AddModule(module, 'llh', Output=output, **params)
+    tray.AddModule(collect, 'collect', Streams=collected_streams)
+    tray.AddModule('TrashCan', 'Done')
+    tray.Execute()
+    tray.Finish()
+    return outputs
+
+def compare_outputs(frame_outputs, batch_outputs):
+    """ Output: list of differences, empty if both modules gave the same frames,
+        in the same order, with the same keys and values (nan equal to nan)."""
+
+    differences = []
+    if len(frame_outputs) != len(batch_outputs):
+        differences.append('%i frames vs %i frames'%(len(frame_outputs),len(batch_outputs)))
+    for a, b in zip(frame_outputs, batch_outputs):
+        if a[:-1] != b[:-1]:
+            differences.append('frame order: %s vs %s'%(a[:-1],b[:-1]))
+            break
+        if a[-1] is None or b[-1] is None:
+            if a[-1] is not b[-1]:
+                differences.append('%s: output missing in one module'%(a[:-1],))
+            continue
+        if sorted(a[-1].keys()) != sorted(b[-1].keys()):
+            differences.append('%s: keys %s vs %s'%(a[:-1],sorted(a[-1].keys()),sorted(b[-1].keys())))
+            continue
+        for key in a[-1]:
+            if not (a[-1][key] == b[-1][key] or (np.isnan(a[-1][key]) and np.isnan(b[-1][key]))):
+                differences.append('%s %s: %r vs %r'%(a[:-1],key,a[-1][key],b[-1][key]))
+    return differences
+
+def skip_every_fifth(frame):
+    """ If of the synthetic check: skips the frames of every 5th event."""
+    return 'I3EventHeader' not in frame or frame['I3EventHeader'].event_id%5 != 0
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Compare IceTop_LLH_Ratio_Batch with IceTop_LLH_Ratio on I3 files, '
+                                            'or on synthetic frames built in-process (--synthetic).')
+    p.add_argument('--input_files', nargs='+', help='GCD file and I3 files with Laputop and the tank pulses.')
+    p.add_argument('--synthetic', type=int, nargs='?', const=100, default=None,
+                   help='Number of synthetic events (100 if no number is given) to check on instead of input files. Geometry and a random '
+                        'heatmap store are written to --workdir, the modules run with and without If.')
+    p.add_argument('--workdir', default=None, help='Directory of the synthetic geometry and heatmap store (default: temporary).')
+    p.add_argument('--track', default='Laputop', help='Track of the modules.')
+    p.add_argument('--year', default='2012', help='TwoDPDFPickleYear of the modules.')
+    p.add_argument('--heatmap_store', default=None, help='HeatmapStore of the modules.')
+    p.add_argument('--geometry', default='geometry.h5', help='GeometryHDF5 of the modules.')
+    p.add_argument('--slc_time_correction', default=None, help='SLCTimeCorrectionPickle of the modules.')
+    p.add_argument('--highEbins', action='store_true', default=False)
+    p.add_argument('--trace_tanks', action='store_true', default=False)
+    p.add_argument('--check_quality', action='store_true', default=False,
+                   help='checkQuality of the modules, needs <track>_passing in the frames.')
+    p.add_argument('--batch_size', type=int, nargs='+', default=None,
+                   help='BatchSize of IceTop_LLH_Ratio_Batch, one run each (default: 1000, 1 3 7 with --synthetic).')
+    args = p.parse_args()
+
+    params = dict(Track=args.track, TwoDPDFPickleYear=args.year, HeatmapStore=args.heatmap_store,
+                  GeometryHDF5=args.geometry, SLCTimeCorrectionPickle=args.slc_time_correction,
+                  highEbins=args.highEbins, TraceTanks=args.trace_tanks, checkQuality=args.check_quality)
+    output = args.track+'_IceTopLLHRatio'
+    conditions = [None]
+    source = args.input_files
+    batch_sizes = [1000]
+
+    if args.synthetic is not None:
+        from synthetic_events import write_geometry, write_random_store
+
+        workdir = args.workdir if args.workdir != None else tempfile.mkdtemp()
+        geofile = os.path.join(workdir,'geometry.h5')
+        store = os.path.join(workdir,'heatmaps')
+        write_geometry(geofile)
+        write_random_store(store)
+        params.update(TwoDPDFPickleYear=None, HeatmapStore=store, GeometryHDF5=geofile,
+                      highEbins=True, checkQuality=True)
+        conditions = [None, skip_every_fifth]
+        source = lambda: synthetic_frames(geofile, args.synthetic, track=args.track)
+        # 7 does not divide the default 100 events, the last batch is flushed at Finish
+        batch_sizes = [1,3,7]
+    if args.batch_size is not None:
+        batch_sizes = args.batch_size
+
+    ndifferences = 0
+    for condition in conditions:
+        if condition is not None:
+            params['If'] = condition
+        frame_outputs = run_module(source, IceTop_LLH_Ratio, output, **params)
+        for batch_size in batch_sizes:
+            batch_outputs = run_module(source, IceTop_LLH_Ratio_Batch, output, BatchSize=batch_size, **params)
+
+            differences = compare_outputs(frame_outputs, batch_outputs)
+            for difference in differences[:20]:
+                print difference
+            print 'If %s, BatchSize %i: %i frames, %i differences'%(condition is not None,batch_size,
+                                                                   len(frame_outputs),len(differences))
+            ndifferences += len(differences)
+    sys.exit(1 if ndifferences else 0)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+########################################################################
+# Check that sparse 3D heatmaps give the 3D LLH values of dense ones
+########################################################################
+
+import sys
+import argparse
+import numpy as np
+
+from llh_ratio_test_globals import globalhistbins, global3dbins, global3drange
+from llh_ratio_test_library import llh_ratio_test, sparse_heatmap
+
+s125_keys = ['0.5','0.6','0.7']
+zen_keys = ['0.95','0.9','0.85']
+
+def random_heatmaps(seed,fill=0.03):
+    """ Proton and gamma heatmaps for every key of s125_keys and zen_keys: 2D templates of
+        Poisson counts and 3D heatmaps with a fraction fill of the bins set to uniform
+        random floats, so the normalizations are not sums of integers."""
+
+    rng = np.random.RandomState(seed)
+    heatmap = {}
+    for prim in ['proton','gamma']:
+        heatmap[prim] = {}
+        for var in ['q_r','q_t','t_r','3d']:
+            heatmap[prim][var] = {}
+            for s125 in s125_keys:
+                heatmap[prim][var][s125] = {}
+                for zen in zen_keys:
+                    if var == '3d':
+                        temp = rng.uniform(0,1,global3dbins)
+                        temp[rng.uniform(0,1,global3dbins)>fill] = 0
+                        # a few values the smearedthumbplot option removes
+                        temp[rng.uniform(0,1,global3dbins)<1e-4] = 1e-8
+                    else:
+                        temp = rng.poisson(1.,globalhistbins[var]).astype(float)
+                    heatmap[prim][var][s125][zen] = temp
+    return heatmap
+
+def random_events(seed,nevents):
+    """ Flat r, q, t entries (partly outside global3drange), offsets and per event
+        s125/zen heatmap indices, -1 for events without heatmap."""
+
+    rng = np.random.RandomState(seed)
+    offsets = np.concatenate([[0],np.cumsum(rng.randint(0,60,nevents))])
+    r, q, t = [rng.uniform(low-0.2,high+0.2,offsets[-1]) for low, high in global3drange]
+    s125 = rng.randint(-1,len(s125_keys),nevents)
+    zen = rng.randint(0,len(zen_keys),nevents)
+    return r, q, t, offsets, s125, zen
+
+def normalize_3d_rows(llh):
+    """ Normalizes each first axis row of the dense 3D heatmaps of llh by its np.sum, the
+        normradialbins normalization of sparse_heatmap (normalize_heatmaps_new can not
+        normalize rows of dense 3D heatmaps)."""
+
+    for prim in ['proton','gamma']:
+        for s125 in s125_keys:
+            for zen in zen_keys:
+                temp = llh.heatmap[prim]['3d'][s125][zen].copy()
+                for i in range(len(temp)):
+                    if np.sum(temp[i])!=0:
+                        temp[i] = temp[i]/np.sum(temp[i])
+                llh.heatmap[prim+'_norm']['3d'][s125][zen] = temp
+                with np.errstate(divide='ignore'):
+                    llh.heatmap[prim+'_log']['3d'][s125][zen] = np.log10(temp)
+    return
+
+def compare(seed,nevents,fill):
+    """ Scores the same events with calc_llh_values_3d_batch on dense and on sparse 3D
+        heatmaps, for every normalization option and ignorezerobinsinboth.
+        Output: list of differences, empty if all values are identical (nan equal to nan)."""
+
+    events = random_events(seed+1,nevents)
+    differences = []
+    for smearedthumbplot, normradialbins in [(False,False),(True,False),(False,True)]:
+        dense, sparse = llh_ratio_test(), llh_ratio_test()
+        dense.heatmap = random_heatmaps(seed,fill)
+        sparse.heatmap = random_heatmaps(seed,fill)
+        for prim in ['proton','gamma']:
+            for s125 in s125_keys:
+                for zen in zen_keys:
+                    sparse.heatmap[prim]['3d'][s125][zen] = sparse_heatmap.from_dense(sparse.heatmap[prim]['3d'][s125][zen])
+
+        dense.normalize_heatmaps_new(smearedthumbplot=smearedthumbplot)
+        if normradialbins==True:
+            normalize_3d_rows(dense)
+        sparse.normalize_heatmaps_new(smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+
+        for prim in ['proton','gamma']:
+            for s125 in s125_keys:
+                for zen in zen_keys:
+                    nbins = np.sum(sparse.heatmap[prim+'_norm']['3d'][s125][zen].toarray()
+                                   !=dense.heatmap[prim+'_norm']['3d'][s125][zen])
+                    if nbins:
+                        differences.append('smearedthumbplot %s normradialbins %s %s %s %s: %i normalized bins differ'%(
+                                           smearedthumbplot,normradialbins,prim,s125,zen,nbins))
+
+        for ignorezerobinsinboth in [True,False]:
+            a = dense.calc_llh_values_3d_batch(*events,ignorezerobinsinboth=ignorezerobinsinboth)
+            b = sparse.calc_llh_values_3d_batch(*events,ignorezerobinsinboth=ignorezerobinsinboth)
+            for name in ['proton_like','gamma_like','unused_proton','unused_gamma']:
+                same = (a[name]==b[name])|(np.isnan(a[name])&np.isnan(b[name]))
+                if not np.all(same):
+                    differences.append('smearedthumbplot %s normradialbins %s ignorezerobinsinboth %s %s: %i events differ'%(
+                                       smearedthumbplot,normradialbins,ignorezerobinsinboth,name,np.sum(~same)))
+    return differences
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Compare the 3D LLH values of sparse and dense 3D heatmaps on random heatmaps and events.')
+    p.add_argument('--events', type=int, default=2000, help='Number of random events.')
+    p.add_argument('--fill', type=float, default=0.03, help='Fraction of nonzero 3D heatmap bins.')
+    p.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = p.parse_args()
+
+    differences = compare(args.seed,args.events,args.fill)
+    for difference in differences[:20]:
+        print difference
+    print '%i differences'%len(differences)
+    sys.exit(1 if differences else 0)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+########################################################################
+# Pulses of analysis HDF files stored as uint8 bin indices of the
+# LLH Ratio heatmaps, for histogramming and scoring without float math
+########################################################################
+
+import os
+import argparse
+import hashlib
+import numpy as np
+import tables
+from multiprocessing import Pool
+
+from llh_ratio_test_globals import globalhistbins, globalhistrange, hist_edges, digitize
+from heatmap_store import templates
+
+variables = ['r','q','t']
+# Bin index of values np.histogramdd would drop (out of range, nan)
+overflow = 255
+
+def variable_edges(histbins=globalhistbins,histrange=globalhistrange):
+    """ Edges of log r, log q and log t, the same in every template they appear in."""
+
+    edges = {}
+    for var in templates:
+        xedges, yedges = hist_edges(histbins[var],histrange[var])
+        for name,axis_edges in [(var[2],xedges),(var[0],yedges)]:
+            if name in edges and not np.array_equal(edges[name],axis_edges):
+                raise ValueError('%s is binned differently in the templates, it can not be digitized once'%name)
+            edges[name] = axis_edges
+    for name in variables:
+        if len(edges[name])-1 >= overflow:
+            raise ValueError('%s has too many bins for uint8 bin indices'%name)
+    return edges
+
+def binning_hash(edges):
+    """ sha1 of the edges of all variables, stored with the digitized pulses."""
+    h = hashlib.sha1()
+    for name in variables:
+        h.update(name)
+        h.update(np.asarray(edges[name],dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def digitize_values(values,edges):
+    """ Input: dict of log r, log q, log t arrays and variable_edges.
+        Output: dict of uint8 bin indices, overflow where np.histogramdd drops the value."""
+
+    digitized = {}
+    for name in variables:
+        index = digitize(values[name],edges[name])
+        index[index<0] = overflow
+        digitized[name] = index.astype(np.uint8)
+    return digitized
+
+def write_digitized(hdffile,outfile,geofile,quality_cuts=False,include_slc_time=False,exclude_hlc_time=False,
+                    slc_time_corrected=False,chunksize=10000,histbins=globalhistbins,histrange=globalhistrange):
+    """ Writes the SLC, HLC and no hit tanks of the events of an HDF file as uint8 bin indices
+        (r_bin, q_bin, t_bin, ordered per event like combine_pulses) with the event offsets,
+        the row of each event in hdffile and its log_s125 and cos_zen.
+        The pulses are streamed in chunks of events (llh_ratio_test.iter_pulses),
+        the time options are stored as attributes next to the binning hash."""
+
+    from llh_ratio_test_library import llh_ratio_test, combine_pulses
+
+    edges = variable_edges(histbins,histrange)
+
+    llh = llh_ratio_test()
+    llh.load_geometry(geofile)
+    llh.load_hdf_file(hdffile)
+    nrows = llh.f.root.Laputop.nrows
+    llh.events.add('row', lambda: np.arange(nrows))
+    if quality_cuts:
+        llh.make_quality_cuts()
+
+    out = tables.open_file(outfile+'.tmp','w')
+    bins = {}
+    for name in variables:
+        bins[name] = out.create_earray('/',name+'_bin',tables.UInt8Atom(),(0,))
+    offsets = out.create_earray('/','offsets',tables.Int64Atom(),(0,))
+    offsets.append(np.zeros(1,dtype=np.int64))
+    for key in ['row','log_s125','cos_zen']:
+        out.create_array('/',key,np.asarray(llh.events[key]))
+
+    if llh.check_survivors():
+        nentries = 0
+        for events, pulses in llh.iter_pulses(chunksize=chunksize,include_slc_time=include_slc_time,
+                                              exclude_hlc_time=exclude_hlc_time,slc_time_corrected=slc_time_corrected):
+            values = {}
+            values['r'], values['q'], values['t'], chunk_offsets = combine_pulses(pulses)
+            digitized = digitize_values(values,edges)
+            for name in variables:
+                bins[name].append(digitized[name])
+            offsets.append(chunk_offsets[1:]+nentries)
+            nentries += chunk_offsets[-1]
+
+    attrs = out.root._v_attrs
+    attrs.binning_hash = binning_hash(edges)
+    attrs.source = os.path.abspath(hdffile)
+    attrs.nrows = nrows
+    attrs.quality_cuts = quality_cuts
+    attrs.include_slc_time = include_slc_time
+    attrs.exclude_hlc_time = exclude_hlc_time
+    attrs.slc_time_corrected = slc_time_corrected
+    out.close()
+    os.rename(outfile+'.tmp',outfile)
+
+    llh.f.close()
+    return
+
+def read_digitized(filename,histbins=globalhistbins,histrange=globalhistrange):
+    """ Reads a file of write_digitized. Raises ValueError if it was digitized with other bins.
+        Output: dict of its arrays and attributes."""
+
+    f = tables.open_file(filename)
+    try:
+        attrs = f.root._v_attrs
+        if attrs.binning_hash != binning_hash(variable_edges(histbins,histrange)):
+            raise ValueError('%s was digitized with other heatmap bins'%filename)
+        digitized = {}
+        for name in attrs._v_attrnamesuser:
+            digitized[name] = attrs[name]
+        for node in f.list_nodes('/'):
+            digitized[node.name] = node.read()
+    finally:
+        f.close()
+    return digitized
+
+def digitized_source(filename):
+    """ HDF file the digitized pulses were written from."""
+    f = tables.open_file(filename)
+    source = str(f.root._v_attrs.source)
+    f.close()
+    return source
+
+def template_bins(digitized,template_key,histbins=globalhistbins,entries=slice(None)):
+    """ C-order linear bin index of the entries in a template histogram, -1 where dropped,
+        as linear_bin_index gives it for the float values."""
+
+    nx, ny = histbins[template_key]
+    x = digitized[template_key[2]+'_bin'][entries]
+    y = digitized[template_key[0]+'_bin'][entries]
+    linbin = x.astype(np.int64)*ny + y
+    linbin[(x==overflow)|(y==overflow)] = -1
+    return linbin
+
+def digitized_histograms(digitized,histbins=globalhistbins,events=slice(None)):
+    """ event_histograms of the events (a slice) of digitized pulses, for
+        llh_ratio_test.calc_llh_values_batch(..., histograms=...).
+        Without values the tanks on zero bins can not be counted (tanks=None)."""
+
+    first, stop, step = events.indices(len(digitized['offsets'])-1)
+    offsets = digitized['offsets'][first:stop+1]
+    entries = slice(offsets[0],offsets[-1])
+    offsets = offsets-offsets[0]
+
+    from llh_ratio_test_library import sparse_histograms
+
+    nevents = len(offsets)-1
+    eventno = np.repeat(np.arange(nevents),np.diff(offsets))
+    histograms = {'offsets':offsets,'eventno':eventno,'values':None}
+    for template_key in templates:
+        nx, ny = histbins[template_key]
+        histograms[template_key] = sparse_histograms(eventno,template_bins(digitized,template_key,histbins,entries),nx*ny)
+    return histograms
+
+def digitized_name(hdffile,outdir):
+    """ Digitized file of an HDF file: <outdir>/<name>_digitized.h5"""
+    name = os.path.splitext(os.path.basename(hdffile))[0]
+    return os.path.join(outdir,name+'_digitized.h5')
+
+def digitize_job(args):
+    hdffile, outdir, kwargs = args
+    write_digitized(hdffile,digitized_name(hdffile,outdir),**kwargs)
+    print 'digitized',hdffile
+    return hdffile
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Store the pulses of analysis HDF files as heatmap bin indices.')
+    p.add_argument('files', nargs='+', help='HDF files with Laputop and pulse tables.')
+    p.add_argument('--outdir', default=os.getcwd(), help='Directory of the digitized files.')
+    p.add_argument('--geometry', default=os.getcwd()+'/geometry.h5', help='Geometry HDF file.')
+    p.add_argument('--processes', type=int, default=1, help='Number of processes.')
+    p.add_argument('--quality_cuts', action='store_true', default=False,
+                   help='Only store events passing make_quality_cuts?')
+    p.add_argument('--include_slc_time', action='store_true', default=False)
+    p.add_argument('--exclude_hlc_time', action='store_true', default=False)
+    p.add_argument('--slc_time_corrected', action='store_true', default=False)
+    args = p.parse_args()
+
+    kwargs = dict(geofile=args.geometry, quality_cuts=args.quality_cuts,
+                  include_slc_time=args.include_slc_time, exclude_hlc_time=args.exclude_hlc_time,
+                  slc_time_corrected=args.slc_time_corrected)
+    jobs = [(hdffile,args.outdir,kwargs) for hdffile in args.files]
+    if args.processes>1:
+        pool = Pool(args.processes)
+        list(pool.imap_unordered(digitize_job,jobs))
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            digitize_job(job)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+########################################################################
+# Streaming, mergeable builder of the LLH Ratio heatmaps (PDFs)
+########################################################################
+
+import os
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+from llh_ratio_test_globals import globalhistbins, globalhistrange, hist_edges, linear_bin_index
+from llh_ratio_test_globals import s125_bins, zenith_bins, locate_bin
+from heatmap_store import primaries, templates, write_llh_heatmaps
+
+def empty_partial(s125_bins=s125_bins,zen_bins=zenith_bins):
+    """ Partial heatmaps: integer counts per (primary, template) of shape
+        (s125 bin, zen bin, x, y) and the number of events per (primary, s125 bin, zen bin)."""
+
+    s125_bins = np.array(s125_bins,dtype=float)
+    zen_bins = np.array(zen_bins,dtype=float)
+    partial = {'s125_bins':s125_bins,'zen_bins':zen_bins}
+    for prim in primaries:
+        partial['nevents_'+prim] = np.zeros((len(s125_bins),len(zen_bins)),dtype=np.int64)
+        for var in templates:
+            partial['counts_%s_%s'%(prim,var)] = np.zeros((len(s125_bins),len(zen_bins))+tuple(globalhistbins[var]),
+                                                          dtype=np.int64)
+    return partial
+
+def histogram_file(hdffile,primary,geofile,quality_cuts=True,s125_bins=s125_bins,zen_bins=zenith_bins,
+                   include_slc_time=False,exclude_hlc_time=False,slc_time_corrected=False,chunksize=10000):
+    """ Histograms the SLC, HLC and no hit tanks of the events of one HDF file
+        into a partial, streaming the pulses in chunks of events (llh_ratio_test.iter_pulses).
+        Each event goes to its s125/zen bin, as make_s125_cut/make_zenith_cut would select it."""
+
+    from llh_ratio_test_library import llh_ratio_test, combine_pulses
+
+    partial = empty_partial(s125_bins,zen_bins)
+    s125_bins = partial['s125_bins']
+    zen_bins = partial['zen_bins']
+    nzen = len(zen_bins)
+
+    llh = llh_ratio_test()
+    llh.load_geometry(geofile)
+    llh.load_hdf_file(hdffile)
+    if quality_cuts:
+        llh.make_quality_cuts()
+
+    s125_bin = locate_bin(llh.events['log_s125'],s125_bins[:,0],s125_bins[:,1])
+    zen_bin = locate_bin(llh.events['cos_zen'],zen_bins[:,1],zen_bins[:,0])
+    select = (s125_bin>=0)&(zen_bin>=0)
+    llh.apply_cut(select)
+    heatmap_bin = (s125_bin*nzen + zen_bin)[select]
+
+    partial['nevents_'+primary] += np.bincount(heatmap_bin,minlength=partial['nevents_'+primary].size).reshape(
+                                                                                  partial['nevents_'+primary].shape)
+
+    edges = {}
+    for var in templates:
+        edges[var] = hist_edges(globalhistbins[var],globalhistrange[var])
+
+    if llh.check_survivors():
+        for events, pulses in llh.iter_pulses(chunksize=chunksize,include_slc_time=include_slc_time,
+                                              exclude_hlc_time=exclude_hlc_time,slc_time_corrected=slc_time_corrected):
+            values = {}
+            values['r'], values['q'], values['t'], offsets = combine_pulses(pulses)
+            entry_bin = np.repeat(heatmap_bin[events],np.diff(offsets))
+
+            for var in templates:
+                counts = partial['counts_%s_%s'%(primary,var)]
+                linbin = linear_bin_index([values[var[2]],values[var[0]]],edges[var])
+                nbins = np.prod(globalhistbins[var])
+                select = linbin>=0
+                counts += np.bincount(entry_bin[select]*nbins + linbin[select],minlength=counts.size).reshape(counts.shape)
+
+    llh.f.close()
+    return partial
+
+def histogram_digitized_file(digitizedfile,primary,s125_bins=s125_bins,zen_bins=zenith_bins):
+    """ histogram_file for a file of digitized_pulses.write_digitized, which holds the events
+        (and quality cuts, time options) it was written with. Only bincounts of the bin indices."""
+
+    from digitized_pulses import read_digitized, template_bins
+
+    partial = empty_partial(s125_bins,zen_bins)
+    s125_bins = partial['s125_bins']
+    zen_bins = partial['zen_bins']
+    nzen = len(zen_bins)
+
+    digitized = read_digitized(digitizedfile)
+    s125_bin = locate_bin(digitized['log_s125'],s125_bins[:,0],s125_bins[:,1])
+    zen_bin = locate_bin(digitized['cos_zen'],zen_bins[:,1],zen_bins[:,0])
+    select = (s125_bin>=0)&(zen_bin>=0)
+    heatmap_bin = s125_bin*nzen + zen_bin
+
+    partial['nevents_'+primary] += np.bincount(heatmap_bin[select],minlength=partial['nevents_'+primary].size).reshape(
+                                                                                          partial['nevents_'+primary].shape)
+
+    entry_bin = np.repeat(np.where(select,heatmap_bin,-1),np.diff(digitized['offsets']))
+    for var in templates:
+        counts = partial['counts_%s_%s'%(primary,var)]
+        linbin = template_bins(digitized,var)
+        nbins = np.prod(globalhistbins[var])
+        keep = (linbin>=0)&(entry_bin>=0)
+        counts += np.bincount(entry_bin[keep]*nbins + linbin[keep],minlength=counts.size).reshape(counts.shape)
+
+    return partial
+
+def merge_partials(partials):
+    """ Sums partials (dicts or npz files written by save_partial) one by one."""
+
+    merged = None
+    for partial in partials:
+        if isinstance(partial,basestring):
+            partial = load_partial(partial)
+        if merged is None:
+            merged = empty_partial(partial['s125_bins'],partial['zen_bins'])
+        if not (np.array_equal(merged['s125_bins'],partial['s125_bins']) and
+                np.array_equal(merged['zen_bins'],partial['zen_bins'])):
+            raise ValueError('partials with different s125/zen bins can not be merged')
+        for key in merged:
+            if key.startswith('counts_') or key.startswith('nevents_'):
+                merged[key] += partial[key]
+    return merged
+
+def save_partial(partial,filename):
+    np.savez(filename,**partial)
+    return
+
+def load_partial(filename):
+    f = np.load(filename)
+    partial = dict((key,f[key]) for key in f.files)
+    f.close()
+    return partial
+
+def partial_heatmaps(partial):
+    """ Heatmap dicts (primary, template, s125 key, zen key) of a partial, as load_heatmaps
+        reads them from the pickles. s125/zen bins without events of every primary are left out."""
+
+    heatmap = {}
+    for prim in primaries:
+        heatmap[prim] = {}
+        for var in templates:
+            heatmap[prim][var] = {}
+            for i,s125 in enumerate(partial['s125_bins'][:,1]):
+                for j,zen in enumerate(partial['zen_bins'][:,0]):
+                    if any(partial['nevents_'+p][i,j]==0 for p in primaries):
+                        continue
+                    heatmap[prim][var].setdefault(str(s125),{})[str(zen)] = partial['counts_%s_%s'%(prim,var)][i,j].astype(float)
+    return heatmap
+
+def write_partial_store(partial,base,normalize=False,smearedthumbplot=False,normradialbins=False):
+    """ Writes the heatmaps of a (merged) partial as a heatmap store."""
+
+    from llh_ratio_test_library import llh_ratio_test
+
+    llh = llh_ratio_test()
+    llh.heatmap = partial_heatmaps(partial)
+    write_llh_heatmaps(llh,base,normalize=normalize,smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+    return
+
+def histogram_job(args):
+    hdffile, primary, kwargs = args
+    if kwargs.get('digitized',False):
+        return histogram_digitized_file(hdffile,primary)
+    return histogram_file(hdffile,primary,**kwargs)
+
+def build_heatmaps(files,processes=1,**kwargs):
+    """ Input: list of (hdf file, primary); keyword arguments of histogram_file,
+        or digitized=True for files of digitized_pulses.write_digitized.
+        Histograms the files in a pool of processes and merges the partials as they arrive."""
+
+    jobs = [(hdffile,primary,kwargs) for hdffile,primary in files]
+    if processes>1:
+        pool = Pool(processes)
+        merged = merge_partials(pool.imap_unordered(histogram_job,jobs))
+        pool.close()
+        pool.join()
+    else:
+        merged = merge_partials(histogram_job(job) for job in jobs)
+    return merged
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Build the LLH Ratio heatmaps from HDF files.')
+    p.add_argument('--proton', nargs='*', default=[], help='HDF files of proton (hadron) events.')
+    p.add_argument('--gamma', nargs='*', default=[], help='HDF files of gamma events.')
+    p.add_argument('--partials', nargs='*', default=[], help='Partial heatmaps (.npz) to merge in.')
+    p.add_argument('--geometry', default=os.getcwd()+'/geometry.h5', help='Geometry HDF file.')
+    p.add_argument('--output', help='Basename of the output store, or .npz partial with --partial.')
+    p.add_argument('--partial', action='store_true', default=False,
+                   help='Write the partial heatmaps to merge later instead of a store?')
+    p.add_argument('--processes', type=int, default=1, help='Number of processes.')
+    p.add_argument('--no_quality_cuts', action='store_true', default=False,
+                   help='Skip make_quality_cuts?')
+    p.add_argument('--digitized', action='store_true', default=False,
+                   help='Are the files digitized pulses (digitized_pulses.py)? Then they keep the cuts and time options they were written with.')
+    p.add_argument('--include_slc_time', action='store_true', default=False)
+    p.add_argument('--exclude_hlc_time', action='store_true', default=False)
+    p.add_argument('--slc_time_corrected', action='store_true', default=False)
+    p.add_argument('--normalize', action='store_true', default=False,
+                   help='Store normalized and log heatmaps?')
+    p.add_argument('--smearedthumbplot', action='store_true', default=False,
+                   help='normalize_heatmaps_new option.')
+    p.add_argument('--normradialbins', action='store_true', default=False,
+                   help='normalize_heatmaps_new option.')
+    args = p.parse_args()
+
+    files = [(f,'proton') for f in args.proton] + [(f,'gamma') for f in args.gamma]
+    partials = list(args.partials)
+    if len(files)>0 and args.digitized:
+        partials.append(build_heatmaps(files, processes=args.processes, digitized=True))
+    elif len(files)>0:
+        partials.append(build_heatmaps(files, processes=args.processes, geofile=args.geometry,
+                                       quality_cuts=not args.no_quality_cuts,
+                                       include_slc_time=args.include_slc_time,
+                                       exclude_hlc_time=args.exclude_hlc_time,
+                                       slc_time_corrected=args.slc_time_corrected))
+    merged = merge_partials(partials)
+
+    if args.partial:
+        save_partial(merged, args.output)
+    else:
+        write_partial_store(merged, args.output, normalize=args.normalize,
+                            smearedthumbplot=args.smearedthumbplot,
+                            normradialbins=args.normradialbins)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+########################################################################
+# Dense, memory-mappable store of the LLH Ratio heatmaps (PDFs)
+########################################################################
+
+import os
+import argparse
+import cPickle as pickle
+import numpy as np
+
+from llh_ratio_test_globals import globalhistbins, globalhistrange, hist_edges
+
+primaries = ['proton','gamma']
+templates = ['q_r','q_t','t_r']
+
+def store_files(base):
+    """ Files of the store with basename base: heatmaps, log heatmaps and edges."""
+    return base+'.npy', base+'_log.npy', base+'_edges.npz'
+
+def write_heatmap_store(base,heatmap,normalized=False,logheatmap=None,smearedthumbplot=False,normradialbins=False):
+    """ Writes heatmap dicts (primary, template, s125 key, zen key) as one dense
+        array of shape (primary, template, s125 bin, zen bin, x, y), padded to the
+        largest template, plus the bin edges and keys next to it.
+        s125 bins are ordered ascending and zen bins descending, like the heatmap
+        indices of llh_ratio_test.make_dense_heatmaps.
+        normalized: the heatmaps are probabilities; then logheatmap (same structure)
+        is stored too, so that loading needs no computation at all.
+        smearedthumbplot, normradialbins: the normalize_heatmaps_new options the
+        heatmaps were normalized with, stored to check them when loading."""
+
+    s125_keys=set()
+    zen_keys=set()
+    for var in templates:
+        for s125 in heatmap['proton'][var].keys():
+            s125_keys.add(s125)
+            zen_keys.update(heatmap['proton'][var][s125].keys())
+    s125_keys = sorted(s125_keys,key=float)
+    zen_keys = sorted(zen_keys,key=float,reverse=True)
+
+    shapes = np.array([globalhistbins[var] for var in templates])
+    shape = (len(primaries),len(templates),len(s125_keys),len(zen_keys))+tuple(shapes.max(axis=0))
+
+    tables = [(heatmap,store_files(base)[0])]
+    if normalized:
+        tables.append((logheatmap,store_files(base)[1]))
+
+    available = np.ones((len(s125_keys),len(zen_keys)),dtype=bool)
+    for table,filename in tables:
+        # Written through a memory map so the full array is never held in memory.
+        dense = np.lib.format.open_memmap(filename+'.tmp',mode='w+',dtype=np.float64,shape=shape)
+        for p,prim in enumerate(primaries):
+            for t,var in enumerate(templates):
+                nx, ny = shapes[t]
+                for i,s125 in enumerate(s125_keys):
+                    for j,zen in enumerate(zen_keys):
+                        if zen not in table[prim][var].get(s125,{}):
+                            available[i,j]=False
+                            continue
+                        dense[p,t,i,j,:nx,:ny]=table[prim][var][s125][zen]
+        dense.flush()
+        del dense
+        os.rename(filename+'.tmp',filename)
+
+    edges = {}
+    for var in templates:
+        edges['xedges_'+var], edges['yedges_'+var] = hist_edges(globalhistbins[var],globalhistrange[var])
+    np.savez(store_files(base)[2],
+             s125_keys=np.array(s125_keys),zen_keys=np.array(zen_keys),
+             s125_highs=np.array(s125_keys,dtype=float),zen_highs=np.array(zen_keys,dtype=float),
+             shapes=shapes,available=available,normalized=normalized,
+             smearedthumbplot=smearedthumbplot,normradialbins=normradialbins,**edges)
+    return
+
+def convert_pickle(inputpicklefile,base,normalize=False,smearedthumbplot=False,normradialbins=False):
+    """ Converts a heatmap pickle (as read by llh_ratio_test.load_heatmaps)
+        into a heatmap store. With normalize=True the store holds the normalized
+        and log heatmaps of normalize_heatmaps_new with the given options."""
+
+    from llh_ratio_test_library import llh_ratio_test
+
+    llh = llh_ratio_test()
+    llh.load_heatmaps(inputpicklefile)
+    write_llh_heatmaps(llh,base,normalize=normalize,smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+    return
+
+def write_llh_heatmaps(llh,base,normalize=False,smearedthumbplot=False,normradialbins=False):
+    """ Writes the heatmaps of a llh_ratio_test instance (llh.heatmap['proton'/'gamma'])
+        as a store, normalized by normalize_heatmaps_new if normalize=True."""
+
+    if not normalize:
+        write_heatmap_store(base,llh.heatmap)
+        return
+
+    llh.normalize_heatmaps_new(smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+    heatmap = {}
+    logheatmap = {}
+    for prim in primaries:
+        heatmap[prim] = llh.heatmap[prim+'_norm']
+        logheatmap[prim] = llh.heatmap[prim+'_log']
+    write_heatmap_store(base,heatmap,normalized=True,logheatmap=logheatmap,
+                        smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+    return
+
+def load_heatmap_store(base,mmap_mode='r'):
+    """ Loads a heatmap store. The arrays are read-only memory maps by default,
+        so every process on a node shares the same pages.
+        Output: dict with 'heatmaps' (and 'log_heatmaps' for normalized stores),
+        the s125/zen keys, template shapes, availability of each bin, the edges and the
+        normalization options (False for stores written before they were stored)."""
+
+    heatmapfile, logfile, edgesfile = store_files(base)
+
+    edges = np.load(edgesfile)
+    store = {}
+    for key in edges.files:
+        store[key] = edges[key]
+    edges.close()
+
+    store['normalized'] = bool(store['normalized'])
+    for key in ['smearedthumbplot','normradialbins']:
+        store[key] = bool(store.get(key,False))
+    store['s125_keys'] = [str(key) for key in store['s125_keys']]
+    store['zen_keys'] = [str(key) for key in store['zen_keys']]
+    store['heatmaps'] = np.load(heatmapfile,mmap_mode=mmap_mode)
+    if store['normalized']:
+        store['log_heatmaps'] = np.load(logfile,mmap_mode=mmap_mode)
+
+    return store
+
+def template_view(store,key,prim,var):
+    """ (s125 bin, zen bin, x, y) view of one primary and template, without padding."""
+    t = templates.index(var)
+    nx, ny = store['shapes'][t]
+    return store[key][primaries.index(prim),t,:,:,:nx,:ny]
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Convert a heatmap pickle into a heatmap store.')
+    p.add_argument('--pickle', help='Input heatmap pickle.')
+    p.add_argument('--output', help='Basename of the output store.')
+    p.add_argument('--normalize', action='store_true', default=False,
+                   help='Store normalized and log heatmaps?')
+    p.add_argument('--smearedthumbplot', action='store_true', default=False,
+                   help='normalize_heatmaps_new option.')
+    p.add_argument('--normradialbins', action='store_true', default=False,
+                   help='normalize_heatmaps_new option.')
+    args = p.parse_args()
+
+    convert_pickle(args.pickle, args.output, normalize=args.normalize,
+                   smearedthumbplot=args.smearedthumbplot,
+                   normradialbins=args.normradialbins)
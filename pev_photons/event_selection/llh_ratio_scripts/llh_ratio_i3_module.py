@@ -1,21 +1,43 @@
 
 #Python Lib imports
-import cPickle as pickle
 import numpy as np
 
 #IceTray imports
 from icecube import icetray, dataio, dataclasses, phys_services, toprec
 from I3Tray import *
 from icecube.dataclasses import I3Constants
-from icecube.icetray.i3logging import log_info, log_warn, log_debug, log_trace, log_error
+from icecube.icetray.i3logging import log_info, log_warn, log_debug, log_trace, log_error, log_fatal
 from icecube.recclasses import I3LaputopParams, LaputopParameter
 
 # Function/Global var imports
-from llh_ratio_test_library import llh_ratio_test
+from llh_ratio_test_library import llh_ratio_test, shared_resource, combine_pulses, pack_omkeys
 from llh_ratio_test_globals import globalhistbins as histbins
 from llh_ratio_test_globals import globalhistrange as histrange
-from llh_ratio_test_globals import zenith_bins,s125_bins, correct_slc_time
-from tools import to_shower_cs
+from llh_ratio_test_globals import shower_cs
+from llh_ratio_test_globals import load_slc_time_correction, correct_slc_times
+
+# Intermediates of the current event, shared by all IceTop_LLH_Ratio instances in the process
+# (e.g. one per systematic reco): gathered pulse maps and the histograms of each track.
+# Keyed by I3EventHeader only, so it is cleared whenever a module is configured or
+# gets a new geometry: event ids of another tray or geometry never hit old entries.
+frame_cache = {'event':None, 'pulses':{}, 'tracks':{}}
+
+def clear_frame_cache():
+    """ Drops the cached event."""
+    frame_cache['event'] = None
+    frame_cache['pulses'] = {}
+    frame_cache['tracks'] = {}
+
+def event_id(frame):
+    """ (run, event, sub event, stream) of a frame, None without I3EventHeader."""
+    if 'I3EventHeader' not in frame:
+        return None
+    header = frame['I3EventHeader']
+    return (header.run_id, header.event_id, header.sub_event_id, header.sub_event_stream)
+
+def track_key(axis):
+    """ Everything of a track the LLH values depend on."""
+    return (axis.pos.x, axis.pos.y, axis.pos.z, axis.dir.zenith, axis.dir.azimuth, axis.time)
 
 
 class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
@@ -39,6 +61,10 @@ class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
                           False)
         self.AddParameter('TwoDPDFPickleYear','Year to get pickle that contains 3 x 2D PDFs for Gamma Sim and Data for all s125/zen bins',
                           None)
+        self.AddParameter('HeatmapStore','Basename of a heatmap store (see heatmap_store.py), used instead of the year pickle',
+                          None)
+        self.AddParameter('TraceTanks','If true: also store the number of tanks landing on zero PDF bins (N_unused_tanks_*)',
+                          True)
         #self.AddOutbox('OutBox')
 
     def Configure(self):
@@ -51,6 +77,9 @@ class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
         self.highE = self.GetParameter('highEbins')
         self.checkQuality = self.GetParameter('checkQuality')
         year = self.GetParameter('TwoDPDFPickleYear')
+        self.heatmapstore = self.GetParameter('HeatmapStore')
+        self.trace_tanks = self.GetParameter('TraceTanks')
+        clear_frame_cache()
 
         if year == None:
             self.histpickle = None
@@ -66,19 +95,23 @@ class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
         # Initiate LLH Ratio Test class
         self.llh = llh_ratio_test()
         self.llh.load_geometry(self.geoh5)
-        self.llh.load_heatmaps(self.histpickle)
-        self.llh.normalize_heatmaps_new(smearedthumbplot=False, normradialbins=False)
+        # Heatmaps, geometry and SLC correction are shared by all instances in the process
+        if self.heatmapstore != None:
+            self.llh.load_shared_heatmaps(self.heatmapstore, store=True, smearedthumbplot=False, normradialbins=False)
+        else:
+            self.llh.load_shared_heatmaps(self.histpickle, smearedthumbplot=False, normradialbins=False)
+
+        # Zen/S125 bins and the heatmap index of each bin
+        self.llh.set_analysis_bins(self.highE)
 
         # Load SLC Time Correction Pickle
         if self.slc_time_corr != None:
-            f=open(self.slc_time_corr,'r')
-            self.mean_slc_charge = np.array( pickle.load(f) )
-            self.median_time_diff = np.array( pickle.load(f) )
-            variance_time = np.array( pickle.load(f) )
-            f.close()
+            self.slc_charge_table, self.slc_time_table = shared_resource('slc_time_correction', self.slc_time_corr, (),
+                                                                         lambda: load_slc_time_correction(self.slc_time_corr))
 
     def Geometry(self,frame):
         self.geometry = frame['I3Geometry']
+        clear_frame_cache()
         self.PushFrame(frame)
 
 
@@ -95,21 +128,7 @@ class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
         logs125= params.value(Par.Log10_S125)
 
         # Locate the Zen/S125 bin to use appropriate 2D PDF
-        for zen_high,zen_low in zenith_bins:
-            if coszen < zen_high and coszen >= zen_low:
-                break
-            zen_high = None
-
-        #if not self.highEbins:
-        if not self.highE:
-            s125_bins = np.array(zip(np.arange(-0.5,1,0.1),np.arange(-0.4,1.1,0.1)))
-        else:
-            s125_bins = np.array(zip(np.arange(-0.5,2.1,0.1),np.arange(-0.4,2.2,0.1)))
-        
-        for s125_low,s125_high in s125_bins:
-            if logs125 < s125_high and logs125 >= s125_low:
-                break
-            s125_high = None
+        s125_bin, zen_bin, s125_index, zen_index = self.llh.locate_heatmap_bins(logs125, coszen)
 
         # See whether Pulse Containers are found in frame
         good_event = self.slcpulses in frame or self.hlcpulses in frame
@@ -117,85 +136,302 @@ class IceTop_LLH_Ratio(icetray.I3ConditionalModule):
             log_info('Either %s or %s missing in frame. LLH Ratio not being calculated.'%(self.slcpulses,self.hlcpulses))
       
         # Store Nans if event out of S125/Zen bin or Pulse Containers not found
-        if s125_high==None or zen_high==None or not good_event:
-            dict={}
-            for key in ['q_r','q_t','t_r']:
-                dict['LLH_Hadron_%s'%key]=np.nan
-                dict['LLH_Gamma_%s'%key]=np.nan
-            dict['LLH_Ratio']=np.nan
-            frame.Put(self.objname, dataclasses.I3MapStringDouble(dict))
+        if s125_bin<0 or zen_bin<0 or not good_event:
+            frame.Put(self.objname, dataclasses.I3MapStringDouble(self.nan_output()))
             self.PushFrame(frame)
             return
         
-        self.llh.events={}
-        event_doms=[]
-
         axis=frame[self.track]
-        rotation = to_shower_cs(axis)
-        origin = np.array([[axis.pos.x], [axis.pos.y], [axis.pos.z]])
-        self.llh.events['laputop_x']=[axis.pos.x] #len(self.events['laputop_x']) used for a loop later
 
-        for pulsename,tag in [[self.slcpulses,'slc'], [self.hlcpulses,'hlc']]:
+        # Recos with the same track (e.g. S125 shifts) only redo the heatmap lookup
+        key = (self.slcpulses, self.hlcpulses, self.slc_time_corr, self.geoh5, self.trace_tanks, track_key(axis))
+        event = self.cached(frame, 'tracks', key, lambda: self.event_intermediates(frame, axis))
 
-            if pulsename  not in frame:
-                log_warn('%s not found in frame'%pulsename)
-                continue
+        results = self.llh.calc_llh_values_batch(None, None, None, None,
+                            histbins=histbins, histrange=histrange, s125=s125_index,
+                            zen = zen_index, ignorezerobinsinboth=True, tanks=event['tanks'],
+                            histograms=event['histograms'])
+
+        frame.Put(self.objname, dataclasses.I3MapStringDouble(self.output(results,0)))
 
-            self.llh.events[tag+'_rperp']=[]
-            self.llh.events[tag+'_q']=[]
-            self.llh.events[tag+'_t']=[]
-
-            pulses = dataclasses.I3RecoPulseSeriesMap.from_frame(frame,pulsename)
-
-            for k,m in pulses.iteritems():
-                event_doms.append((k[0],k[1],k[2]))
-                for i,pulse in enumerate(m):
-                    if not k in self.geometry.omgeo:
-                        log_fatal("OM {om} not in geometry!".format(om=k))
-                        continue
-                    position = self.geometry.omgeo[k].position
-                    det_cs_position = np.array([[position.x],
-                                      [position.y],
-                                      [position.z]])
-                    shower_cs_position = rotation*(det_cs_position - origin)
-                    shower_cs_radius = np.sqrt(shower_cs_position[0]**2 + shower_cs_position[1]**2)
-                    time = pulse.time - float(axis.time - shower_cs_position[2]/ I3Constants.c)
-
-                    # Correct SLC Time Stamp if SLC Time Correction Pickle has been supplied
-                    if self.slc_time_corr!=None and pulsename==self.slcpulses:
-                        newtime = correct_slc_time(self.mean_slc_charge, self.median_time_diff, time, pulse.charge)
-                        time = newtime
-
-                    self.llh.events[tag+'_rperp'].append(np.log10(np.float(shower_cs_radius)))
-                    self.llh.events[tag+'_q'].append(np.log10(pulse.charge))
-                    self.llh.events[tag+'_t'].append(np.log10(time))
-
-        nohit_t,nohit_q,nohit_rperp,nohit_om,nohit_string= self.llh.no_hit_doms(event_doms,axis.dir.azimuth,axis.dir.zenith,axis.pos.x,axis.pos.y)
-        self.llh.events['nohit_t'] = nohit_t
-        self.llh.events['nohit_q'] = nohit_q
-        self.llh.events['nohit_rperp'] = nohit_rperp
-        self.llh.events['nohit_om'] = nohit_om
-        self.llh.events['nohit_string'] = nohit_string
-
-        # need to convert each list to list of list.
-        for key in self.llh.events.keys():
-            self.llh.events[key] = [self.llh.events[key]]
-
-        self.llh.calc_llh_values_new(histbins=histbins, histrange=histrange, s125=str(s125_high), 
-                            zen = str(zen_high), ignorezerobinsinboth=True,
-                            generatepdf=False, pdffileinstance=None, trace_tanks=False)
+        self.PushFrame(frame)
+        return
+
+    def nan_output(self):
+        """ Output map of events that are not scored."""
+        dict={}
+        for key in ['q_r','q_t','t_r']:
+            dict['LLH_Hadron_%s'%key]=np.nan
+            dict['LLH_Gamma_%s'%key]=np.nan
+        dict['LLH_Ratio']=np.nan
+        if self.trace_tanks:
+            for key in ['q_r','q_t','t_r','Common']:
+                dict['N_unused_tanks_%s'%key]=np.nan
+        return dict
 
+    def output(self, results, i):
+        """ Output map of event i of calc_llh_values_batch results."""
         dict={}
         LLHRatio=0
         for key in ['q_r','q_t','t_r']:
-            dict['LLH_Hadron_%s'%key]=self.llh.events['proton_like'][key][0]
-            dict['LLH_Gamma_%s'%key]=self.llh.events['gamma_like'][key][0]
-            LLHRatio += self.llh.events['proton_like'][key][0] - self.llh.events['gamma_like'][key][0] 
+            dict['LLH_Hadron_%s'%key]=results['proton_like'][key][i]
+            dict['LLH_Gamma_%s'%key]=results['gamma_like'][key][i]
+            LLHRatio += results['proton_like'][key][i] - results['gamma_like'][key][i]
         dict['LLH_Ratio']=LLHRatio
-        frame.Put(self.objname, dataclasses.I3MapStringDouble(dict))
+        if self.trace_tanks:
+            for key in ['q_r','q_t','t_r','Common']:
+                dict['N_unused_tanks_%s'%key]=results['N_unused_tanks'][key][i]
+        return dict
 
-        # Event arrays need to be cleared out:
-        del self.llh.events
+    def cached(self, frame, kind, key, compute):
+        """ Value of key in frame_cache[kind] for the event of frame, computed once per event.
+            Frames without I3EventHeader are not cached."""
 
-        self.PushFrame(frame)
-        return
+        event = event_id(frame)
+        if event is None:
+            return compute()
+        if frame_cache['event'] != event:
+            clear_frame_cache()
+            frame_cache['event'] = event
+        if key not in frame_cache[kind]:
+            frame_cache[kind][key] = compute()
+        return frame_cache[kind][key]
+
+    def event_intermediates(self, frame, axis):
+        """ Histograms of the SLC, HLC and no hit tanks of the event for one track.
+            Output: dict with the event_histograms and the (string, om) of every entry
+            if TraceTanks (else None)."""
+
+        r=[]
+        q=[]
+        t=[]
+        event_doms=[]
+        tanks=[]
+        for pulsename in [self.slcpulses, self.hlcpulses]:
+
+            if pulsename  not in frame:
+                log_warn('%s not found in frame'%pulsename)
+                continue
+
+            rperp, charge, time, doms, pulse_doms = self.gather_pulses(frame, pulsename, axis)
+            r.append(rperp)
+            q.append(charge)
+            t.append(time)
+            event_doms.append(doms)
+            tanks.append(pulse_doms)
+
+        nohit_t,nohit_q,nohit_rperp,nohit_om,nohit_string= self.llh.no_hit_doms(np.concatenate(event_doms),axis.dir.azimuth,axis.dir.zenith,axis.pos.x,axis.pos.y)
+        r.append(nohit_rperp)
+        q.append(nohit_q)
+        t.append(nohit_t)
+        tanks.append(np.column_stack((nohit_string,nohit_om)))
+
+        if self.trace_tanks:
+            tanks = np.concatenate(tanks)
+            tanks = (tanks[:,0], tanks[:,1])
+        else:
+            tanks = None
+
+        r = np.concatenate(r)
+        histograms = self.llh.event_histograms(r, np.concatenate(q), np.concatenate(t), np.array([0,len(r)]),
+                                               histbins, histrange, tank_bins=self.trace_tanks)
+        return {'histograms':histograms, 'tanks':tanks}
+
+    def read_pulses(self, frame, pulsename):
+        """ Gathers a pulse map into flat arrays.
+            Output: position, charge and time of every pulse, the (string, om, pmt)
+            of every DOM in the map and the (string, om) of every pulse."""
+
+        pulses = dataclasses.I3RecoPulseSeriesMap.from_frame(frame,pulsename)
+
+        positions=[]
+        charges=[]
+        times=[]
+        doms=[]
+        pulse_doms=[]
+        for k,m in pulses.iteritems():
+            doms.append((k[0],k[1],k[2]))
+            if len(m)==0:
+                continue
+            if not k in self.geometry.omgeo:
+                log_fatal("OM {om} not in geometry!".format(om=k))
+                continue
+            position = self.geometry.omgeo[k].position
+            positions.extend([(position.x, position.y, position.z)]*len(m))
+            charges.extend([pulse.charge for pulse in m])
+            times.extend([pulse.time for pulse in m])
+            pulse_doms.extend([(k[0],k[1])]*len(m))
+
+        positions = np.array(positions,dtype=float).reshape(-1,3)
+        charges = np.array(charges,dtype=float)
+        times = np.array(times,dtype=float)
+        doms = np.array(doms,dtype=np.int64).reshape(-1,3)
+        pulse_doms = np.array(pulse_doms,dtype=np.int64).reshape(-1,2)
+        return positions, charges, times, doms, pulse_doms
+
+    def gather_pulses(self, frame, pulsename, axis):
+        """ Transforms the pulses of a pulse map (read once per event) in bulk.
+            Output: log10 of rperp, charge and (SLC corrected) shower front time
+            of every pulse, the (string, om, pmt) of every DOM in the map
+            and the (string, om) of every pulse."""
+
+        positions, charges, times, doms, pulse_doms = self.cached(frame, 'pulses', pulsename,
+                                                                  lambda: self.read_pulses(frame, pulsename))
+
+        shower_cs_radius, delay = shower_cs(positions, [axis.pos.x, axis.pos.y, axis.pos.z],
+                                            axis.dir.theta, axis.dir.phi, c=I3Constants.c)
+        times = times - (axis.time - delay)
+
+        # Correct SLC Time Stamp if SLC Time Correction Pickle has been supplied
+        if self.slc_time_corr!=None and pulsename==self.slcpulses:
+            times = correct_slc_times(self.slc_charge_table, self.slc_time_table, times, charges)
+
+        return np.log10(shower_cs_radius), np.log10(charges), np.log10(times), doms, pulse_doms
+
+
+class IceTop_LLH_Ratio_Batch(IceTop_LLH_Ratio):
+    """ IceTop_LLH_Ratio that buffers BatchSize physics frames and scores them with one
+        calc_llh_values_batch call. Every other frame (DAQ, custom streams, ...) is buffered
+        along, so all frames leave in their original order. The buffer is flushed before
+        Geometry, Calibration and DetectorStatus frames and at Finish.
+        If only decides which physics frames are scored: frames it skips are buffered
+        unscored instead of being pushed ahead of the buffer."""
+
+    flush_streams = [icetray.I3Frame.Geometry, icetray.I3Frame.Calibration, icetray.I3Frame.DetectorStatus]
+
+    def __init__(self,ctx):
+        IceTop_LLH_Ratio.__init__(self,ctx)
+        self.AddParameter('BatchSize','Number of physics frames scored at once',
+                          1000)
+
+    def Configure(self):
+        IceTop_LLH_Ratio.Configure(self)
+        self.batchsize = self.GetParameter('BatchSize')
+        self.condition = self.GetParameter('If')
+        self.buffer = []
+        self.nphysics = 0
+
+    def ShouldDoProcess(self,frame):
+        # Frames skipped by If would be pushed ahead of the buffer, If is applied in Process
+        return True
+
+    def Process(self):
+        frame = self.PopFrame()
+        if frame.Stop in self.flush_streams:
+            self.flush()
+            if frame.Stop == icetray.I3Frame.Geometry:
+                self.Geometry(frame)
+            else:
+                self.PushFrame(frame)
+        elif frame.Stop == icetray.I3Frame.Physics and (self.condition is None or self.condition(frame)):
+            self.Physics(frame)
+        else:
+            self.buffer.append((frame,False))
+
+    def Physics(self,frame):
+        if self.checkQuality and not frame[self.track+'_passing']:
+            frame.Put(self.objname, dataclasses.I3MapStringDouble({}))
+            return
+        self.buffer.append((frame,True))
+        self.nphysics += 1
+        if self.nphysics >= self.batchsize:
+            self.flush()
+
+    def Finish(self):
+        self.flush()
+
+    def flush(self):
+        """ Scores the buffered physics frames and pushes all buffered frames in order."""
+
+        frames = [frame for frame,physics in self.buffer if physics]
+        if len(frames)>0:
+            for frame, output in zip(frames, self.score_frames(frames)):
+                frame.Put(self.objname, dataclasses.I3MapStringDouble(output))
+        for frame,physics in self.buffer:
+            self.PushFrame(frame)
+        self.buffer = []
+        self.nphysics = 0
+
+    def score_frames(self, frames):
+        """ Output maps of physics frames, scored together. The pulses of all frames are
+            transformed in bulk, no hit tanks are found with one no_hit_tanks call."""
+
+        outputs = [self.nan_output() for frame in frames]
+
+        scored = []
+        s125 = []
+        zen = []
+        axes = []
+        gathered = {self.slcpulses:[], self.hlcpulses:[]}
+        for i,frame in enumerate(frames):
+            laputop=frame[self.track]
+            coszen = np.cos(laputop.dir.zenith)
+            params = I3LaputopParams.from_frame(frame, self.track+'Params')
+            logs125= params.value(LaputopParameter.Log10_S125)
+            s125_bin, zen_bin, s125_index, zen_index = self.llh.locate_heatmap_bins(logs125, coszen)
+
+            good_event = self.slcpulses in frame or self.hlcpulses in frame
+            if not good_event:
+                log_info('Either %s or %s missing in frame. LLH Ratio not being calculated.'%(self.slcpulses,self.hlcpulses))
+            if s125_bin<0 or zen_bin<0 or not good_event:
+                continue
+
+            scored.append(i)
+            s125.append(s125_index)
+            zen.append(zen_index)
+            axes.append(laputop)
+            for pulsename in [self.slcpulses, self.hlcpulses]:
+                if pulsename not in frame:
+                    log_warn('%s not found in frame'%pulsename)
+                    gathered[pulsename].append((np.zeros((0,3)),np.zeros(0),np.zeros(0),
+                                                np.zeros((0,3),dtype=np.int64),np.zeros((0,2),dtype=np.int64)))
+                    continue
+                gathered[pulsename].append(self.read_pulses(frame, pulsename))
+
+        if len(scored)==0:
+            return outputs
+
+        core = np.array([[axis.pos.x, axis.pos.y, axis.pos.z] for axis in axes])
+        theta = np.array([axis.dir.theta for axis in axes])
+        phi = np.array([axis.dir.phi for axis in axes])
+        time = np.array([axis.time for axis in axes])
+
+        pulses = {}
+        keys = []
+        for tag,pulsename in [('slc',self.slcpulses),('hlc',self.hlcpulses)]:
+            positions, charges, times, doms, pulse_doms = [np.concatenate(column) for column in zip(*gathered[pulsename])]
+            offsets = np.zeros(len(scored)+1,dtype=np.int64)
+            offsets[1:] = np.cumsum([len(g[1]) for g in gathered[pulsename]])
+            eventno = np.repeat(np.arange(len(scored)),np.diff(offsets))
+
+            shower_cs_radius, delay = shower_cs(positions, core[eventno], theta[eventno], phi[eventno], c=I3Constants.c)
+            times = times - (time[eventno] - delay)
+            if self.slc_time_corr!=None and tag=='slc':
+                times = correct_slc_times(self.slc_charge_table, self.slc_time_table, times, charges)
+
+            pulses[tag] = {'rperp':np.log10(shower_cs_radius), 'q':np.log10(charges), 't':np.log10(times),
+                           'string':pulse_doms[:,0], 'om':pulse_doms[:,1], 'offsets':offsets}
+            dom_offsets = np.cumsum([0]+[len(g[3]) for g in gathered[pulsename]])
+            keys.append((pack_omkeys(doms[:,0],doms[:,1],doms[:,2]), np.repeat(np.arange(len(scored)),np.diff(dom_offsets))))
+
+        # Hit DOMs of each event, slc then hlc
+        eventno = np.concatenate([k[1] for k in keys])
+        order = np.argsort(eventno,kind='mergesort')
+        offsets = np.zeros(len(scored)+1,dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(eventno,minlength=len(scored)))
+        pulses['nohit'] = self.llh.no_hit_tanks(np.concatenate([k[0] for k in keys])[order],offsets,
+                                                [axis.dir.azimuth for axis in axes],[axis.dir.zenith for axis in axes],
+                                                core[:,0],core[:,1])
+
+        r, q, t, string, om, offsets = combine_pulses(pulses,variables=['rperp','q','t','string','om'],
+                                                      tags=['slc','hlc','nohit'])
+        if self.trace_tanks:
+            tanks = (string, om)
+        else:
+            tanks = None
+
+        results = self.llh.calc_llh_values_batch(r, q, t, offsets, histbins=histbins, histrange=histrange,
+                            s125=np.array(s125), zen=np.array(zen), ignorezerobinsinboth=True, tanks=tanks)
+        for j,i in enumerate(scored):
+            outputs[i] = self.output(results,j)
+        return outputs
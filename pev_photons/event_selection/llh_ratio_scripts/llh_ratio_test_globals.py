@@ -25,6 +25,71 @@ key = 't_r'
 globalhistbins[key]=[80,60]
 globalhistrange[key] = [[0,4],[-2,4]]
 
+# speed of light in m/ns, as I3Constants.c
+light_speed = 0.299792458
+
+def shower_cs_rotation(theta,phi):
+    """ Rotation from detector to shower coordinate system, the product of the
+        counter-clockwise (pi + phi) and clock-wise (pi - theta) rotations.
+        Input: scalar or array angles. Output: (...,3,3) array."""
+
+    theta = np.asarray(theta,dtype=float)
+    phi = np.asarray(phi,dtype=float)
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    cos_p, sin_p = np.cos(phi), np.sin(phi)
+    zero = np.zeros_like(cos_t*cos_p)
+
+    # d_theta * d_phi written out
+    rotation = np.array([[ cos_t*cos_p,  cos_t*sin_p, -sin_t+zero],
+                         [ sin_p+zero,  -cos_p+zero,   zero],
+                         [-sin_t*cos_p, -sin_t*sin_p, -cos_t+zero]])
+    return np.moveaxis(rotation,[0,1],[-2,-1])
+
+def shower_cs(positions,core,theta,phi,c=light_speed):
+    """ Input: detector positions (...,3); shower core (...,3) and shower angles (...),
+        one axis for all positions or one per position, broadcast against each other.
+        Output: perpendicular distance to the shower axis and the plane-front delay
+        (shower cs z / c) of each position."""
+
+    rotation = shower_cs_rotation(theta,phi)
+    relative = np.asarray(positions,dtype=float) - np.asarray(core,dtype=float)
+    shower_cs_position = np.einsum('...ij,...j->...i',rotation,relative)
+    shower_cs_radius = np.sqrt(shower_cs_position[...,0]**2 + shower_cs_position[...,1]**2)
+    return shower_cs_radius, shower_cs_position[...,2]/c
+
+def hist_edges(bins, range):
+    """ Bin edges exactly as np.histogram2d/np.histogramdd build them from bins and range."""
+    return [np.linspace(low, high, nbins+1) for nbins, (low, high) in zip(bins, range)]
+
+def digitize(values, edges, last_inclusive=True):
+    """ Input: values and the edges of one histogram axis.
+        Output: 0-based bin index of each value, -1 where np.histogramdd would drop it
+        (out of range, nan). The last edge is inclusive, as in np.histogramdd,
+        unless last_inclusive=False (edges[j] <= value < edges[j+1] for every bin)."""
+
+    values = np.asarray(values, dtype=float)
+    index = np.searchsorted(edges, values, side='right')
+    if last_inclusive:
+        index[values == edges[-1]] -= 1
+    index -= 1
+    index[(index < 0) | (index >= len(edges)-1)] = -1
+    return index
+
+def linear_bin_index(values, edges):
+    """ Input: values and edges of each histogram axis.
+        Output: C-order linear bin index of each point in the flattened histogram,
+        -1 where np.histogramdd would drop it."""
+
+    shape = [len(e)-1 for e in edges]
+    index = np.zeros(len(values[0]), dtype=np.int64)
+    inrange = np.ones(len(values[0]), dtype=bool)
+    for axis_values, axis_edges, nbins in zip(values, edges, shape):
+        axis_index = digitize(axis_values, axis_edges)
+        inrange &= axis_index>=0
+        index = index*nbins + axis_index
+    index[~inrange] = -1
+    return index
+
 def correct_slc_time(mean_slc_charge,median_time_diff,slc_time,slc_charge):
     if slc_charge<=0:
         #do nothing
@@ -44,3 +109,57 @@ def correct_slc_time(mean_slc_charge,median_time_diff,slc_time,slc_charge):
 
     return corrected_slc_time
 
+
+def sort_slc_time_correction(mean_slc_charge,median_time_diff):
+    """ Sorts the SLC time correction table by charge once, for correct_slc_times."""
+    mean_slc_charge = np.asarray(mean_slc_charge,dtype=float)
+    order = np.argsort(mean_slc_charge,kind='mergesort')
+    return mean_slc_charge[order], np.asarray(median_time_diff,dtype=float)[order]
+
+def load_slc_time_correction(picklefile):
+    """ Reads a SLC time correction pickle, sorted for correct_slc_times."""
+    f=open(picklefile,'r')
+    mean_slc_charge = np.array( p.load(f) )
+    median_time_diff = np.array( p.load(f) )
+    f.close()
+    return sort_slc_time_correction(mean_slc_charge,median_time_diff)
+
+def correct_slc_times(sorted_mean_slc_charge,sorted_median_time_diff,slc_time,slc_charge):
+    """ correct_slc_time for arrays of SLC times and charges.
+        Input: the table from sort_slc_time_correction, SLC times and charges.
+        The correction of the nearest log10 charge bin is found with np.searchsorted,
+        non-positive and nan charges are left uncorrected."""
+
+    slc_time = np.array(slc_time,dtype=float)
+    slc_charge = np.asarray(slc_charge,dtype=float)
+
+    with np.errstate(invalid='ignore'):
+        select = slc_charge>0
+        xx = np.log10(slc_charge[select])
+    valid = ~np.isnan(xx)
+    select[select] = valid
+    xx = xx[valid]
+
+    right = np.searchsorted(sorted_mean_slc_charge,xx)
+    right = np.clip(right,0,len(sorted_mean_slc_charge)-1)
+    left = np.clip(right-1,0,len(sorted_mean_slc_charge)-1)
+    nearest = np.where(np.absolute(xx - sorted_mean_slc_charge[left]) <= np.absolute(xx - sorted_mean_slc_charge[right]),
+                       left, right)
+
+    slc_time[select] = slc_time[select] + sorted_median_time_diff[nearest]
+    return slc_time
+
+def locate_bin(value,lows,highs):
+    """ Input: value(s), lower and upper edges of sorted bins (ascending or descending).
+        Output: index of the first bin with lows[i] <= value < highs[i], -1 if there is none."""
+
+    lows = np.asarray(lows,dtype=float)
+    highs = np.asarray(highs,dtype=float)
+    if lows[0] <= lows[-1]:
+        index = np.digitize(value,highs)
+    else:
+        index = np.digitize(value,lows)
+    inside = np.minimum(index,len(lows)-1)
+    with np.errstate(invalid='ignore'):
+        found = (index<len(lows)) & (lows[inside]<=value) & (value<highs[inside])
+    return np.where(found,index,-1)
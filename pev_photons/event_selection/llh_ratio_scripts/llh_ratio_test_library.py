@@ -3,12 +3,427 @@ import tables
 import numpy as np
 import random
 import cPickle as pickle
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import pyplot as plt
-from matplotlib.colors import LogNorm
-from matplotlib.backends.backend_pdf import PdfPages
-from llh_ratio_test_globals import global3dbins, global3drange
+from llh_ratio_test_globals import global3dbins, global3drange, hist_edges, digitize, linear_bin_index, shower_cs
+from llh_ratio_test_globals import zenith_bins, s125_bins, locate_bin
+from heatmap_store import load_heatmap_store, store_files, template_view, primaries, templates
+
+def plotting():
+    """ pyplot (Agg backend) and LogNorm, imported only when plotting
+        so that processing jobs do not load matplotlib."""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from matplotlib.colors import LogNorm
+    return plt, LogNorm
+
+def pdf_file(filename):
+    """ PdfPages for plot_heatmaps/make_pdf/plot_events. Open it through this function,
+        importing matplotlib.backends first would choose the backend before plotting() does."""
+    plotting()
+    from matplotlib.backends.backend_pdf import PdfPages
+    return PdfPages(filename)
+
+def segment_sums(values,bounds,pairwise=True):
+    """ Sum of values[bounds[i]:bounds[i+1]] for each i, 0 for empty segments.
+        pairwise: the sums are bit for bit those of np.sum on each slice (pairwise summation),
+        as the per event scoring gives them. Segments of equal length are summed together
+        with one np.sum over axis 1, so the loop runs over the distinct lengths, not the events.
+        Else np.add.reduceat sums each segment left to right, about 8 times faster again
+        but different in the last bits."""
+    bounds = np.asarray(bounds)
+    lengths = np.diff(bounds)
+    sums = np.zeros(len(lengths))
+    if not pairwise:
+        nonempty = lengths>0
+        if np.any(nonempty):
+            sums[nonempty] = np.add.reduceat(values,bounds[:-1][nonempty])
+        return sums
+    for length in np.unique(lengths[lengths>0]):
+        segments = np.flatnonzero(lengths==length)
+        sums[segments] = values[bounds[segments][:,np.newaxis]+np.arange(length)].sum(axis=1)
+    return sums
+
+def gather_log_like(counts,pdf,logpdf):
+    """ log10(counts*pdf) for the occupied bins of an event histogram,
+        given the heatmap and log heatmap values of those bins.
+        Taken from the log table, only bins hit more than once are recomputed
+        so the result is identical to the log of the dense product."""
+    temp = np.array(logpdf,dtype=float)
+    multi = counts>1
+    if np.any(multi):
+        with np.errstate(divide='ignore'):
+            temp[multi] = np.log10(counts[multi]*pdf[multi])
+    return temp
+
+def sparse_histograms(eventno,linbin,nbins):
+    """ Histograms of many events without a dense (event, bin) array.
+        Input: event number and linear bin index (-1 for dropped entries) of each entry.
+        Output: event, bin and count of each occupied bin, ordered by event and then by bin."""
+    select = linbin>=0
+    index = np.unique(eventno[select].astype(np.int64)*nbins + linbin[select],return_counts=True)
+    return index[0]//nbins, index[0]%nbins, index[1].astype(float)
+
+def segment_counts(mask,offsets):
+    """ Number of true entries of mask in each segment offsets[i]:offsets[i+1]."""
+    cumulative = np.zeros(len(mask)+1,dtype=np.int64)
+    np.cumsum(mask,out=cumulative[1:])
+    return cumulative[offsets[1:]]-cumulative[offsets[:-1]]
+
+def count_common(eventno,string,om,masks,nevents):
+    """ Number of distinct (string, om) of each event with an entry in every one of masks.
+        The (string, om) present are numbered with one bincount of the packed keys and
+        flagged in a dense (event, key) array, so no sort over the entries is needed."""
+    select = np.flatnonzero(np.logical_or.reduce(masks))
+    if len(select)==0:
+        return np.zeros(nevents,dtype=np.int64)
+    codes = (np.asarray(string,dtype=np.int64)[select]<<8) | np.asarray(om,dtype=np.int64)[select]
+    slots = np.cumsum(np.bincount(codes)>0)-1
+    nslots = slots[-1]+1
+    keys = eventno[select]*nslots + slots[codes]
+
+    flags = np.zeros(nevents*nslots,dtype=np.uint8)
+    for k,mask in enumerate(masks):
+        flags[keys[mask[select]]] |= 1<<k
+    return (flags.reshape(nevents,nslots)==(1<<len(masks))-1).sum(axis=1)
+
+class deferred_events(object):
+    """ Event columns (self.events of llh_ratio_test) that are read from the file when first
+        requested, with all cuts kept as one combined mask over the rows of the file.
+        A cut only updates the mask; a column is read once and masked once when it is requested.
+        Values set directly (e.g. pulse containers, llh values) belong to the surviving events
+        and are cut right away."""
+
+    def __init__(self):
+        self.loaders = {}
+        self.raw = {}
+        self.values = {}
+        self.mask = None
+
+    def add(self,key,loader):
+        """ Registers a column of all rows of the file, loader() reads it."""
+        self.loaders[key] = loader
+        self.raw.pop(key,None)
+        self.values.pop(key,None)
+
+    def from_file(self,key):
+        return key in self.loaders
+
+    def column(self,key):
+        """ Uncut column of a registered key, read once."""
+        if key not in self.raw:
+            self.raw[key] = np.asarray(self.loaders[key]())
+        return self.raw[key]
+
+    def cut(self,select,rows=False):
+        """ Keeps the events where select is true. select is over the surviving events,
+            or over all rows of the file if rows=True."""
+
+        select = np.asarray(select,dtype=bool)
+        if rows:
+            mask = select if self.mask is None else self.mask&select
+            select = select if self.mask is None else select[self.mask]
+        elif self.mask is None:
+            mask = select
+        else:
+            mask = np.zeros(len(self.mask),dtype=bool)
+            mask[np.flatnonzero(self.mask)[select]] = True
+
+        for key in self.values.keys():
+            if key in self.loaders:
+                del self.values[key]
+            else:
+                self.values[key] = self.values[key][select]
+        self.mask = mask
+        return
+
+    def restore(self,mask=None):
+        """ Goes back to an earlier mask (None: no cuts), e.g. for loops over s125/zen bins.
+            Values set directly are dropped, they do not belong to these events."""
+        self.values = {}
+        self.mask = mask
+        return
+
+    def __getitem__(self,key):
+        if key not in self.values:
+            if key not in self.loaders:
+                raise KeyError(key)
+            column = self.column(key)
+            self.values[key] = column if self.mask is None else column[self.mask]
+        return self.values[key]
+
+    def __setitem__(self,key,value):
+        self.values[key] = value
+        self.loaders.pop(key,None)
+        self.raw.pop(key,None)
+
+    def __delitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        self.values.pop(key,None)
+        self.loaders.pop(key,None)
+        self.raw.pop(key,None)
+
+    def __contains__(self,key):
+        return key in self.values or key in self.loaders
+
+    def keys(self):
+        return list(set(self.values.keys())|set(self.loaders.keys()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self,key,default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self,other):
+        for key in other.keys():
+            self[key] = other[key]
+
+class sparse_heatmap(object):
+    """ Heatmap kept as the sorted linear (C-order) indices and the values of its nonzero bins.
+        Every other bin holds fill, 0 for heatmaps and -inf for log heatmaps.
+        The 3D heatmaps are mostly empty, this keeps them at a few percent of the dense size."""
+
+    def __init__(self,index,values,shape,fill=0.):
+        self.index = np.asarray(index,dtype=np.int32)
+        self.values = np.asarray(values)
+        self.shape = tuple(shape)
+        self.fill = fill
+
+    @classmethod
+    def from_dense(cls,dense,dtype=np.float64):
+        """ Input: dense heatmap; dtype of the stored values, np.float32 halves them again."""
+        dense = np.asarray(dense)
+        index = np.flatnonzero(dense)
+        return cls(index,dense.ravel()[index].astype(dtype),dense.shape)
+
+    def toarray(self):
+        dense = np.full(np.prod(self.shape),self.fill,dtype=self.values.dtype)
+        dense[self.index] = self.values
+        return dense.reshape(self.shape)
+
+    def gather(self,linear):
+        """ Values of the bins with the given linear indices."""
+        linear = np.asarray(linear)
+        values = np.full(len(linear),self.fill,dtype=self.values.dtype)
+        if len(self.index)==0:
+            return values
+        position = np.minimum(np.searchsorted(self.index,linear),len(self.index)-1)
+        found = self.index[position]==linear
+        values[found] = self.values[position[found]]
+        return values
+
+    def normalize(self,smearedthumbplot=False,normradialbins=False):
+        """ Normalized copy, bin for bin that of normalize_heatmaps_new on the dense heatmap.
+            The totals are summed over a dense copy (made here, once per heatmap), as np.sum
+            of the nonzero values alone adds them in another order.
+            normradialbins: the rows of a 2D heatmap are summed left to right, like the builtin
+            sum of normalize_heatmaps_new. Dense heatmaps of more dimensions can not be
+            normalized per row there (sum gives an array), here each row (first axis) is
+            divided by its np.sum."""
+        index, values = self.index, self.values.copy()
+
+        if smearedthumbplot==True:
+            keep = values>1e-7 # remove extremely small probability values
+            index, values = index[keep], values[keep]
+
+        if normradialbins==True:
+            row = index//int(np.prod(self.shape[1:]))
+            if len(self.shape)==2:
+                norm = np.bincount(row,weights=values,minlength=self.shape[0])
+            else:
+                dense = sparse_heatmap(index,values,self.shape).toarray()
+                norm = np.array([np.sum(dense[i]) for i in range(self.shape[0])])
+            values = values/norm[row]
+        else:
+            values = values/np.sum(sparse_heatmap(index,values,self.shape).toarray())
+
+        return sparse_heatmap(index,values.astype(self.values.dtype),self.shape)
+
+    def log10(self):
+        """ log10 heatmap, -inf on empty bins."""
+        return sparse_heatmap(self.index,np.log10(self.values),self.shape,fill=-np.inf)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.values.nbytes
+
+def gather_bins(heatmap,linear):
+    """ Values of a dense or sparse heatmap at linear bin indices."""
+    if isinstance(heatmap,sparse_heatmap):
+        return heatmap.gather(linear)
+    return heatmap.ravel()[linear]
+
+# Geometry, heatmaps and SLC time corrections shared by all IceTop_LLH_Ratio
+# instances of a process, keyed by (kind, file, mtime, options).
+shared_resources = {}
+
+def shared_resource(kind,filename,options,loader):
+    """ Result of loader(), loaded once per process for each (kind, file, mtime, options).
+        Arrays in the result are made read-only since all users share them."""
+
+    filename = os.path.abspath(filename)
+    key = (kind,filename,os.path.getmtime(filename),options)
+    if key not in shared_resources:
+        # drop copies of an older version of the file
+        for old_key in shared_resources.keys():
+            if old_key[:2]==key[:2] and old_key[3]==options:
+                del shared_resources[old_key]
+        shared_resources[key] = freeze(loader())
+    return shared_resources[key]
+
+def freeze(obj):
+    """ Makes all arrays in nested dicts/lists read-only."""
+    if isinstance(obj,np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj,dict):
+        for value in obj.values():
+            freeze(value)
+    elif isinstance(obj,(list,tuple)):
+        for value in obj:
+            freeze(value)
+    return obj
+
+geometry_dtype = [('string',np.int64),('om',np.int64),('pmt',np.int64),
+                  ('x',np.float64),('y',np.float64),('z',np.float64),
+                  ('partner_om',np.int64),('tank_first',np.bool_)]
+
+def read_geometry(geofile,ndoms=324):
+    """ Reads the DOM table of a geometry HDF file in one pass.
+        Output: record array with string, om, pmt, x, y, z, the om of the other
+        DOM in the same tank (61/62, 63/64, -1 if none) and whether the DOM is the
+        first of its tank in the table."""
+
+    geometry = tables.open_file(geofile)
+    table = geometry.root.mygeometry.read()
+    geometry.close()
+
+    # columns are DOMs, rows are string, om, pmt, x, y, z
+    columns = np.array([table['dom%i'%i] for i in range(ndoms)],dtype=np.float64)
+
+    geo = np.zeros(ndoms,dtype=geometry_dtype)
+    for i, name in enumerate(['string','om','pmt','x','y','z']):
+        geo[name] = columns[:,i]
+
+    geo['partner_om'] = -1
+    for om_a, om_b in [(61,62),(63,64)]:
+        geo['partner_om'][geo['om']==om_a] = om_b
+        geo['partner_om'][geo['om']==om_b] = om_a
+
+    tank_om = np.where(geo['partner_om']>0, np.minimum(geo['om'],geo['partner_om']), geo['om'])
+    tank_keys = pack_omkeys(geo['string'],tank_om,geo['pmt'])
+    first = np.unique(tank_keys,return_index=True)[1]
+    geo['tank_first'][first] = True
+
+    return geo
+
+def load_geometry_table(geofile,cache=True):
+    """ read_geometry, cached in geofile+'.npy'.
+        The cache is used if it is newer than geofile and is opened as a read-only memory map.
+        A cache that can not be written (read-only resource directory) is skipped silently."""
+
+    cachefile = geofile+'.npy'
+    if cache and os.path.exists(cachefile) and os.path.getmtime(cachefile)>=os.path.getmtime(geofile):
+        return np.load(cachefile,mmap_mode='r')
+
+    geo = read_geometry(geofile)
+
+    if cache:
+        tmpfile = cachefile+'.%i.tmp'%os.getpid()
+        try:
+            with open(tmpfile,'wb') as f:
+                np.save(f,geo)
+            os.rename(tmpfile,cachefile)
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    return geo
+
+def read_ragged(table,start,stop,window=100000):
+    """ Reads the rows start[i]:stop[i] of a table for all i.
+        The selected rows are read in windows of at most window rows, windows without
+        selected rows are skipped, so memory is bounded by window and the selected rows
+        however far apart they are in the file. Output: dict of flat columns and 'offsets'."""
+
+    start = np.asarray(start,dtype=np.int64)
+    stop = np.asarray(stop,dtype=np.int64)
+    lengths = stop-start
+    offsets = np.zeros(len(start)+1,dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    if offsets[-1]==0:
+        rows = table.read(0,0)
+    else:
+        # file row of every output row, read in ascending order
+        rowno = np.repeat(start-offsets[:-1],lengths) + np.arange(offsets[-1])
+        order = np.argsort(rowno,kind='mergesort')
+        sorted_rows = rowno[order]
+        bounds = np.flatnonzero(np.diff(sorted_rows//window))+1
+        bounds = np.concatenate(([0],bounds,[len(sorted_rows)]))
+
+        rows = np.empty(offsets[-1],dtype=table.dtype)
+        for a,b in zip(bounds[:-1],bounds[1:]):
+            low = sorted_rows[a]
+            rows[order[a:b]] = table.read(low,sorted_rows[b-1]+1)[sorted_rows[a:b]-low]
+
+    columns = {'offsets':offsets}
+    for name in rows.dtype.names:
+        columns[name] = rows[name]
+    return columns
+
+def merge_pulse_chunks(chunks):
+    """ Concatenates the pulse dicts of consecutive iter_pulses chunks."""
+
+    pulses = {}
+    for tag in chunks[0].keys():
+        pulses[tag] = {}
+        for var in chunks[0][tag].keys():
+            if var == 'offsets':
+                lengths = np.concatenate([np.diff(chunk[tag]['offsets']) for chunk in chunks])
+                pulses[tag]['offsets'] = np.zeros(len(lengths)+1,dtype=np.int64)
+                pulses[tag]['offsets'][1:] = np.cumsum(lengths)
+            else:
+                pulses[tag][var] = np.concatenate([chunk[tag][var] for chunk in chunks])
+    return pulses
+
+def combine_pulses(pulses,variables=['rperp','q','t'],tags=['nohit','hlc','slc']):
+    """ Input: pulse dicts of iter_pulses.
+        Output: flat arrays of the variables ordered like flatten_events
+        (nohit, hlc, slc of each event) and the event offsets."""
+
+    lengths = np.array([np.diff(pulses[tag]['offsets']) for tag in tags],dtype=np.int64).reshape(len(tags),-1)
+    offsets = np.zeros(lengths.shape[1]+1,dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths.sum(axis=0))
+
+    # Position of every entry of each tag in the combined arrays, without sorting
+    starts = offsets[:-1] + np.cumsum(lengths,axis=0) - lengths
+    positions = []
+    for k,tag in enumerate(tags):
+        tag_offsets = np.asarray(pulses[tag]['offsets'])-pulses[tag]['offsets'][0]
+        positions.append(np.repeat(starts[k]-tag_offsets[:-1],lengths[k]) + np.arange(tag_offsets[-1]))
+
+    combined = []
+    for var in variables:
+        values = [np.asarray(pulses[tag][var]) for tag in tags]
+        combined.append(np.empty(offsets[-1],dtype=np.result_type(*values)))
+        for position,value in zip(positions,values):
+            combined[-1][position] = value
+    return combined + [offsets]
+
+def pack_omkeys(string,om,pmt):
+    """ Packs (string, om, pmt) into one integer per DOM for fast membership tests."""
+    return (np.asarray(string,dtype=np.int64)<<16) | (np.asarray(om,dtype=np.int64)<<8) | np.asarray(pmt,dtype=np.int64)
 
 class llh_ratio_test(object):
 
@@ -18,106 +433,122 @@ class llh_ratio_test(object):
         self.tangerine = 'abba dabba chabba'
         return
 
-    def load_geometry(self,geofile=os.getcwd()+'/geometry.h5'):
-        """ From a geometry file, loads geometry of the detector"""
-        geometry = tables.open_file(geofile)
-        self.geo_doms=[]
-        self.geo_X = []
-        self.geo_Y = []
-        self.geo_Z = []
+    def load_geometry(self,geofile=os.getcwd()+'/geometry.h5',cache=True):
+        """ From a geometry file, loads geometry of the detector.
+            With cache=True the DOM table is kept in a .npy file next to geofile
+            and later loads are a single memory map of it."""
 
-        for i in range(324):
-            j = 'geometry.root.mygeometry.cols.dom%i'%i
-            #BEWARE: This is a DOM list not Tank list
-            self.geo_doms.append((np.int(eval(j+'[0]')),np.int(eval(j+'[1]')), np.int(eval(j+'[2]'))))
-            self.geo_X.append(eval(j+'[3]'))
-            self.geo_Y.append(eval(j+'[4]'))
-            self.geo_Z.append(eval(j+'[5]'))
+        #BEWARE: This is a DOM list not Tank list
+        self.geometry = shared_resource('geometry',geofile,(cache,),
+                                        lambda: load_geometry_table(geofile,cache=cache))
 
-        geometry.close()
+        self.geo_doms = np.column_stack((self.geometry['string'],self.geometry['om'],self.geometry['pmt']))
+        self.geo_X = self.geometry['x']
+        self.geo_Y = self.geometry['y']
+        self.geo_Z = self.geometry['z']
 
-        self.geo_X = np.array(self.geo_X)
-        self.geo_Y = np.array(self.geo_Y)
-        self.geo_Z = np.array(self.geo_Z)
+        self.make_tank_index()
 
         return
 
-    def rotate_to_shower_cs(self,x,y,z,phi,theta,core_x,core_y,core_z):
-        """ Input: X,Y,Z of the dom/particle; Phi, Theta, Core x,y ,z of the shower.
-            Output: Radial distance from shower core in shower coordinate system."""
+    def make_tank_index(self):
+        """ Precomputes packed OMKeys of all DOMs and of their tank partners (61/62, 63/64),
+            and the first DOM of every tank, which no_hit_doms uses as the tank position."""
+
+        string = self.geometry['string']
+        om = self.geometry['om']
+        pmt = self.geometry['pmt']
+        partner_om = self.geometry['partner_om']
+
+        self.geo_keys = pack_omkeys(string,om,pmt)
+        self.geo_partner_keys = np.where(partner_om>0, pack_omkeys(string,partner_om,pmt), -1)
+        self.tank_doms = np.flatnonzero(self.geometry['tank_first'])
 
-        # counter-clockwise (pi + phi) rotation
-        d_phi = np.matrix([ [ -np.cos(phi), -np.sin(phi), 0], 
-        [  np.sin(phi), -np.cos(phi), 0], 
-        [  0,                 0,                1] ])
-        # clock-wise (pi - theta) rotation
-        d_theta = np.matrix([ [  -np.cos(theta), 0, -np.sin(theta)],
-        [  0,                  1,  0,                ],  
-        [  np.sin(theta), 0,  -np.cos(theta)] ])
-        rotation= d_theta*d_phi
+        # Sorted lookup from the packed OMKey of either DOM of a tank to the tank's index
+        keys = np.concatenate((self.geo_keys[self.tank_doms],self.geo_partner_keys[self.tank_doms]))
+        tanks = np.concatenate((np.arange(len(self.tank_doms)),np.arange(len(self.tank_doms))))
+        order = np.argsort(keys[keys>=0],kind='mergesort')
+        self.tank_lookup_keys = keys[keys>=0][order]
+        self.tank_lookup_index = tanks[keys>=0][order]
 
-        origin = np.array([[core_x], [core_y], [core_z]])
+        return
+
+    def rotate_to_shower_cs(self,x,y,z,phi,theta,core_x,core_y,core_z):
+        """ Input: X,Y,Z of the dom/particle (scalars or arrays); Phi, Theta, Core x,y ,z of the shower.
+            Output: Radial distance from shower core in shower coordinate system."""
 
-        det_cs_position = np.array([[x],[y],[z]])
-        shower_cs_position = rotation*(det_cs_position - origin)
-        shower_cs_radius = np.sqrt(shower_cs_position[0]**2 + shower_cs_position[1]**2)
+        positions = np.stack(np.broadcast_arrays(x,y,z),axis=-1).astype(float)
+        shower_cs_radius = shower_cs(positions,[core_x,core_y,core_z],theta,phi)[0]
 
-        return np.float(shower_cs_radius)
+        if np.ndim(shower_cs_radius)==0:
+            return np.float(shower_cs_radius)
+        return shower_cs_radius
 
     def no_hit_doms(self,event_doms, phi, theta, core_x, core_y):
-        """ Input: Event Doms list
-            Output: No Hit Doms Location in Shower Coordinate System and Their Charge 1e-3 VEM for underflow bin."""
-
-        qnohit =[]
-        rnohit = []
-        omnohit= []
-        stringnohit = []
-
-        #print event_doms
-        #print '----------'
-        for m in range(len(self.geo_doms)):
-            if self.geo_doms[m] not in event_doms:
-                # Check if other DOM from tank is present:
-                if self.geo_doms[m][1]==61 and (self.geo_doms[m][0],62,self.geo_doms[m][2]) in event_doms:
-                    #print 'other dom present',geo_doms[m]
-                    continue
-                if self.geo_doms[m][1]==62 and (self.geo_doms[m][0],61,self.geo_doms[m][2]) in event_doms:
-                    #print 'other dom present',geo_doms[m]
-                    continue
-                if self.geo_doms[m][1]==63 and (self.geo_doms[m][0],64,self.geo_doms[m][2]) in event_doms:
-                    #print 'other dom present',geo_doms[m]
-                    continue
-                if self.geo_doms[m][1]==64 and (self.geo_doms[m][0],63,self.geo_doms[m][2]) in event_doms:
-                    #print 'other dom present',geo_doms[m]
-                    continue
-                #print 'this tank is not present:',geo_doms[m]
-                rnohit.append(self.rotate_to_shower_cs(self.geo_X[m], self.geo_Y[m], 0, phi, theta, core_x, core_y, 0))
-                qnohit.append(1e-3)
-                event_doms.append(self.geo_doms[m])
-                omnohit.append(self.geo_doms[m][1])
-                stringnohit.append(self.geo_doms[m][0])
-
-        #print len(event_doms)
-        qnohit = np.log10(qnohit)
-        rnohit = np.log10(rnohit)
-        tnohit = np.ones_like(rnohit)*-2
-        omnohit = np.array(omnohit)
-        stringnohit = np.array(stringnohit)
-
-        return tnohit, qnohit,rnohit,omnohit,stringnohit
+        """ Input: Event Doms, list of (string, om, pmt) or Nx3 array
+            Output: No Hit Doms Location in Shower Coordinate System and Their Charge 1e-3 VEM for underflow bin.
+            A tank counts as hit if either of its DOMs is in event_doms.
+            One entry per not hit tank, at the position of the tank's first DOM in the geometry."""
+
+        event_doms = np.array(event_doms,dtype=np.int64).reshape(-1,3)
+        event_keys = pack_omkeys(event_doms[:,0],event_doms[:,1],event_doms[:,2])
+
+        nohit = self.no_hit_tanks(event_keys,np.array([0,len(event_keys)]),[phi],[theta],[core_x],[core_y])
+
+        return nohit['t'], nohit['q'], nohit['rperp'], nohit['om'], nohit['string']
+
+    def no_hit_tanks(self,event_keys,offsets,phi,theta,core_x,core_y):
+        """ no_hit_doms for many events at once.
+            Input: packed OMKeys (pack_omkeys) of the hit DOMs of all events with event offsets,
+            and the shower phi, theta, core x, y of each event.
+            Output: dict of flat rperp, q, t, om, string arrays of the not hit tanks,
+            ordered by event, and their offsets."""
+
+        nevents = len(offsets)-1
+        ntanks = len(self.tank_doms)
+        eventno = np.repeat(np.arange(nevents),np.diff(offsets))
+
+        event_keys = np.asarray(event_keys,dtype=np.int64)
+        index = np.clip(np.searchsorted(self.tank_lookup_keys,event_keys),0,len(self.tank_lookup_keys)-1)
+        found = self.tank_lookup_keys[index]==event_keys
+
+        tank_hit = np.zeros((nevents,ntanks),dtype=bool)
+        tank_hit[eventno[found],self.tank_lookup_index[index[found]]] = True
+        nohit_event, nohit_tank = np.nonzero(~tank_hit)
+        nohit = self.tank_doms[nohit_tank]
+
+        positions = np.column_stack((self.geo_X[nohit],self.geo_Y[nohit],np.zeros(len(nohit))))
+        core = np.column_stack((np.asarray(core_x,dtype=float)[nohit_event],np.asarray(core_y,dtype=float)[nohit_event],
+                                np.zeros(len(nohit))))
+        radius = shower_cs(positions,core,np.asarray(theta,dtype=float)[nohit_event],
+                           np.asarray(phi,dtype=float)[nohit_event])[0]
+
+        pulses={}
+        pulses['rperp'] = np.log10(radius)
+        pulses['q'] = np.log10(np.full(len(nohit),1e-3))
+        pulses['t'] = np.ones_like(pulses['rperp'])*-2
+        pulses['om'] = np.array(self.geo_doms[nohit,1])
+        pulses['string'] = np.array(self.geo_doms[nohit,0])
+        pulses['offsets'] = np.zeros(nevents+1,dtype=np.int64)
+        pulses['offsets'][1:] = np.cumsum(ntanks-tank_hit.sum(axis=1))
+
+        return pulses
 
     def load_hdf_file(self,file,llh_calculated=False,skip_non_llh=False,skylab=False,isMC=False):
-        """ Load all necessary variables from a hdf file. """
+        """ Load all necessary variables from a hdf file.
+            Columns are read when first used, see deferred_events."""
        
         self.f=tables.open_file(file)
 
-        self.events={}
+        self.events=deferred_events()
         self.hist={}
+        self.file_columns={}
 
-        self.events['cos_zen']=np.cos(self.f.root.Laputop.cols.zenith[:])
-        self.events['log_s125']=np.log10(self.f.root.LaputopParams.cols.s125[:])
-        self.events['beta']=self.f.root.LaputopParams.cols.beta[:]
-        self.events['inice_count'] = np.zeros(len(self.events['beta']))#np.array(self.f.root.hlc_count_InIcePulses.cols.value[:]) 
+        column = self.file_column
+        self.events.add('cos_zen', lambda: np.cos(column('Laputop','zenith')))
+        self.events.add('log_s125', lambda: np.log10(column('LaputopParams','s125')))
+        self.events.add('beta', lambda: column('LaputopParams','beta'))
+        self.events.add('inice_count', lambda: np.zeros(self.f.root.LaputopParams.nrows))#np.array(self.f.root.hlc_count_InIcePulses.cols.value[:]) 
         #self.events['inice_count'] += 0#np.array(self.f.root.slc_count_InIcePulses.cols.value[:]) 
         #self.events['thumb_q'] = self.f.root.ThumbRegion_2_0_0_7_0_4.cols.Sum_Q_Thumb[:]
 
@@ -127,42 +558,42 @@ class llh_ratio_test(object):
             #using azimuth as ra (since azimuth is randomly sampled in simulation while I don't know time sampling)
             #another option is to pick mjd randomly from a year and use that to go from azi to ra.
             #which is more work.
-            self.events['laputop_ra']=self.f.root.Laputop.cols.azimuth[:]
-            self.events['laputop_dec']=dec
-            self.events['run']=self.f.root.I3EventHeader.cols.Run[:]
-            self.events['event']=self.f.root.I3EventHeader.cols.Event[:]
-            self.events['time']= (self.f.root.I3EventHeader.cols.time_start_mjd_day[:] 
-                                + self.f.root.I3EventHeader.cols.time_start_mjd_sec[:]/86400.)
+            self.events.add('laputop_ra', lambda: column('Laputop','azimuth'))
+            self.events.add('laputop_dec', lambda dec=dec: dec)
+            self.events.add('run', lambda: column('I3EventHeader','Run'))
+            self.events.add('event', lambda: column('I3EventHeader','Event'))
+            self.events.add('time', lambda: (column('I3EventHeader','time_start_mjd_day')
+                                             + column('I3EventHeader','time_start_mjd_sec')/86400.))
 
             if isMC:
-                self.events['true_zen']=self.f.root.MCPrimary.cols.zenith[:]
-                self.events['true_azimuth']=self.f.root.MCPrimary.cols.azimuth[:]
-                self.events['true_E']=self.f.root.MCPrimary.cols.energy[:]
+                self.events.add('true_zen', lambda: column('MCPrimary','zenith'))
+                self.events.add('true_azimuth', lambda: column('MCPrimary','azimuth'))
+                self.events.add('true_E', lambda: column('MCPrimary','energy'))
                 ra,dec= astro.tables_to_equa(self.f.root.MCPrimary,self.f.root.I3EventHeader)
                 #using azimuth as ra (since azimuth is randomly sampled in simulation while I don't know time sampling)
                 #another option is to pick mjd randomly from a year and use that to go from azi to ra.
                 #which is more work.
-                self.events['true_ra']=self.f.root.MCPrimary.cols.azimuth[:]
-                self.events['true_dec']=dec
+                self.events.add('true_ra', lambda: column('MCPrimary','azimuth'))
+                self.events.add('true_dec', lambda dec=dec: dec)
 
 
         if not skip_non_llh:
-            self.events['start_slc']=self.f.root.__I3Index__.IceTopLaputopSeededSelectedSLC.cols.start[:]
-            self.events['stop_slc']=self.f.root.__I3Index__.IceTopLaputopSeededSelectedSLC.cols.stop[:]
-            self.events['start_hlc']=self.f.root.__I3Index__.IceTopLaputopSeededSelectedHLC.cols.start[:]
-            self.events['stop_hlc']=self.f.root.__I3Index__.IceTopLaputopSeededSelectedHLC.cols.stop[:]
-            self.events['laputop_azi'] = self.f.root.Laputop.cols.azimuth[:]
-            self.events['laputop_zen'] = self.f.root.Laputop.cols.zenith[:]
-            self.events['laputop_x'] = self.f.root.Laputop.cols.x[:]
-            self.events['laputop_y'] = self.f.root.Laputop.cols.y[:]
-            self.events['laputop_z'] = self.f.root.Laputop.cols.z[:]
+            self.events.add('start_slc', lambda: column('__I3Index__/IceTopLaputopSeededSelectedSLC','start'))
+            self.events.add('stop_slc', lambda: column('__I3Index__/IceTopLaputopSeededSelectedSLC','stop'))
+            self.events.add('start_hlc', lambda: column('__I3Index__/IceTopLaputopSeededSelectedHLC','start'))
+            self.events.add('stop_hlc', lambda: column('__I3Index__/IceTopLaputopSeededSelectedHLC','stop'))
+            self.events.add('laputop_azi', lambda: column('Laputop','azimuth'))
+            self.events.add('laputop_zen', lambda: column('Laputop','zenith'))
+            self.events.add('laputop_x', lambda: column('Laputop','x'))
+            self.events.add('laputop_y', lambda: column('Laputop','y'))
+            self.events.add('laputop_z', lambda: column('Laputop','z'))
 
         if llh_calculated==True:
-            self.events['Laputop_E']=self.f.root.Laputop_E.cols.value[:]
+            self.events.add('Laputop_E', lambda: column('Laputop_E','value'))
             for key in ['q_r','q_t','t_r']:
-                self.events['LLH_Hadron_%s'%key]=eval('self.f.root.GammaRayAnalysis_LLH.cols.LLH_Hadron_%s[:]'%key)
-                self.events['LLH_Gamma_%s'%key]=eval('self.f.root.GammaRayAnalysis_LLH.cols.LLH_Gamma_%s[:]'%key)
-            self.events['LLH_Ratio']=eval('self.f.root.GammaRayAnalysis_LLH.cols.LLH_Ratio[:]')
+                self.events.add('LLH_Hadron_%s'%key, lambda key=key: column('GammaRayAnalysis_LLH','LLH_Hadron_%s'%key))
+                self.events.add('LLH_Gamma_%s'%key, lambda key=key: column('GammaRayAnalysis_LLH','LLH_Gamma_%s'%key))
+            self.events.add('LLH_Ratio', lambda: column('GammaRayAnalysis_LLH','LLH_Ratio'))
 
             #self.events['hlc_count_InIcePulses']=self.f.root.hlc_count_InIcePulses.cols.value[:]
             #self.events['slc_count_InIcePulses']=self.f.root.slc_count_InIcePulses.cols.value[:]
@@ -175,53 +606,76 @@ class llh_ratio_test(object):
    
         return
 
+    def file_column(self,table,col):
+        """ Column col of table (path below root) of the open file, read once for all cuts and events."""
+        if (table,col) not in self.file_columns:
+            self.file_columns[(table,col)] = self.f.get_node('/'+table).col(col)
+        return self.file_columns[(table,col)]
+
     def make_quality_cuts(self):
         """ Make Quality Cuts """
         
+        column = self.file_column
         #Check Trigger
-        cut1 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.IceTop_StandardFilter[:] == 1.0
+        cut1 = column('IT73AnalysisIceTopQualityCuts','IceTop_StandardFilter') == 1.0
         #Did Laputop Converge?
-        cut5 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.IceTop_reco_succeeded[:] == 1.0
+        cut5 = column('IT73AnalysisIceTopQualityCuts','IceTop_reco_succeeded') == 1.0
         #Check Spectrum Paper Cuts - Bakhtiyars paper
-        cut2 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.IceTopMaxSignalInside[:] == 1.0
-        cut4 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.Laputop_FractionContainment[:] == 1.0 # i.e. fraction<0.96
-        cut7 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.IceTopMaxSignalAbove6[:] == 1.0
-        cut6 = self.f.root.NStation.cols.value[:] >= 5.0 
+        cut2 = column('IT73AnalysisIceTopQualityCuts','IceTopMaxSignalInside') == 1.0
+        cut4 = column('IT73AnalysisIceTopQualityCuts','Laputop_FractionContainment') == 1.0 # i.e. fraction<0.96
+        cut7 = column('IT73AnalysisIceTopQualityCuts','IceTopMaxSignalAbove6') == 1.0
+        cut6 = column('NStation','value') >= 5.0 
         
         #Beta cut also used now
-        cut3 = self.f.root.IT73AnalysisIceTopQualityCuts.cols.BetaCutPassed[:] == 1.0
+        cut3 = column('IT73AnalysisIceTopQualityCuts','BetaCutPassed') == 1.0
 
         bool = (cut1)&(cut2)&(cut3)&(cut4)&(cut5)&(cut6)&(cut7)
 
-        for key in self.events:
-            self.events[key]=self.events[key][bool]
+        self.apply_cut(bool,rows=True)
 
         return
 
     def make_quality_cuts_zach(self):
         """ Make Quality Cuts same as Zach"""
 
-        ic_containment = self.f.root.Laputop_inice_FractionContainment.cols.value[:]
+        ic_containment = self.file_column('Laputop_inice_FractionContainment','value')
         cut1 = ic_containment<=1.0
 
-        laputop_E = self.events['Laputop_E']
+        laputop_E = self.file_column('Laputop_E','value')
         cut2 = np.log10(laputop_E)>5.65
 
         bool = (cut1)&(cut2)
 
-        for key in self.events:
-            self.events[key]=self.events[key][bool]
+        self.apply_cut(bool,rows=True)
 
         return
 
     def make_cut(self,key,low, high):
         """ Make Log S125 Cut """
 
-        cut1 = self.events[key] >= low
-        cut2 = self.events[key] < high
+        rows = isinstance(self.events,deferred_events) and self.events.from_file(key)
+        if rows:
+            values = self.events.column(key)
+        else:
+            values = self.events[key]
+
+        cut1 = values >= low
+        cut2 = values < high
 
         bool = (cut1)&(cut2)
 
+        self.apply_cut(bool,rows=rows)
+
+        return
+
+    def apply_cut(self,bool,rows=False):
+        """ Keeps the events where bool is true, over the surviving events or,
+            if rows=True, over all rows of the file. Deferred for events of load_hdf_file."""
+
+        if isinstance(self.events,deferred_events):
+            self.events.cut(bool,rows=rows)
+            return
+
         for key in self.events:
             self.events[key]=self.events[key][bool]
 
@@ -256,120 +710,27 @@ class llh_ratio_test(object):
 
         return
 
-    def load_pulses(self,include_slc_time=False, exclude_hlc_time=False,slc_time_corrected=False):
+    def load_pulses(self,include_slc_time=False, exclude_hlc_time=False,slc_time_corrected=False,chunksize=10000):
         """ Run this module after cuts.
-            It loads slc, hlc and no hit q and rperp containers"""
+            It loads slc, hlc and no hit q and rperp containers.
+            Flat arrays with offsets are kept in self.pulses, self.events gets per event views of them."""
 
         if not self.check_survivors():
             print 'no surviving events after cuts'
             print 'not loading pulse containers'
             return
 
-        self.events['slc_rperp']=[]
-        self.events['slc_q']=[]
-        self.events['slc_t']=[]
-        self.events['slc_T']=[]
-        self.events['slc_om']=[]
-        self.events['slc_string']=[]
-        self.events['hlc_rperp']=[]
-        self.events['hlc_q']=[]
-        self.events['hlc_t']=[]
-        self.events['hlc_T']=[]
-        self.events['hlc_om']=[]
-        self.events['hlc_string']=[]
-        self.events['nohit_rperp']=[]
-        self.events['nohit_q']=[]
-        self.events['nohit_t']=[]
-        self.events['nohit_om']=[]
-        self.events['nohit_string']=[]
-
-        for i,j,k,l,eventid in zip(self.events['start_slc'],self.events['stop_slc'],
-                           self.events['start_hlc'],self.events['stop_hlc'], range(len(self.events['start_slc']))):
-
-            xslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.x[i:j]
-            yslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.y[i:j]
-            Xslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.X[i:j]
-            Yslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.Y[i:j]
-            rperpslc= np.log10(np.sqrt(xslc**2 + yslc**2))
-            qslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.charge[i:j]
-            qslc= np.log10(qslc)
-
-            if slc_time_corrected:
-                tslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.time_corrected[i:j]
-                det_tslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.T_corrected[i:j]
-            else:
-                tslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.time[i:j]
-                det_tslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.T[i:j]
-                
-
-            select = tslc<0
-            if len(select[select])>0:
-                print 'slc neg time',len(select[select]),'out of ',len(select)
-                #print qslc[select],tslc[select],rperpslc[select]
-                #print 'changing those to 10^-2'
-                tslc[select]=0.01
-
-            if include_slc_time:
-                tslc= np.log10(tslc)
-            else:
-                tslc= np.ones_like(tslc)*-2
-
-            self.events['slc_q'].append(qslc)
-            self.events['slc_t'].append(tslc)
-            self.events['slc_T'].append(det_tslc)
-            self.events['slc_rperp'].append(rperpslc)
-
-            xhlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.x[k:l]
-            yhlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.y[k:l]
-            rperphlc= np.log10(np.sqrt(xhlc**2 + yhlc**2))
-            qhlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.charge[k:l]
-            qhlc= np.log10(qhlc)
-            thlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.time[k:l]
-
-            select = thlc<0
-            if len(select[select])>0:
-                print 'hlc neg time',len(select[select]),'out of ',len(select)
-                #print 'changing those to 10^-2'
-                thlc[select]=0.01
-
-            if exclude_hlc_time:
-                thlc= np.ones_like(thlc)*-2
-            else:
-                thlc= np.log10(thlc)
-
-            det_thlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.T[k:l]
-
-            self.events['hlc_q'].append(qhlc)
-            self.events['hlc_t'].append(thlc)
-            self.events['hlc_T'].append(det_thlc)
-            self.events['hlc_rperp'].append(rperphlc)
-
-            stringslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.string[i:j]
-            omslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.om[i:j]
-            pmtslc=self.f.root.IceTopLaputopSeededSelectedSLC.cols.pmt[i:j]
-            stringhlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.string[k:l]
-            omhlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.om[k:l]
-            pmthlc=self.f.root.IceTopLaputopSeededSelectedHLC.cols.pmt[k:l]
+        chunks = [pulses for events, pulses in self.iter_pulses(chunksize=chunksize, include_slc_time=include_slc_time,
+                                                                exclude_hlc_time=exclude_hlc_time,
+                                                                slc_time_corrected=slc_time_corrected)]
+        self.pulses = merge_pulse_chunks(chunks)
 
-            self.events['hlc_om'].append(omhlc)
-            self.events['hlc_string'].append(stringhlc)
-            self.events['slc_om'].append(omslc)
-            self.events['slc_string'].append(stringslc)
-
-            event_doms = zip(stringslc,omslc,pmtslc)+zip(stringhlc,omhlc,pmthlc)
-
-            phi = self.events['laputop_azi'][eventid]
-            theta = self.events['laputop_zen'][eventid]
-            core_x= self.events['laputop_x'][eventid] 
-            core_y= self.events['laputop_y'][eventid] 
-
-            tnohit, qnohit,rperpnohit,omnohit,stringnohit = self.no_hit_doms(event_doms,phi,theta,core_x,core_y)
-
-            self.events['nohit_rperp'].append(rperpnohit)
-            self.events['nohit_q'].append(qnohit)
-            self.events['nohit_t'].append(tnohit)
-            self.events['nohit_om'].append(omnohit)
-            self.events['nohit_string'].append(stringnohit)
+        for tag in ['slc','hlc','nohit']:
+            offsets = self.pulses[tag]['offsets']
+            for var in self.pulses[tag].keys():
+                if var == 'offsets':
+                    continue
+                self.events[tag+'_'+var] = np.split(self.pulses[tag][var],offsets[1:-1])
 
         i = int(random.random()*len(self.events['slc_rperp'])) 
         total_tanks = sum([len(self.events['slc_rperp'][i]), len(self.events['hlc_rperp'][i]), len(self.events['nohit_rperp'][i])])
@@ -379,6 +740,67 @@ class llh_ratio_test(object):
 
         return
 
+    def iter_pulses(self,chunksize=10000,include_slc_time=False, exclude_hlc_time=False,slc_time_corrected=False):
+        """ Streams the slc, hlc and no hit containers of the surviving events in chunks of events,
+            for files too large to hold all pulses in memory. Each pulse table is read once per chunk.
+            Yields (events, pulses): the slice of events of the chunk and, for 'slc', 'hlc' and 'nohit',
+            dicts of flat arrays with 'offsets' (event i of the chunk owns offsets[i]:offsets[i+1])."""
+
+        nevents = len(self.events['start_slc'])
+        for first in range(0,nevents,chunksize):
+            events = slice(first,min(first+chunksize,nevents))
+            pulses = {}
+
+            if slc_time_corrected:
+                slc_columns = {'time':'time_corrected','T':'T_corrected'}
+            else:
+                slc_columns = {'time':'time','T':'T'}
+            rows = read_ragged(self.f.root.IceTopLaputopSeededSelectedSLC,
+                               self.events['start_slc'][events],self.events['stop_slc'][events])
+            pulses['slc'] = self.pulse_containers(rows,'slc',slc_columns,log_time=include_slc_time)
+
+            rows = read_ragged(self.f.root.IceTopLaputopSeededSelectedHLC,
+                               self.events['start_hlc'][events],self.events['stop_hlc'][events])
+            pulses['hlc'] = self.pulse_containers(rows,'hlc',{'time':'time','T':'T'},log_time=not exclude_hlc_time)
+
+            # Hit DOMs of each event, slc then hlc
+            keys = np.concatenate((pulses['slc'].pop('keys'),pulses['hlc'].pop('keys')))
+            eventno = np.concatenate((np.repeat(np.arange(events.stop-first),np.diff(pulses['slc']['offsets'])),
+                                      np.repeat(np.arange(events.stop-first),np.diff(pulses['hlc']['offsets']))))
+            order = np.argsort(eventno,kind='mergesort')
+            offsets = np.zeros(events.stop-first+1,dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(eventno,minlength=events.stop-first))
+
+            pulses['nohit'] = self.no_hit_tanks(keys[order],offsets,
+                                                self.events['laputop_azi'][events],self.events['laputop_zen'][events],
+                                                self.events['laputop_x'][events],self.events['laputop_y'][events])
+
+            yield events, pulses
+
+    def pulse_containers(self,rows,tag,columns,log_time=True):
+        """ log rperp, log q, (log) t, T, om, string and packed OMKeys of ragged pulse rows."""
+
+        offsets = rows['offsets']
+        pulses = {'offsets':offsets}
+        pulses['rperp'] = np.log10(np.sqrt(rows['x']**2 + rows['y']**2))
+        pulses['q'] = np.log10(rows['charge'])
+
+        time = np.array(rows[columns['time']])
+        select = time<0
+        if np.any(select):
+            print tag+' neg time',len(select[select]),'out of ',len(select)
+            time[select]=0.01
+        if log_time:
+            pulses['t'] = np.log10(time)
+        else:
+            pulses['t'] = np.ones_like(time)*-2
+
+        pulses['T'] = rows[columns['T']]
+        pulses['om'] = rows['om']
+        pulses['string'] = rows['string']
+        pulses['keys'] = pack_omkeys(rows['string'],rows['om'],rows['pmt'])
+        return pulses
+
     def histogram2d(self,key,bins, range):
         """ Histogram HLC, SLC, No hit Tanks"""
 
@@ -402,6 +824,7 @@ class llh_ratio_test(object):
 
         key='3d'
         self.hist[key] = {}
+        edges = hist_edges(global3dbins, global3drange)
 
         for var in ['nohit','hlc','slc']:
 
@@ -409,15 +832,11 @@ class llh_ratio_test(object):
             q=np.concatenate(self.events[var+'_q'])
             t= np.concatenate(self.events[var+'_t'])
 
-            if len(r)==0:
-                self.hist[key][var] = np.zeros(global3dbins)
-                continue
-
-            data=np.array(zip(r,q,t))
-            bins = global3dbins 
-            range = global3drange 
+            linbin = linear_bin_index([r,q,t], edges)
+            hist = np.bincount(linbin[linbin>=0], minlength=np.prod(global3dbins))
+            self.hist[key][var] = hist.astype(float).reshape(global3dbins)
 
-            self.hist[key][var], self.hist[key]['edges'] = np.histogramdd(data, bins = bins, range=range)
+        self.hist[key]['edges'] = edges
 
         return
 
@@ -442,23 +861,102 @@ class llh_ratio_test(object):
 
         return
 
-    def load_heatmaps_new(self,inputpicklefile):
+    def load_shared_heatmaps(self,filename,store=False,smearedthumbplot=False,normradialbins=False):
+        """ Loads and normalizes the heatmaps of a pickle, or of a heatmap store basename
+            if store=True, once per process. Instances asking for the same file and
+            normalization options share one read-only copy."""
+
+        def loader():
+            llh = llh_ratio_test()
+            if store:
+                llh.load_heatmap_store(filename,smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+            else:
+                llh.load_heatmaps(filename)
+                llh.normalize_heatmaps_new(smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+            return dict((key,value) for key,value in llh.__dict__.items()
+                        if key in ['heatmap','dense','dense_available','s125_keys','zen_keys','xedges','yedges'])
+
+        if store:
+            path = store_files(filename)[0]
+        else:
+            path = filename
+        shared = shared_resource('heatmaps',path,(smearedthumbplot,normradialbins),loader)
+        for key,value in shared.items():
+            setattr(self,key,value)
+        return
+
+    def load_heatmap_store(self,base,smearedthumbplot=False,normradialbins=False):
+        """ Loads heatmaps from a heatmap store (see heatmap_store.py).
+            A normalized store is used as is, memory mapped and shared between processes,
+            and raises ValueError if it was normalized with other options;
+            a store of raw heatmaps is normalized with the given options."""
+
+        store = load_heatmap_store(base)
+        if store['normalized'] and (store['smearedthumbplot'],store['normradialbins'])!=(smearedthumbplot,normradialbins):
+            raise ValueError('%s was normalized with smearedthumbplot=%s, normradialbins=%s'
+                             %(base,store['smearedthumbplot'],store['normradialbins']))
+
+        self.heatmap={}
+        if not store['normalized']:
+            for prim in primaries:
+                self.heatmap[prim]={}
+                for var in templates:
+                    heatmaps = template_view(store,'heatmaps',prim,var)
+                    self.heatmap[prim][var]=self.heatmap_dict(heatmaps,store['s125_keys'],store['zen_keys'],store['available'])
+            self.normalize_heatmaps_new(smearedthumbplot=smearedthumbplot,normradialbins=normradialbins)
+            return
+
+        self.s125_keys = store['s125_keys']
+        self.zen_keys = store['zen_keys']
+        self.dense_available = store['available']
+        self.dense={}
+        for prim in primaries:
+            self.dense[prim+'_norm']={}
+            self.dense[prim+'_log']={}
+            for var in templates:
+                self.dense[prim+'_norm'][var]=template_view(store,'heatmaps',prim,var)
+                self.dense[prim+'_log'][var]=template_view(store,'log_heatmaps',prim,var)
+        self.dense['nonzero_both']={}
+        for var in templates:
+            self.dense['nonzero_both'][var]=(self.dense['proton_norm'][var]!=0)&(self.dense['gamma_norm'][var]!=0)
+
+        for name in self.dense.keys():
+            self.heatmap[name]={}
+            for var in templates:
+                self.heatmap[name][var]=self.heatmap_dict(self.dense[name][var],self.s125_keys,self.zen_keys,self.dense_available)
+        return
+
+    def heatmap_dict(self,dense,s125_keys,zen_keys,available):
+        """ s125 key, zen key dict of views into a dense (s125 bin, zen bin, x, y) array."""
+        heatmap={}
+        for i,s125 in enumerate(s125_keys):
+            heatmap[s125]={}
+            for j,zen in enumerate(zen_keys):
+                if available[i,j]:
+                    heatmap[s125][zen]=dense[i,j]
+        return heatmap
+
+    def load_heatmaps_new(self,inputpicklefile,sparse=True,dtype=np.float64):
         """ FOR loading pickles with 3d heatmaps too
             Given a pickle file with appropriate structure,
-            Loads Gamma, Proton heat map dicts with s125, zen keys"""
+            Loads Gamma, Proton heat map dicts with s125, zen keys
+            sparse: keep the 3d heatmaps as sparse_heatmap, converted as they are read,
+            with values of the given dtype."""
 
         self.heatmap={}
         nevents={}
 
         picklefile= open(inputpicklefile,'r')
 
-        self.heatmap['proton'] = pickle.load(picklefile)
-        nevents['proton'] = pickle.load(picklefile)
-        self.heatmap['proton']['3d'] = pickle.load(picklefile)
-
-        self.heatmap['gamma'] = pickle.load(picklefile)
-        nevents['gamma'] = pickle.load(picklefile)
-        self.heatmap['gamma']['3d'] = pickle.load(picklefile)
+        for prim in ['proton','gamma']:
+            self.heatmap[prim] = pickle.load(picklefile)
+            nevents[prim] = pickle.load(picklefile)
+            self.heatmap[prim]['3d'] = pickle.load(picklefile)
+            if sparse:
+                for s125 in self.heatmap[prim]['3d'].keys():
+                    for zen in self.heatmap[prim]['3d'][s125].keys():
+                        self.heatmap[prim]['3d'][s125][zen] = sparse_heatmap.from_dense(
+                                                               self.heatmap[prim]['3d'][s125][zen],dtype=dtype)
 
         xedges = pickle.load(picklefile)
         yedges = pickle.load(picklefile)
@@ -470,13 +968,18 @@ class llh_ratio_test(object):
 
     def normalize_heatmaps_new(self,smearedthumbplot=False,normradialbins=False):
 
-        for prim in self.heatmap.keys():
+        for prim in ['proton','gamma']:
             self.heatmap[prim+'_norm']={}
             for var in self.heatmap[prim].keys():
                 self.heatmap[prim+'_norm'][var]={}
                 for s125 in self.heatmap[prim][var].keys():
                     self.heatmap[prim+'_norm'][var][s125]={}
                     for zen in self.heatmap[prim][var][s125].keys():
+                        if isinstance(self.heatmap[prim][var][s125][zen],sparse_heatmap):
+                            self.heatmap[prim+'_norm'][var][s125][zen]=self.heatmap[prim][var][s125][zen].normalize(
+                                                                        smearedthumbplot,normradialbins)
+                            continue
+
                         temp=self.heatmap[prim][var][s125][zen].copy()
 
                         if smearedthumbplot==True:
@@ -490,6 +993,76 @@ class llh_ratio_test(object):
                             temp=temp/np.sum(temp)
 
                         self.heatmap[prim+'_norm'][var][s125][zen]=temp
+
+        self.make_log_heatmaps()
+        self.make_dense_heatmaps()
+        return
+
+    def make_log_heatmaps(self):
+        """ Precomputes log10 of the normalized heatmaps (-inf on empty bins) and
+            the mask of bins that are nonzero in both the proton and gamma heatmap,
+            so that scoring an event is a gather over its occupied bins."""
+
+        for prim in ['proton','gamma']:
+            self.heatmap[prim+'_log']={}
+            for var in self.heatmap[prim+'_norm'].keys():
+                self.heatmap[prim+'_log'][var]={}
+                for s125 in self.heatmap[prim+'_norm'][var].keys():
+                    self.heatmap[prim+'_log'][var][s125]={}
+                    for zen in self.heatmap[prim+'_norm'][var][s125].keys():
+                        if isinstance(self.heatmap[prim+'_norm'][var][s125][zen],sparse_heatmap):
+                            self.heatmap[prim+'_log'][var][s125][zen]=self.heatmap[prim+'_norm'][var][s125][zen].log10()
+                            continue
+                        with np.errstate(divide='ignore'):
+                            temp=np.log10(self.heatmap[prim+'_norm'][var][s125][zen])
+                        self.heatmap[prim+'_log'][var][s125][zen]=temp
+
+        self.heatmap['nonzero_both']={}
+        for var in self.heatmap['proton_norm'].keys():
+            self.heatmap['nonzero_both'][var]={}
+            for s125 in self.heatmap['proton_norm'][var].keys():
+                self.heatmap['nonzero_both'][var][s125]={}
+                for zen in self.heatmap['proton_norm'][var][s125].keys():
+                    if isinstance(self.heatmap['proton_norm'][var][s125][zen],sparse_heatmap):
+                        # found from the gathered bins when scoring
+                        continue
+                    self.heatmap['nonzero_both'][var][s125][zen]=((self.heatmap['proton_norm'][var][s125][zen]!=0)
+                                                                  &(self.heatmap['gamma_norm'][var][s125][zen]!=0))
+        return
+
+    def make_dense_heatmaps(self,templates=['q_r','q_t','t_r']):
+        """ Stacks the normalized, log and nonzero_both 2D heatmaps into dense arrays
+            self.dense[name][template] of shape (s125 bin, zen bin, x, y), addressed by
+            integer bin indices into self.s125_keys (ascending) and self.zen_keys (descending).
+            The dict heatmaps become views into these arrays.
+            self.dense_available marks the (s125, zen) bins present in the heatmaps."""
+
+        s125_keys=set()
+        zen_keys=set()
+        for var in templates:
+            for s125 in self.heatmap['proton_norm'][var].keys():
+                s125_keys.add(s125)
+                zen_keys.update(self.heatmap['proton_norm'][var][s125].keys())
+        self.s125_keys = sorted(s125_keys,key=float)
+        self.zen_keys = sorted(zen_keys,key=float,reverse=True)
+
+        self.dense={}
+        self.dense_available=np.ones((len(self.s125_keys),len(self.zen_keys)),dtype=bool)
+        for name in ['proton_norm','gamma_norm','proton_log','gamma_log','nonzero_both']:
+            self.dense[name]={}
+            for var in templates:
+                temp=None
+                for i,s125 in enumerate(self.s125_keys):
+                    for j,zen in enumerate(self.zen_keys):
+                        if zen not in self.heatmap[name][var].get(s125,{}):
+                            self.dense_available[i,j]=False
+                            continue
+                        heatmap=self.heatmap[name][var][s125][zen]
+                        if temp is None:
+                            temp=np.zeros((len(self.s125_keys),len(self.zen_keys))+heatmap.shape,dtype=heatmap.dtype)
+                        temp[i,j]=heatmap
+                        self.heatmap[name][var][s125][zen]=temp[i,j]
+                self.dense[name][var]=temp
         return
     
 
@@ -511,6 +1084,7 @@ class llh_ratio_test(object):
 
     def plot_heatmaps(self,s125,zen,template_key,pdffileinstance,xedges,yedges):
         pdf = pdffileinstance
+        plt, LogNorm = plotting()
         for key in ['gamma','proton']:
             temp = np.flipud(np.rot90(self.heatmap[key+'_norm'][template_key][s125][zen]))
             temp = np.ma.masked_where(temp==0,temp)
@@ -548,6 +1122,7 @@ class llh_ratio_test(object):
 
     def make_pdf(self,s125,zen,template_key,pdffileinstance,tempp,tempg,xedges,yedges,i,Tbins,Zbins_g,Zbins_p):
         pdf = pdffileinstance
+        plt, LogNorm = plotting()
         for key in ['gamma','proton']:
             temp = np.flipud(np.rot90(self.heatmap[key+'_norm'][template_key][s125][zen]))
             temp = np.ma.masked_where(temp==0,temp)
@@ -596,17 +1171,15 @@ class llh_ratio_test(object):
         return
 
     def tanks_on_zero_bins(self,protonmap,gammamap,hevent,xedges,yedges,template_key,eventno):
-        """ Find which tanks are landing on zero bin in this event"""
+        """ Find which tanks are landing on zero bin in this event
+            A tank lands in bin (j,k) if xedges[j] <= x < xedges[j+1] and yedges[k] <= y < yedges[k+1],
+            the bin is a zero bin if the proton or the gamma heatmap is zero there.
+            Output: lists of (string, om) of the tanks on zero and on nonzero bins."""
 
-        bins_assigned={}
         tanks_zerobins=[]
         tanks_nonzerobins=[]
 
         for key in ['nohit','hlc','slc']:
-            om_non_zero_bins = []
-            string_non_zero_bins = []
-            om_zero_bins = []
-            string_zero_bins = []
 
             if template_key[2]=='r':
                 x=self.events[key+'_%sperp'%template_key[2]][eventno]
@@ -614,163 +1187,324 @@ class llh_ratio_test(object):
                 x=self.events[key+'_%s'%template_key[2]][eventno]
             
             y=self.events[key+'_%s'%template_key[0]][eventno]
-            om=self.events[key+'_om'][eventno]
-            string=self.events[key+'_string'][eventno]
-
-            bins_assigned[key]=[]
-            for i in range(len(x)):
-                for j in range(len(xedges)-1):
-                    for k in range(len(yedges)-1):
-                        if xedges[j] <= x[i] < xedges[j+1]:
-                            if yedges[k] <= y[i] < yedges[k+1]:
-                                bins_assigned[key].append((j,k))
-                                if protonmap[j,k]!=0 and gammamap[j,k]!=0:
-                                    om_non_zero_bins.append(om[i])
-                                    string_non_zero_bins.append(string[i])
-                                else:
-                                    om_zero_bins.append(om[i])
-                                    string_zero_bins.append(string[i])
-            #om_zero_bins=np.array(om_zero_bins)
-            #string_zero_bins=np.array(string_zero_bins)
-            #om_non_zero_bins=np.array(om_non_zero_bins)
-            #string_non_zero_bins=np.array(string_non_zero_bins)
-
-            tanks_nonzerobins.extend(zip(string_non_zero_bins, om_non_zero_bins))
-            tanks_zerobins.extend(zip(string_zero_bins, om_zero_bins)) 
-
-            # rest of these 10 lines are for checking purposes
-            #print 'key, len of tanks on non zerobins',key,len(tanks_nonzerobins[key])
-            #print 'len of tanks on zerobins',key,len(tanks_zerobins[key])
-            #print 'len of bins assigned',len(bins_assigned[key])
-            #seen = set()
-            #unique=[item for item in bins_assigned[key] if item not in seen and not seen.add(item)]
-            #bins_assigned[key] = unique
-            #print 'len of unique bins assigned' , len(unique)
-            #print '---------------------'
-        #print 'no of bins in hevent', len(hevent[hevent!=0])
+            om=np.asarray(self.events[key+'_om'][eventno])
+            string=np.asarray(self.events[key+'_string'][eventno])
 
-        return tanks_zerobins, tanks_nonzerobins 
+            xbin = digitize(x, xedges, last_inclusive=False)
+            ybin = digitize(y, yedges, last_inclusive=False)
+            assigned = (xbin>=0)&(ybin>=0)
+            nonzero = (protonmap[xbin,ybin]!=0)&(gammamap[xbin,ybin]!=0)
 
+            tanks_nonzerobins.extend(zip(string[assigned&nonzero], om[assigned&nonzero]))
+            tanks_zerobins.extend(zip(string[assigned&~nonzero], om[assigned&~nonzero])) 
 
+        return tanks_zerobins, tanks_nonzerobins 
 
     def calc_llh_values_new(self,histbins,histrange,s125,zen,ignorezerobinsinboth,generatepdf,pdffileinstance,trace_tanks=True):
-        """ Calculate LLH values for events """
+        """ Calculate LLH values for events
+            generatepdf: afterwards plot some of the events into pdffileinstance (plot_events)."""
+
+        if trace_tanks:
+            r, q, t, string, om, offsets = self.flatten_containers(['rperp','q','t','string','om'])
+            tanks = (string, om)
+        else:
+            r, q, t, offsets = self.flatten_events()
+            tanks = None
+        results = self.calc_llh_values_batch(r, q, t, offsets, s125, zen, histbins, histrange,
+                                             ignorezerobinsinboth=ignorezerobinsinboth, tanks=tanks)
+        self.events.update(results)
+
+        if generatepdf==True:
+            self.plot_events(histbins,histrange,s125,zen,pdffileinstance)
 
-        self.events['proton_like']={}
-        self.events['gamma_like']={}
-        self.events['unused_proton']={}
-        self.events['unused_gamma']={}
-        self.events['N_unused_tanks']={}
-        tanks_zerobins = {}
-        tanks_nonzerobins = {}
+        return
 
-        for template_key in ['q_r','q_t','t_r']:
-            self.events['proton_like'][template_key]=[]
-            self.events['gamma_like'][template_key]=[]
-            self.events['unused_proton'][template_key]=[]
-            self.events['unused_gamma'][template_key]=[]
-            self.events['N_unused_tanks'][template_key]=[]
-            tanks_zerobins[template_key]={}
-            tanks_nonzerobins[template_key]={}
-        self.events['N_unused_tanks']['Common']=[]
-
-        for i in range(len(self.events['laputop_x'])):
-            for template_key in ['q_r','q_t','t_r']:
-                hevent, xedges, yedges = self.return_hevent(i, histbins, histrange, template_key)
+    def plot_events(self,histbins,histrange,s125,zen,pdffileinstance,events=None,fraction=0.05):
+        """ Diagnostic post-pass over saved per event results: plots the heatmaps with the
+            tanks of events on top (make_pdf), titled with the events' LLH values.
+            The LLH values are proton_like/gamma_like of calc_llh_values_new or, for files
+            loaded with llh_calculated=True, LLH_Hadron_*/LLH_Gamma_*. Needs the pulse containers.
+            events: event numbers to plot, by default a random fraction of the events."""
 
-                tempp=hevent* self.heatmap['proton_norm'][template_key][s125][zen]
-                tempg=hevent* self.heatmap['gamma_norm'][template_key][s125][zen]
+        if events is None:
+            events = [i for i in range(len(self.events['laputop_x'])) if random.random() < fraction]
 
-                tanksloc = hevent!=0
+        for i in events:
+            for template_key in ['q_r','q_t','t_r']:
+                if 'proton_like' in self.events:
+                    tempp = self.events['proton_like'][template_key][i]
+                    tempg = self.events['gamma_like'][template_key][i]
+                else:
+                    tempp = self.events['LLH_Hadron_%s'%template_key][i]
+                    tempg = self.events['LLH_Gamma_%s'%template_key][i]
 
+                hevent, xedges, yedges = self.return_hevent(i, histbins, histrange, template_key)
+                tanksloc = hevent!=0
                 totalbins = float(len(tanksloc[tanksloc]))
-
-                bins_proton = self.heatmap['proton_norm'][template_key][s125][zen].copy()[tanksloc]
+                bins_proton = self.heatmap['proton_norm'][template_key][s125][zen][tanksloc]
                 zerobins_proton = len(bins_proton[bins_proton==0])
-
-                bins_gamma = self.heatmap['gamma_norm'][template_key][s125][zen].copy()[tanksloc]
+                bins_gamma = self.heatmap['gamma_norm'][template_key][s125][zen][tanksloc]
                 zerobins_gamma = len(bins_gamma[bins_gamma==0])
-                
-                #Find which tanks are landing on zero bins
-                if trace_tanks:
-                    tanks_zerobins[template_key], tanks_nonzerobins[template_key] = self.tanks_on_zero_bins(
-                                        self.heatmap['proton_norm'][template_key][s125][zen].copy(), 
-                                        self.heatmap['gamma_norm'][template_key][s125][zen].copy(),
-                                        hevent, xedges, yedges, template_key, eventno=i
-                                        )
-                self.events['unused_proton'][template_key].append(zerobins_proton/totalbins)
-                self.events['unused_gamma'][template_key].append(zerobins_gamma/totalbins)
-
-                if ignorezerobinsinboth==True:
-                    bool = (tempp!=0)&(tempg!=0)
-                else:
-                    bool = tempp!=0
-
-                tempp=np.sum(np.log10(tempp[bool]))
-                tempg=np.sum(np.log10(tempg[bool]))
-
-                self.events['proton_like'][template_key].append(tempp)
-                self.events['gamma_like'][template_key].append(tempg)
-
-                if generatepdf==True and random.random() > 0.95 :
-                   self.make_pdf(s125,zen,template_key,pdffileinstance,tempp,tempg,xedges,yedges,i, 
-                                totalbins,zerobins_proton,zerobins_gamma) 
-           
-            #Count N Tanks landing on zero bins in all 3 PDFs
-            a=tanks_zerobins['q_r']
-            self.events['N_unused_tanks']['q_r'].append(len(a))
-            b=tanks_zerobins['t_r']
-            self.events['N_unused_tanks']['t_r'].append(len(b))
-            c=tanks_zerobins['q_t']
-            self.events['N_unused_tanks']['q_t'].append(len(c))
-            d=list(set(a) & set(b) & set(c))
-            self.events['N_unused_tanks']['Common'].append(len(d))
 
+                self.make_pdf(s125,zen,template_key,pdffileinstance,tempp,tempg,xedges,yedges,i,
+                              totalbins,zerobins_proton,zerobins_gamma)
         return
 
-    def calc_llh_values_new_3d(self,s125,zen,ignorezerobinsinboth=True):
-        """ Calculate LLH values for events """
-
-        template_key='3d'
-
-        for template in ['proton','gamma']:
-            self.events[template+'_like'][template_key]=[]
-            self.events['unused_'+template][template_key]=[]
-
-            for i in range(len(self.events['laputop_x'])):
-                hist={}
-                for key in ['nohit','hlc','slc']:
-                    r=np.array(self.events[key+'_rperp'][i])
-                    q=np.array(self.events[key+'_q'][i])
-                    t=np.array(self.events[key+'_t'][i])
+    def flatten_events(self):
+        """ Concatenates the nohit, hlc and slc containers of all events.
+            Output: flat r, q, t arrays and offsets, event i owns entries offsets[i]:offsets[i+1]."""
+
+        return self.flatten_containers(['rperp','q','t'])
+
+    def flatten_tanks(self):
+        """ string and om of every entry of flatten_events, in the same order."""
+
+        string, om, offsets = self.flatten_containers(['string','om'])
+        return string, om
+
+    def flatten_containers(self,variables):
+        """ Concatenates the nohit, hlc and slc containers of the variables of all events,
+            one concatenation per container, ordered by event (nohit, hlc, slc of each event).
+            Output: flat array of each variable (int64 for string and om, else float)
+            and the event offsets."""
+
+        dtypes = [np.int64 if var in ['string','om'] else float for var in variables]
+        tags = [key for key in ['nohit','hlc','slc'] if key+'_rperp' in self.events]
+        nevents = len(self.events['laputop_x'])
+        if nevents==0 or len(tags)==0:
+            return [np.zeros(0,dtype=dtype) for dtype in dtypes] + [np.zeros(nevents+1,dtype=np.int64)]
+
+        pulses = {}
+        for tag in tags:
+            lengths = np.fromiter((len(container) for container in self.events[tag+'_rperp']),dtype=np.int64,count=nevents)
+            pulses[tag] = {'offsets':np.concatenate(([0],np.cumsum(lengths)))}
+            for var,dtype in zip(variables,dtypes):
+                pulses[tag][var] = np.concatenate(self.events[tag+'_'+var]).astype(dtype)
+
+        return combine_pulses(pulses,variables=variables,tags=tags)
+
+    def event_histograms(self,r,q,t,offsets,histbins,histrange,tank_bins=False):
+        """ Sparse histograms of many events, the part of calc_llh_values_batch that
+            does not depend on the s125/zen bin (and so on the heatmaps).
+            Input: as calc_llh_values_batch.
+            Output: dict with the offsets, eventno and values (r, q, t) of the entries
+            and (occ_event, occ_bin, counts) per template (see sparse_histograms).
+            tank_bins: also store, per template, the linear bin of each entry as
+            tanks_on_zero_bins assigns it (-1 outside the bins or on their upper edges),
+            to count the tanks on zero bins."""
+
+        nevents=len(offsets)-1
+        eventno=np.repeat(np.arange(nevents),np.diff(offsets))
+        values={'r':np.asarray(r,dtype=float),'q':np.asarray(q,dtype=float),'t':np.asarray(t,dtype=float)}
+
+        histograms={'offsets':np.asarray(offsets),'eventno':eventno,'values':values}
+        if tank_bins:
+            histograms['tank_bins']={}
+        for template_key in ['q_r','q_t','t_r']:
+            xedges, yedges = hist_edges(histbins[template_key], histrange[template_key])
+            nx, ny = histbins[template_key]
+            x, y = values[template_key[2]], values[template_key[0]]
+            linbin = linear_bin_index([x,y],[xedges,yedges])
+            histograms[template_key] = sparse_histograms(eventno,linbin,nx*ny)
+            if tank_bins:
+                # the last bins of np.histogram2d include their upper edge, tanks_on_zero_bins leaves it out
+                histograms['tank_bins'][template_key] = np.where((x==xedges[-1])|(y==yedges[-1]),-1,linbin)
+        return histograms
+
+    def calc_llh_values_batch(self,r,q,t,offsets,s125,zen,histbins,histrange,ignorezerobinsinboth=True,tanks=None,
+                              histograms=None):
+        """ Calculate LLH values for many events at once.
+            Input: flat log r, log q, log t of all SLC/HLC/no hit tanks of all events
+            and the event offsets (see flatten_events).
+            s125, zen: heatmap keys as in calc_llh_values_new, or integer indices into
+            self.s125_keys/self.zen_keys, one for all events or one per event.
+            Events with a negative index or without heatmap in their bin are scored nan.
+            tanks: (string, om) of every entry (see flatten_tanks) to count the tanks
+            on zero bins as tanks_on_zero_bins does, else N_unused_tanks is zero.
+            The count gathers nonzero_both at the linear bins the histograms were made of.
+            histograms: event_histograms of the same events, to score them in other
+            s125/zen bins without histogramming them again (r, q, t are then ignored);
+            made with tank_bins=True if tanks are given.
+            Output: dict with proton_like, gamma_like, unused_proton, unused_gamma
+            and N_unused_tanks per template, as arrays over events.
+            Results are identical to scoring the np.histogram2d histogram of each event."""
+
+        if histograms is None:
+            histograms = self.event_histograms(r,q,t,offsets,histbins,histrange,tank_bins=tanks is not None)
+        elif tanks is not None and 'tank_bins' not in histograms:
+            raise ValueError('tanks need event_histograms made with tank_bins=True')
+        offsets = histograms['offsets']
+        eventno = histograms['eventno']
+        nevents=len(offsets)-1
+
+        s125_bin, zen_bin = self.heatmap_bin_index(s125,zen,nevents)
+        scored = (s125_bin>=0)&(zen_bin>=0)
+        s125_bin = np.where(scored,s125_bin,0)
+        zen_bin = np.where(scored,zen_bin,0)
+        scored &= self.dense_available[s125_bin,zen_bin]
+
+        results={}
+        for name in ['proton_like','gamma_like','unused_proton','unused_gamma','N_unused_tanks']:
+            results[name]={}
+
+        if tanks is not None:
+            # per template, the entries on bins that are zero in either heatmap
+            on_zero_bins=[]
+            entry_heatmap = np.repeat(s125_bin*len(self.zen_keys)+zen_bin,np.diff(offsets))
 
-                    if len(r)==0:
-                        hist[key] = np.zeros(global3dbins)
-                        continue
-                    
-                    data=np.array(zip(r,q,t))
-                    hbins = global3dbins 
-                    hrange = global3drange 
+        for template_key in ['q_r','q_t','t_r']:
+            nx, ny = histbins[template_key]
+
+            results['N_unused_tanks'][template_key]=np.zeros(nevents,dtype=int)
+
+            # Occupied bins and their counts of each event, ordered by event and then by bin
+            occ_event, occ_bin, counts = histograms[template_key]
+
+            # Heatmap values of each occupied bin, in the heatmap of the event's s125/zen bin
+            where = (s125_bin[occ_event],zen_bin[occ_event],occ_bin//ny,occ_bin%ny)
+            protonmap = self.dense['proton_norm'][template_key][where]
+            gammamap = self.dense['gamma_norm'][template_key][where]
+
+            totalbins = np.bincount(occ_event,minlength=nevents).astype(float)
+            zerobins_proton = np.bincount(occ_event,weights=protonmap==0,minlength=nevents)
+            zerobins_gamma = np.bincount(occ_event,weights=gammamap==0,minlength=nevents)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                results['unused_proton'][template_key]=zerobins_proton/totalbins
+                results['unused_gamma'][template_key]=zerobins_gamma/totalbins
+
+            if tanks is not None:
+                tank_bins = histograms['tank_bins'][template_key]
+                nonzero = self.dense['nonzero_both'][template_key].reshape(-1)
+                on_zero = ~nonzero.take(entry_heatmap*(nx*ny)+tank_bins,mode='clip')
+                on_zero &= tank_bins>=0
+                results['N_unused_tanks'][template_key]=np.where(scored,segment_counts(on_zero,offsets),0)
+                on_zero_bins.append(on_zero)
+
+            if ignorezerobinsinboth==True:
+                bool = self.dense['nonzero_both'][template_key][where]
+            else:
+                bool = protonmap!=0
+
+            where = tuple(w[bool] for w in where)
+            bounds = np.searchsorted(occ_event[bool],np.arange(nevents+1))
+            tempp = gather_log_like(counts[bool],protonmap[bool],self.dense['proton_log'][template_key][where])
+            tempg = gather_log_like(counts[bool],gammamap[bool],self.dense['gamma_log'][template_key][where])
+            results['proton_like'][template_key]=segment_sums(tempp,bounds)
+            results['gamma_like'][template_key]=segment_sums(tempg,bounds)
+
+            for name in ['proton_like','gamma_like','unused_proton','unused_gamma']:
+                results[name][template_key][~scored]=np.nan
+
+        if tanks is not None:
+            results['N_unused_tanks']['Common']=np.where(scored,count_common(eventno,tanks[0],tanks[1],on_zero_bins,nevents),0)
+        else:
+            results['N_unused_tanks']['Common']=np.zeros(nevents,dtype=int)
+
+        return results
+
+    def set_analysis_bins(self,highE=False):
+        """ s125 and zen bins of the analysis (s125 upto 10 PeV, or 100 PeV if highE)
+            and the heatmap index of each bin, -1 if the heatmaps lack it. Run after loading heatmaps."""
+
+        if not highE:
+            bins = np.array(zip(np.arange(-0.5,1,0.1),np.arange(-0.4,1.1,0.1)))
+        else:
+            bins = s125_bins
+        self.s125_lows, self.s125_highs = bins[:,0], bins[:,1]
+        self.zen_highs, self.zen_lows = np.array(zenith_bins)[:,0], np.array(zenith_bins)[:,1]
+        self.s125_index = np.array([self.s125_keys.index(str(high)) if str(high) in self.s125_keys else -1
+                                    for high in self.s125_highs])
+        self.zen_index = np.array([self.zen_keys.index(str(high)) if str(high) in self.zen_keys else -1
+                                   for high in self.zen_highs])
+        return
 
-                    hist[key], edges3d = np.histogramdd(data, bins = hbins, range=hrange)
+    def locate_heatmap_bins(self,log_s125,cos_zen):
+        """ Output: s125 and zen analysis bin of each event, -1 outside the bins,
+            and their heatmap indices for calc_llh_values_batch, -1 if there is no heatmap."""
+
+        s125_bin = locate_bin(log_s125,self.s125_lows,self.s125_highs)
+        zen_bin = locate_bin(cos_zen,self.zen_lows,self.zen_highs)
+        s125_index = np.where(s125_bin>=0,self.s125_index[s125_bin],-1)
+        zen_index = np.where(zen_bin>=0,self.zen_index[zen_bin],-1)
+        return s125_bin, zen_bin, s125_index, zen_index
+
+    def heatmap_bin_index(self,s125,zen,nevents):
+        """ Per event integer s125 and zen heatmap indices from keys or indices."""
+        if isinstance(s125,basestring):
+            s125 = self.s125_keys.index(s125)
+        if isinstance(zen,basestring):
+            zen = self.zen_keys.index(zen)
+        s125_bin = np.array(np.broadcast_to(np.asarray(s125,dtype=int),(nevents,)))
+        zen_bin = np.array(np.broadcast_to(np.asarray(zen,dtype=int),(nevents,)))
+        return s125_bin, zen_bin
 
-                hevent = hist['hlc'] + hist['slc'] + hist['nohit']
+    def calc_llh_values_new_3d(self,s125,zen,ignorezerobinsinboth=True):
+        """ Calculate LLH values for events """
 
-                temp=hevent* self.heatmap[template+'_norm'][template_key][s125][zen]
+        r, q, t, offsets = self.flatten_events()
+        results = self.calc_llh_values_3d_batch(r, q, t, offsets, s125, zen, ignorezerobinsinboth=ignorezerobinsinboth)
 
-                tanksloc = hevent!=0
-                zerobins = self.heatmap[template+'_norm'][template_key][s125][zen].copy()[tanksloc]
-                totalbins = float(len(zerobins))
-                unusedbins = len(zerobins[zerobins==0])
-                self.events['unused_'+template][template_key].append(unusedbins/totalbins)
+        for name in ['proton_like','gamma_like','unused_proton','unused_gamma']:
+            self.events.setdefault(name,{})['3d'] = results[name]
+        return
 
-                if ignorezerobinsinboth==True:
-                    bool = (self.heatmap['proton_norm'][template_key][s125][zen]!=0)&(self.heatmap['gamma_norm'][template_key][s125][zen]!=0)&(temp!=0)
-                else:
-                    bool = temp!=0
+    def calc_llh_values_3d_batch(self,r,q,t,offsets,s125,zen,ignorezerobinsinboth=True,chunksize=10000):
+        """ 3D (r, q, t) LLH values for many events at once.
+            Input as calc_llh_values_batch; s125, zen are heatmap keys or indices into
+            self.s125_keys/self.zen_keys, one for all events or one per event.
+            Entries are binned into linear 3D bin indices and each event is scored with
+            gathers of its occupied bins from the 3D (log) heatmaps.
+            Output: dict with proton_like, gamma_like, unused_proton, unused_gamma arrays,
+            identical to the per event histogramdd loop; nan for events without heatmap."""
 
-                temp=np.log10(temp[bool])
-                tempp=np.sum(temp)
+        template_key='3d'
+        nevents=len(offsets)-1
+        eventno=np.repeat(np.arange(nevents),np.diff(offsets))
+        linbin = linear_bin_index([r,q,t], hist_edges(global3dbins, global3drange))
+
+        s125_bin, zen_bin = self.heatmap_bin_index(s125,zen,nevents)
+        scored = (s125_bin>=0)&(zen_bin>=0)
+        nzen = len(self.zen_keys)
+        heatmap_bin = np.where(scored,s125_bin*nzen + zen_bin,-1)
+
+        results={}
+        for name in ['proton_like','gamma_like','unused_proton','unused_gamma']:
+            results[name]=np.full(nevents,np.nan)
+
+        # Chunks bound the memory of the per entry arrays of large event sets.
+        for first in range(0,nevents,chunksize):
+            last = min(first+chunksize,nevents)
+            pulses = slice(offsets[first],offsets[last])
+            occ_event, occ_bin, counts = sparse_histograms(eventno[pulses]-first,linbin[pulses],np.prod(global3dbins))
+            occ_event += first
+
+            # Events sharing a heatmap are gathered together
+            for b in np.unique(heatmap_bin[first:last][scored[first:last]]):
+                s125_key, zen_key = self.s125_keys[b//nzen], self.zen_keys[b%nzen]
+                if zen_key not in self.heatmap['proton_norm'][template_key].get(s125_key,{}):
+                    continue
 
-                self.events[template+'_like'][template_key].append(tempp)
-        return
+                events = np.flatnonzero(heatmap_bin[first:last]==b)+first
+                occ = np.isin(occ_event,events)
+                # position of each occupied bin's event in events
+                event, linear, count = np.searchsorted(events,occ_event[occ]), occ_bin[occ], counts[occ]
+                totalbins = np.bincount(event,minlength=len(events)).astype(float)
+
+                maps={}
+                for template in ['proton','gamma']:
+                    maps[template] = gather_bins(self.heatmap[template+'_norm'][template_key][s125_key][zen_key],linear)
+                for template in ['proton','gamma']:
+                    pdf = maps[template]
+                    with np.errstate(divide='ignore',invalid='ignore'):
+                        results['unused_'+template][events] = np.bincount(event,weights=pdf==0,minlength=len(events))/totalbins
+
+                    if ignorezerobinsinboth==True:
+                        bool = (maps['proton']!=0)&(maps['gamma']!=0)
+                    else:
+                        bool = pdf!=0
+
+                    logpdf = gather_bins(self.heatmap[template+'_log'][template_key][s125_key][zen_key],linear[bool])
+                    bounds = np.searchsorted(event[bool],np.arange(len(events)+1))
+                    results[template+'_like'][events] = segment_sums(gather_log_like(count[bool],pdf[bool],logpdf),bounds)
+
+        return results
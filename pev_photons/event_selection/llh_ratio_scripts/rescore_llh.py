@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+########################################################################
+# Rescore the LLH Ratio of the events of analysis HDF files
+########################################################################
+
+import os
+import argparse
+import numpy as np
+import tables
+from multiprocessing import Pool
+
+from llh_ratio_test_globals import globalhistbins as histbins
+from llh_ratio_test_globals import globalhistrange as histrange
+from llh_ratio_test_library import llh_ratio_test, combine_pulses
+from heatmap_store import templates
+
+def sidecar_name(hdffile,outdir):
+    """ Sidecar file of an HDF file: <outdir>/<name>_llh.h5"""
+    name = os.path.splitext(os.path.basename(hdffile))[0]
+    return os.path.join(outdir,name+'_llh.h5')
+
+def score_file(hdffile,heatmaps,geofile,store=False,highE=False,include_slc_time=True,
+               exclude_hlc_time=False,slc_time_corrected=False,chunksize=10000):
+    """ LLH values of every event (row of the Laputop table) of an HDF file,
+        scored in chunks of events with calc_llh_values_batch.
+        heatmaps: year pickle, or store basename if store=True.
+        The time options are those of load_pulses, the defaults use SLC and HLC times
+        as IceTop_LLH_Ratio does. Events outside the s125/zen bins are nan.
+        Output: dict of LLH_Hadron_*, LLH_Gamma_* and LLH_Ratio arrays."""
+
+    llh = llh_ratio_test()
+    llh.load_geometry(geofile)
+    llh.load_shared_heatmaps(heatmaps,store=store,smearedthumbplot=False,normradialbins=False)
+    llh.set_analysis_bins(highE)
+    llh.load_hdf_file(hdffile)
+
+    nevents = len(llh.events['laputop_x'])
+    s125_bin, zen_bin, s125_index, zen_index = llh.locate_heatmap_bins(llh.events['log_s125'],llh.events['cos_zen'])
+
+    columns = {}
+    for key in templates:
+        columns['LLH_Hadron_%s'%key] = np.full(nevents,np.nan)
+        columns['LLH_Gamma_%s'%key] = np.full(nevents,np.nan)
+
+    for events, pulses in llh.iter_pulses(chunksize=chunksize,include_slc_time=include_slc_time,
+                                          exclude_hlc_time=exclude_hlc_time,slc_time_corrected=slc_time_corrected):
+        r, q, t, offsets = combine_pulses(pulses)
+        results = llh.calc_llh_values_batch(r, q, t, offsets, s125_index[events], zen_index[events],
+                                            histbins, histrange, ignorezerobinsinboth=True)
+        for key in templates:
+            columns['LLH_Hadron_%s'%key][events] = results['proton_like'][key]
+            columns['LLH_Gamma_%s'%key][events] = results['gamma_like'][key]
+
+    # Summed in the same order as IceTop_LLH_Ratio
+    columns['LLH_Ratio'] = np.zeros(nevents)
+    for key in templates:
+        columns['LLH_Ratio'] += columns['LLH_Hadron_%s'%key] - columns['LLH_Gamma_%s'%key]
+
+    if 'I3EventHeader' in llh.f.root:
+        for key in ['Run','SubRun','Event','SubEvent']:
+            if key in llh.f.root.I3EventHeader.colnames:
+                columns[key] = llh.f.root.I3EventHeader.col(key)
+
+    llh.f.close()
+    return columns
+
+def score_digitized_file(digitizedfile,heatmaps,store=False,highE=False,chunksize=10000):
+    """ score_file for a file of digitized_pulses.write_digitized: the events are scored
+        from their bin indices. Rows of the source file that were not written
+        (quality cuts) are nan, the time options are those the file was written with.
+        Output: dict of LLH_Hadron_*, LLH_Gamma_* and LLH_Ratio arrays over the rows of the source file."""
+
+    from digitized_pulses import read_digitized, digitized_histograms
+
+    llh = llh_ratio_test()
+    llh.load_shared_heatmaps(heatmaps,store=store,smearedthumbplot=False,normradialbins=False)
+    llh.set_analysis_bins(highE)
+    digitized = read_digitized(digitizedfile)
+
+    nevents = len(digitized['row'])
+    s125_bin, zen_bin, s125_index, zen_index = llh.locate_heatmap_bins(digitized['log_s125'],digitized['cos_zen'])
+
+    columns = {}
+    for key in templates:
+        columns['LLH_Hadron_%s'%key] = np.full(digitized['nrows'],np.nan)
+        columns['LLH_Gamma_%s'%key] = np.full(digitized['nrows'],np.nan)
+
+    for first in range(0,nevents,chunksize):
+        events = slice(first,min(first+chunksize,nevents))
+        results = llh.calc_llh_values_batch(None, None, None, None, s125_index[events], zen_index[events],
+                                            histbins, histrange, ignorezerobinsinboth=True,
+                                            histograms=digitized_histograms(digitized,histbins,events))
+        rows = digitized['row'][events]
+        for key in templates:
+            columns['LLH_Hadron_%s'%key][rows] = results['proton_like'][key]
+            columns['LLH_Gamma_%s'%key][rows] = results['gamma_like'][key]
+
+    # Summed in the same order as IceTop_LLH_Ratio
+    columns['LLH_Ratio'] = np.zeros(digitized['nrows'])
+    for key in templates:
+        columns['LLH_Ratio'] += columns['LLH_Hadron_%s'%key] - columns['LLH_Gamma_%s'%key]
+
+    return columns
+
+def write_sidecar(columns,filename,tablename='IceTopLLHRatio'):
+    """ Writes the columns as one table, row i belongs to row i of the scored file."""
+
+    names = sorted(columns.keys())
+    data = np.rec.fromarrays([columns[name] for name in names],names=names)
+
+    f = tables.open_file(filename+'.tmp','w')
+    f.create_table('/',tablename,obj=data)
+    f.close()
+    os.rename(filename+'.tmp',filename)
+    return
+
+def score_job(args):
+    hdffile, outdir, tablename, kwargs = args
+    if kwargs.get('digitized',False):
+        from digitized_pulses import digitized_source
+        columns = score_digitized_file(hdffile,kwargs['heatmaps'],store=kwargs.get('store',False),
+                                       highE=kwargs.get('highE',False))
+        write_sidecar(columns,sidecar_name(digitized_source(hdffile),outdir),tablename=tablename)
+    else:
+        columns = score_file(hdffile,**kwargs)
+        write_sidecar(columns,sidecar_name(hdffile,outdir),tablename=tablename)
+    print 'scored',hdffile
+    return hdffile
+
+def rescore(files,outdir,processes=1,tablename='IceTopLLHRatio',**kwargs):
+    """ Scores files in a pool of processes and writes a sidecar for each.
+        Each process loads the heatmaps once (shared_resource).
+        With digitized=True the files are digitized pulses (digitized_pulses.py),
+        their sidecars are named after the files they were written from."""
+
+    jobs = [(hdffile,outdir,tablename,kwargs) for hdffile in files]
+    if processes>1:
+        pool = Pool(processes)
+        done = list(pool.imap_unordered(score_job,jobs))
+        pool.close()
+        pool.join()
+    else:
+        done = [score_job(job) for job in jobs]
+    return done
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Rescore the LLH Ratio of analysis HDF files.')
+    p.add_argument('files', nargs='+', help='HDF files with Laputop and pulse tables.')
+    p.add_argument('--outdir', default=os.getcwd(), help='Directory of the sidecar files.')
+    p.add_argument('--table', default='IceTopLLHRatio', help='Table name in the sidecar files.')
+    p.add_argument('--heatmaps', help='Heatmap pickle, or store basename with --store.')
+    p.add_argument('--store', action='store_true', default=False,
+                   help='Are the heatmaps a heatmap store?')
+    p.add_argument('--geometry', default=os.getcwd()+'/geometry.h5', help='Geometry HDF file.')
+    p.add_argument('--highEbins', action='store_true', default=False,
+                   help='Use s125 bins upto 100 PeV.')
+    p.add_argument('--processes', type=int, default=1, help='Number of processes.')
+    p.add_argument('--digitized', action='store_true', default=False,
+                   help='Are the files digitized pulses (digitized_pulses.py)? Then they keep the time options they were written with.')
+    p.add_argument('--exclude_slc_time', action='store_true', default=False)
+    p.add_argument('--exclude_hlc_time', action='store_true', default=False)
+    p.add_argument('--slc_time_corrected', action='store_true', default=False)
+    args = p.parse_args()
+
+    if args.digitized:
+        rescore(args.files, args.outdir, processes=args.processes, tablename=args.table,
+                heatmaps=args.heatmaps, store=args.store, highE=args.highEbins, digitized=True)
+    else:
+        rescore(args.files, args.outdir, processes=args.processes, tablename=args.table,
+                heatmaps=args.heatmaps, geofile=args.geometry, store=args.store, highE=args.highEbins,
+                include_slc_time=not args.exclude_slc_time, exclude_hlc_time=args.exclude_hlc_time,
+                slc_time_corrected=args.slc_time_corrected)
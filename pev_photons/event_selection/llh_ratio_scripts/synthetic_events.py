@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+########################################################################
+# Synthetic IceTop air showers written as analysis HDF files that
+# llh_ratio_test.load_hdf_file reads, plus a random heatmap store
+########################################################################
+
+import os
+import argparse
+import numpy as np
+import tables
+
+from llh_ratio_test_globals import shower_cs_rotation, light_speed, s125_bins, zenith_bins
+
+# Lateral distribution (DLP) and shower front curvature of Laputop
+dlp_kappa = 0.30264
+curvature_a = 4.823e-4 # ns/m^2
+curvature_b = 19.41 # ns
+curvature_sigma = 83.5 # m
+
+def front_delay(r):
+    """ Delay of the curved shower front behind the plane front at distance r, in ns."""
+    return curvature_a*r**2 + curvature_b*np.expm1(-r**2/(2*curvature_sigma**2))
+
+# The curved front runs ahead of the plane front close to the core, times are measured from its earliest point
+front_earliest = front_delay(np.sqrt(2*curvature_sigma**2*np.log(max(curvature_b/(2*curvature_a*curvature_sigma**2),1.))))
+
+class pulse_description(tables.IsDescription):
+    string = tables.Int32Col()
+    om = tables.Int32Col()
+    pmt = tables.Int32Col()
+    x = tables.Float64Col()
+    y = tables.Float64Col()
+    X = tables.Float64Col()
+    Y = tables.Float64Col()
+    charge = tables.Float64Col()
+    time = tables.Float64Col()
+    T = tables.Float64Col()
+    time_corrected = tables.Float64Col()
+    T_corrected = tables.Float64Col()
+
+class index_description(tables.IsDescription):
+    start = tables.Int64Col()
+    stop = tables.Int64Col()
+
+def write_geometry(geofile,nstations=81,spacing=125.,tank_distance=10.,altitude=1950.,seed=0):
+    """ Writes a geometry HDF file (table mygeometry, as read_geometry reads it) of
+        nstations stations on a triangular grid, each with two tanks of two DOMs
+        (om 61/62 and 63/64) tank_distance apart."""
+
+    rng = np.random.RandomState(seed)
+    n = int(np.ceil(np.sqrt(nstations)))+2
+    i, j = np.meshgrid(np.arange(-n,n+1),np.arange(-n,n+1))
+    x = (spacing*(i+0.5*j)).ravel()
+    y = (spacing*np.sqrt(3)/2*j).ravel()
+    nearest = np.argsort(np.hypot(x,y),kind='mergesort')[:nstations]
+    x, y = x[nearest], y[nearest]
+
+    angle = rng.uniform(0,2*np.pi,nstations)
+    rows = []
+    for station in range(nstations):
+        for om, sign in [(61,1),(62,1),(63,-1),(64,-1)]:
+            dx = sign*tank_distance/2*np.cos(angle[station])
+            dy = sign*tank_distance/2*np.sin(angle[station])
+            rows.append((station+1,om,0,x[station]+dx,y[station]+dy,altitude))
+    rows = np.array(rows,dtype=float)
+
+    # columns are DOMs, rows are string, om, pmt, x, y, z
+    description = dict(('dom%i'%i,tables.Float64Col(pos=i)) for i in range(len(rows)))
+    f = tables.open_file(geofile,'w')
+    table = f.create_table('/','mygeometry',description)
+    for k in range(rows.shape[1]):
+        row = table.row
+        for i in range(len(rows)):
+            row['dom%i'%i] = rows[i,k]
+        row.append()
+    table.flush()
+    f.close()
+    return
+
+def tank_table(geofile):
+    """ string, om and position of the first DOM of every tank, and its station."""
+    from llh_ratio_test_library import read_geometry
+    geo = read_geometry(geofile)
+    return geo[geo['tank_first']]
+
+def generate_showers(tanks,nevents,rng,cos_zen_min=0.7,core_radius=400.,log_s125_range=(-0.5,2.1),gamma=2.7):
+    """ Shower axes and sizes: cos^2 zenith and azimuth uniform, core uniform in a disk,
+        S125 from a power law of index gamma and the DLP slope beta around 3.
+        Output: dict of per event arrays."""
+
+    showers = {}
+    showers['zenith'] = np.arccos(np.sqrt(rng.uniform(cos_zen_min**2,1,nevents)))
+    showers['azimuth'] = rng.uniform(0,2*np.pi,nevents)
+    radius = core_radius*np.sqrt(rng.uniform(0,1,nevents))
+    angle = rng.uniform(0,2*np.pi,nevents)
+    showers['x'] = radius*np.cos(angle)
+    showers['y'] = radius*np.sin(angle)
+    showers['z'] = np.full(nevents,np.mean(tanks['z']))
+
+    # Inverse CDF of S^-gamma in log10 S
+    low, high = log_s125_range
+    k = (gamma-1)*np.log(10)
+    u = rng.uniform(0,1,nevents)
+    showers['log_s125'] = low - np.log(1 - u*(1-np.exp(-k*(high-low))))/k
+    showers['beta'] = np.clip(rng.normal(3.,0.3,nevents),1.5,5.)
+    return showers
+
+def generate_pulses(tanks,showers,rng):
+    """ One pulse per hit tank: the DLP charge with fluctuations, hit with probability
+        1-exp(-S), HLC if both tanks of the station are hit and SLC otherwise.
+        Times are the curved shower front delay plus an exponential jitter growing with distance.
+        Output: dict of (event, tank) arrays and the hlc/slc masks."""
+
+    # Detector to shower coordinates, along the direction of propagation
+    theta = np.pi - showers['zenith']
+    phi = (showers['azimuth']+np.pi)%(2*np.pi)
+    rotation = shower_cs_rotation(theta,phi)
+    positions = np.column_stack((tanks['x'],tanks['y'],tanks['z']))
+    core = np.column_stack((showers['x'],showers['y'],showers['z']))
+    relative = positions[np.newaxis,:,:] - core[:,np.newaxis,:]
+    shower_cs_position = np.einsum('eij,etj->eti',rotation,relative)
+
+    pulses = {}
+    pulses['x'] = shower_cs_position[...,0]
+    pulses['y'] = shower_cs_position[...,1]
+    r = np.maximum(np.hypot(pulses['x'],pulses['y']),1.)
+
+    log_r = np.log10(r/125.)
+    expected = 10**(showers['log_s125'][:,np.newaxis] - (showers['beta'][:,np.newaxis] + dlp_kappa*log_r)*log_r)
+    sigma = 0.15 + 0.5/np.sqrt(1+expected)
+    pulses['charge'] = expected*np.exp(sigma*rng.normal(size=expected.shape) - sigma**2/2)
+    hit = rng.uniform(size=expected.shape) < -np.expm1(-expected)
+
+    pulses['time'] = front_delay(r) - front_earliest + rng.exponential(2.+0.02*r)
+    # shower cs z points back to the source, upstream tanks are hit first
+    pulses['T'] = 1e4 - shower_cs_position[...,2]/light_speed + pulses['time']
+    pulses['X'] = np.broadcast_to(tanks['x'],r.shape)
+    pulses['Y'] = np.broadcast_to(tanks['y'],r.shape)
+
+    stations = np.unique(tanks['string'],return_inverse=True)[1]
+    hit_tanks = np.zeros((len(r),stations.max()+1),dtype=int)
+    event, tank = np.nonzero(hit)
+    np.add.at(hit_tanks,(event,stations[tank]),1)
+    hlc = hit & (hit_tanks[:,stations]==2)
+    pulses['hlc'] = hlc
+    pulses['slc'] = hit & ~hlc
+    pulses['nstation'] = (hit_tanks>0).sum(axis=1)
+    return pulses
+
+def append_pulses(table,index,tanks,pulses,select,start):
+    """ Appends the selected (event, tank) pulses to a pulse table and their ranges to its index."""
+
+    event, tank = np.nonzero(select)
+    rows = np.zeros(len(event),dtype=table.dtype)
+    rows['string'] = tanks['string'][tank]
+    rows['om'] = tanks['om'][tank]
+    rows['pmt'] = tanks['pmt'][tank]
+    for name in ['x','y','X','Y','charge','time','T']:
+        rows[name] = pulses[name][event,tank]
+    # No SLC time bias is simulated
+    rows['time_corrected'] = rows['time']
+    rows['T_corrected'] = rows['T']
+    table.append(rows)
+
+    counts = select.sum(axis=1)
+    ranges = np.zeros(len(counts),dtype=index.dtype)
+    ranges['stop'] = start + np.cumsum(counts)
+    ranges['start'] = ranges['stop'] - counts
+    index.append(ranges)
+    return start + counts.sum()
+
+def write_events(hdffile,geofile,nevents,seed=0,chunksize=10000,**kwargs):
+    """ Writes nevents synthetic showers on the tanks of geofile as an analysis HDF file:
+        Laputop, LaputopParams, NStation, IT73AnalysisIceTopQualityCuts (all passed),
+        I3EventHeader and the SLC/HLC pulse tables with their __I3Index__.
+        keyword arguments: options of generate_showers."""
+
+    rng = np.random.RandomState(seed)
+    tanks = tank_table(geofile)
+
+    f = tables.open_file(hdffile,'w')
+    index_group = f.create_group('/','__I3Index__')
+    pulse_tables = {}
+    for tag,name in [('slc','IceTopLaputopSeededSelectedSLC'),('hlc','IceTopLaputopSeededSelectedHLC')]:
+        pulse_tables[tag] = (f.create_table('/',name,pulse_description),f.create_table(index_group,name,index_description),[0])
+
+    event_tables = {}
+    def append_columns(name,columns):
+        if name not in event_tables:
+            description = dict((column,tables.Float64Col(pos=i)) for i,column in enumerate(sorted(columns)))
+            event_tables[name] = f.create_table('/',name,description)
+        rows = np.zeros(len(columns.values()[0]),dtype=event_tables[name].dtype)
+        for column in columns:
+            rows[column] = columns[column]
+        event_tables[name].append(rows)
+
+    quality = ['IceTop_StandardFilter','IceTop_reco_succeeded','IceTopMaxSignalInside','Laputop_FractionContainment',
+               'IceTopMaxSignalAbove6','BetaCutPassed']
+    for first in range(0,nevents,chunksize):
+        n = min(chunksize,nevents-first)
+        showers = generate_showers(tanks,n,rng,**kwargs)
+        pulses = generate_pulses(tanks,showers,rng)
+
+        for tag in ['slc','hlc']:
+            table, index, start = pulse_tables[tag]
+            start[0] = append_pulses(table,index,tanks,pulses,pulses[tag],start[0])
+
+        append_columns('Laputop',dict((key,showers[key]) for key in ['zenith','azimuth','x','y','z']))
+        append_columns('LaputopParams',{'s125':10**showers['log_s125'],'beta':showers['beta']})
+        append_columns('NStation',{'value':pulses['nstation']})
+        append_columns('IT73AnalysisIceTopQualityCuts',dict((key,np.ones(n)) for key in quality))
+        append_columns('I3EventHeader',{'Run':np.zeros(n),'Event':np.arange(first,first+n),'SubEvent':np.zeros(n)})
+
+    f.close()
+    return
+
+def write_random_store(base,seed=0,mean=1.):
+    """ Writes a normalized heatmap store of Poisson(mean) counts for every template
+        and s125/zen bin of llh_ratio_test_globals, for scoring synthetic events."""
+
+    from heatmap_builder import empty_partial, write_partial_store
+
+    rng = np.random.RandomState(seed)
+    partial = empty_partial(s125_bins,zenith_bins)
+    for key in partial:
+        if key.startswith('counts_'):
+            partial[key] += rng.poisson(mean,size=partial[key].shape)
+        elif key.startswith('nevents_'):
+            partial[key] += 1
+    write_partial_store(partial,base,normalize=True)
+    return
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='Write synthetic IceTop events and a random heatmap store.')
+    p.add_argument('--output', help='Output HDF file of the events.')
+    p.add_argument('--events', type=int, default=10000, help='Number of events.')
+    p.add_argument('--geometry', default=os.getcwd()+'/geometry.h5',
+                   help='Geometry HDF file, written first if it does not exist.')
+    p.add_argument('--store', default=None, help='Basename of a random heatmap store to write.')
+    p.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = p.parse_args()
+
+    if not os.path.exists(args.geometry):
+        write_geometry(args.geometry,seed=args.seed)
+    if args.output is not None:
+        write_events(args.output,args.geometry,args.events,seed=args.seed)
+    if args.store is not None:
+        write_random_store(args.store,seed=args.seed)
@@ -1,4 +1,5 @@
 from icecube import icetray, dataclasses
+from llh_ratio_test_globals import shower_cs, shower_cs_rotation
 
 def pulse_is_saturated(gcd, om_key, reco_pulse):
     """
@@ -54,16 +55,7 @@ def to_shower_cs(fit):
     Requires numpy.
     """
     import numpy
-    from math import cos, sin
-    # counter-clockwise (pi + phi) rotation
-    d_phi = numpy.matrix([ [ -cos(fit.dir.phi), -sin(fit.dir.phi), 0],
-                           [  sin(fit.dir.phi), -cos(fit.dir.phi), 0],
-                           [  0,                 0,                1] ])
-    # clock-wise (pi - theta) rotation
-    d_theta = numpy.matrix([ [  -cos(fit.dir.theta), 0, -sin(fit.dir.theta)],
-                             [  0,                  1,  0,                ],
-                             [  sin(fit.dir.theta), 0,  -cos(fit.dir.theta)] ])
-    return d_theta*d_phi
+    return numpy.matrix(shower_cs_rotation(fit.dir.theta, fit.dir.phi))
 
 
 def classify_from_seed(pulses, reco, geometry, min_time=-200, max_time=800):
@@ -104,13 +96,12 @@ def classify_from_seed(pulses, reco, geometry, min_time=-200, max_time=800):
         return {'ok': [], 'after-pulses': [], 'rejected': []}
 
     # Rotate position to shower coordinates according to reco
-    M = to_shower_cs(reco)
     #print "stations:", stations
-    stations[:,2:5] -= numpy.array([reco.pos.x, reco.pos.y, reco.pos.z])
-    stations[:,2:5] = numpy.array(M*stations[:,2:5].transpose()).transpose()
+    _, delay = shower_cs(stations[:,2:5], [reco.pos.x, reco.pos.y, reco.pos.z],
+                         reco.dir.theta, reco.dir.phi, c=dataclasses.I3Constants.c)
 
     # subtract travelling time of plane front from station time
-    stations[:,6] -= reco.time - stations[:,4]/0.29979
+    stations[:,6] -= reco.time - delay
 
     ap = [(keys[i][0], keys[i][1]) for i,p in enumerate(stations.tolist()) if p[6] > 6500 and p[1] > 0.0]
     ok = [(keys[i][0], keys[i][1]) for i,p in enumerate(stations.tolist()) if not (keys[i][0], keys[i][1]) in ap and p[6] > min_time and p[6] < max_time]
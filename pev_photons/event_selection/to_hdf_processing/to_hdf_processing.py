@@ -22,6 +22,7 @@ from icecube.frame_object_diff.segments import uncompress
 from pev_photons.event_selection.llh_ratio_scripts.llh_ratio_i3_module import IceTop_LLH_Ratio
 from pev_photons.event_selection.icecube_cleaning import icecube_cleaning
 from pev_photons.event_selection.run_laputop import run_laputop
+from pev_photons.event_selection.tray_profiler import TrayProfiler
 from pev_photons import utils
 
 def select_keys(isMC=False, store_extra=False, recos=['Laputop']):
@@ -225,9 +226,12 @@ def cut_events(frame, recos=[], threshold=0.7):
 
 
 def main(in_files, out_file, year, isMC=False, systematics=False,
-         run_migrad=False, store_extra=False, training=False):
+         run_migrad=False, store_extra=False, training=False, profile=None):
 
     tray = I3Tray()
+    if profile is not None:
+        # Times every Python module, summary written to profile (.json or .csv)
+        tray = TrayProfiler(tray)
     tray.AddModule('I3Reader', 'Reader', FilenameList=in_files)
     tray.AddSegment(uncompress, 'uncompress')
 
@@ -295,6 +299,8 @@ def main(in_files, out_file, year, isMC=False, systematics=False,
     tray.AddModule('TrashCan', 'Done')
     tray.Execute()
     tray.Finish()
+    if profile is not None:
+        tray.write_summary(profile)
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
@@ -312,9 +318,12 @@ if __name__ == "__main__":
                    help='Store additional keys in HDF files?')
     p.add_argument('--training', action='store_true', default=False,
                    help='Process training data?')
+    p.add_argument('--profile', default=None,
+                   help='Write wall/CPU time and memory of each Python module to this .json or .csv file.')
     args = p.parse_args()
 
     in_files = [args.gcdfile] + args.input_files
     main(in_files, out_file=args.output, year=args.year, isMC=args.isMC,
          systematics=args.systematics, run_migrad=args.run_migrad,
-         store_extra=args.store_extra, training=args.training)
+         store_extra=args.store_extra, training=args.training,
+         profile=args.profile)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+########################################################################
+# Per-module wall time, CPU time and memory of the Python modules of a tray
+########################################################################
+
+import os
+import csv
+import json
+import time
+import inspect
+import resource
+from collections import OrderedDict
+
+# Methods through which an I3Module sees frames, and Finish
+frame_methods = ['Geometry', 'Calibration', 'DetectorStatus', 'DAQ', 'Physics', 'Finish']
+# AddModule parameters of Python function modules handled by the tray itself
+tray_parameters = ['Streams', 'If']
+
+def cpu_time():
+    """ User plus system time of the process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+def resident_memory():
+    """ Resident set size of the process in bytes. Falls back to the peak
+        resident size where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measured(stats, method, count=True):
+    """ method, adding its calls to stats."""
+
+    def call(*args, **kwargs):
+        wall, cpu, rss = time.time(), cpu_time(), resident_memory()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats['wall'] += time.time() - wall
+            stats['cpu'] += cpu_time() - cpu
+            stats['rss'] += resident_memory() - rss
+            if count:
+                stats['frames'] += 1
+    return call
+
+def python_methods(cls):
+    """ Frame methods of cls that are written in Python. A Python Process gets every
+        frame and calls the other frame methods itself, then only Process and Finish
+        are timed so that no frame is counted twice."""
+    methods = []
+    for name in frame_methods + ['Process']:
+        method = getattr(cls, name, None)
+        if inspect.isfunction(getattr(method, '__func__', method)):
+            methods.append(name)
+    if 'Process' in methods:
+        methods = [name for name in methods if name in ['Process', 'Finish']]
+    return methods
+
+class TrayProfiler(object):
+    """ Wraps an I3Tray. Python modules (functions and I3Module classes with frame methods
+        written in Python) added through AddModule are timed, everything else is passed
+        to the tray untouched. Frames, wall time, CPU time and the change of the resident
+        memory are summed per module; modules added inside segments are not timed.
+        Timed modules added without a name are named after the function or class,
+        numbered from the second one on (shift, shift_1, ...)."""
+
+    def __init__(self, tray):
+        self.tray = tray
+        self.stats = OrderedDict()
+
+    def __getattr__(self, name):
+        return getattr(self.tray, name)
+
+    def new_stats(self, name):
+        self.stats[name] = {'frames':0, 'wall':0., 'cpu':0., 'rss':0}
+        return self.stats[name]
+
+    def unique_name(self, module):
+        """ Name of a timed module added without a name."""
+        name = module.__name__
+        number = 1
+        while name in self.stats:
+            name = '%s_%i'%(module.__name__, number)
+            number += 1
+        return name
+
+    def AddModule(self, module, name=None, *args, **kwargs):
+        if inspect.isfunction(module):
+            if name is None:
+                name = self.unique_name(module)
+            stats = self.new_stats(name)
+            # Streams and If go to the tray, which applies them to the timed function as to module.
+            # The parameters of module are bound here, the timed function only takes the frame.
+            tray_kwargs = dict((key, kwargs[key]) for key in kwargs if key in tray_parameters)
+            parameters = dict((key, kwargs[key]) for key in kwargs if key not in tray_parameters)
+            call = measured(stats, module)
+            def timed(frame):
+                return call(frame, **parameters)
+            return self.tray.AddModule(timed, name, *args, **tray_kwargs)
+
+        if inspect.isclass(module) and len(python_methods(module)) > 0:
+            if name is None:
+                name = self.unique_name(module)
+            stats = self.new_stats(name)
+            methods = {}
+            for method in python_methods(module):
+                methods[method] = measured(stats, getattr(module, method), count=method != 'Finish')
+            timed = type(module)(module.__name__, (module,), methods)
+            return self.tray.AddModule(timed, name, *args, **kwargs)
+
+        if name is None:
+            return self.tray.AddModule(module, *args, **kwargs)
+        return self.tray.AddModule(module, name, *args, **kwargs)
+
+    def summary(self):
+        """ One row per timed module, in tray order: frames, wall and CPU time in seconds,
+            wall time per frame in ms and the resident memory change in MB."""
+
+        rows = []
+        for name, stats in self.stats.items():
+            rows.append(OrderedDict([('module', name),
+                                     ('frames', stats['frames']),
+                                     ('wall_s', stats['wall']),
+                                     ('cpu_s', stats['cpu']),
+                                     ('wall_per_frame_ms', 1e3*stats['wall']/max(stats['frames'], 1)),
+                                     ('rss_delta_MB', stats['rss']/2.**20)]))
+        return rows
+
+    def write_summary(self, filename):
+        """ Writes the summary as CSV (.csv) or JSON (any other extension)
+            and prints the modules by wall time."""
+
+        rows = self.summary()
+        if filename.endswith('.csv'):
+            with open(filename, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(rows[0].keys() if len(rows) > 0 else ['module'])
+                for row in rows:
+                    writer.writerow(row.values())
+        else:
+            with open(filename, 'w') as f:
+                json.dump(rows, f, indent=2)
+
+        for row in sorted(rows, key=lambda row: -row['wall_s']):
+            print '{module:40s} {frames:8d} frames {wall_s:10.2f} s wall {cpu_s:10.2f} s cpu {rss_delta_MB:8.1f} MB'.format(**row)
+        return
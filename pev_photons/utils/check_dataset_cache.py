@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+########################################################################
+# Check that load_dataset's reseeded cached LLHs give the trials of new ones.
+########################################################################
+
+import sys
+import numpy as np
+
+from pev_photons.utils import load_datasets
+
+class StubLLH(object):
+    """ Seasonal LLH with the random state and scrambling of PointSourceLLH. """
+
+    def __init__(self, nevents, seed=None, scramble=False, **kwargs):
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        self.exp = np.zeros(nevents, dtype=[('ra', float), ('sinDec', float)])
+        self.exp['sinDec'] = np.linspace(-1., -0.8, nevents)
+        if scramble:
+            self.exp['ra'] = self.random.uniform(0., 2.*np.pi, nevents)
+
+    def do_trials(self, n_iter):
+        """ Right ascensions of the events scrambled again for every trial. """
+        return [self.random.uniform(0., 2.*np.pi, len(self.exp))
+                for i in range(n_iter)]
+
+class StubMultiLLH(object):
+    """ MultiPointSourceLLH of StubLLH samples. """
+
+    def __init__(self, seed=None, ncpu=1):
+        self.random = np.random.RandomState(seed)
+        self.ncpu = ncpu
+        self.samples = []
+
+    def add_sample(self, name, llh):
+        self.samples.append(llh)
+
+    def do_trials(self, n_iter):
+        """ Number of injected events and the trials of every sample. """
+        return (self.random.poisson(5., n_iter),
+                [sample.do_trials(n_iter) for sample in self.samples])
+
+def build_stub(name, ncpu, seed, alpha, template_name, absorption,
+               llh_args, model_args, pin_seeds=False):
+    """ build_dataset, with stub LLHs of 100 to 500 events. """
+    llh = StubMultiLLH(seed=seed, ncpu=ncpu)
+    nevents = [100, 200, 300, 400, 500]
+    seeds = load_datasets.sample_seeds(seed, len(nevents), llh_args)
+    for i, n in enumerate(nevents):
+        year_args = dict(llh_args, seed=seeds[i]) if pin_seeds else llh_args
+        llh.add_sample(i, StubLLH(n, **year_args))
+    return llh, llh.samples
+
+def state(llh, n_iter=3):
+    """ Event right ascensions of every sample, then n_iter trials. """
+    scrambled = [sample.exp['ra'].copy() for sample in llh.samples]
+    injected, trials = llh.do_trials(n_iter)
+    return scrambled, injected, trials
+
+def same(a, b):
+    """ True if two nested lists of arrays are equal. """
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return np.array_equal(a, b)
+
+def check():
+    """ Output: list of failed checks, empty if all passed. """
+    load_datasets.build_dataset = build_stub
+    failures = []
+
+    for llh_args in [None, {'scramble':True}]:
+        uncached = load_datasets.load_dataset('point_source', seed=5, llh_args=llh_args)
+        load_datasets.dataset_cache.clear()
+        new = state(load_datasets.load_dataset('point_source', seed=7, llh_args=llh_args, cache=True))
+        load_datasets.dataset_cache.clear()
+        first = load_datasets.load_dataset('point_source', seed=5, llh_args=llh_args, cache=True)
+        first_state = state(first)
+        other = state(load_datasets.load_dataset('point_source', seed=7, llh_args=llh_args, cache=True))
+        second = load_datasets.load_dataset('point_source', seed=5, llh_args=llh_args, cache=True)
+        second_state = state(second)
+
+        if any(sample.seed is not None for sample in uncached.samples):
+            failures.append('{}: an uncached LLH seeded its seasons'.format(llh_args))
+        if uncached is first or load_datasets.load_dataset('point_source', seed=5, llh_args=llh_args) is first:
+            failures.append('{}: an uncached call returned the cached LLH'.format(llh_args))
+        if second is not first:
+            failures.append('{}: the cached LLH was not reused'.format(llh_args))
+        if not same(other, new):
+            failures.append('{}: reseeding with 7 differs from building with 7'.format(llh_args))
+        if not same(second_state, first_state):
+            failures.append('{}: two calls with seed 5 differ'.format(llh_args))
+        if same(other[1:], first_state[1:]):
+            failures.append('{}: seeds 5 and 7 give the same trials'.format(llh_args))
+
+    # Keys of equal arguments are equal, whatever order or container they come in.
+    key = lambda model_args: load_datasets.dataset_key('point_source', 1, 2., None, False,
+                                                       {'scramble':False}, model_args)
+    if key({'bounds':[2., 2.], 'bins':np.arange(4.)}) != key({'bins':np.arange(4.), 'bounds':(2., 2.)}):
+        failures.append('equal arguments give different keys')
+    if key({'bins':np.arange(4.)}) == key({'bins':np.arange(4.).reshape(2, 2)}):
+        failures.append('arrays of different shapes give the same key')
+    if key({'bins':np.arange(4.)}) == key({'bins':np.arange(1., 5.)}):
+        failures.append('different arrays give the same key')
+    try:
+        key({'weights':set([1])})
+        failures.append('an unhashable argument was accepted')
+    except TypeError:
+        pass
+
+    return failures
+
+if __name__ == "__main__":
+    failures = check()
+    for failure in failures:
+        print(failure)
+    print('{} failures'.format(len(failures)))
+    sys.exit(1 if failures else 0)
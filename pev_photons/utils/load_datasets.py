@@ -15,8 +15,60 @@ from skylab.ps_llh import PointSourceLLH, MultiPointSourceLLH
 from .support import prefix
 from .gamma_ray_survival import apply_source_absorption
 
+# (LLH, seasonal LLHs) built by load_dataset, by dataset_key
+dataset_cache = {}
+
+def freeze(value):
+    """ Hashable form of an llh or model argument. Dicts become their sorted
+    items, lists and tuples become tuples and arrays their shape and values,
+    recursively. Anything else has to be hashable.
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, freeze(item))
+                                   for key, item in value.items())))
+    if isinstance(value, np.ndarray):
+        items = value.ravel()
+        if value.dtype == object:
+            items = [freeze(item) for item in items]
+        return (np.ndarray, value.shape, tuple(items))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        raise TypeError('load_dataset can not cache an argument of type {}, '
+                        'use cache=False.'.format(type(value).__name__))
+    return value
+
+def dataset_key(name, ncpu, alpha, template_name, absorption, llh_args, model_args):
+    """ Everything but the seed that load_dataset builds an LLH from. """
+    return (name, ncpu, alpha, template_name, absorption,
+            freeze(llh_args), freeze(model_args))
+
+def sample_seeds(seed, nsamples, llh_args):
+    """ Seeds of the seasonal LLHs of a cached load_dataset LLH:
+    llh_args['seed'] if given, else drawn from seed, one per season, so that
+    reseed can give a cached LLH the random states of a new build.
+    """
+    if 'seed' in llh_args:
+        return [llh_args['seed']]*nsamples
+    return [int(s) for s in np.random.RandomState(seed).randint(0, 2**31, nsamples)]
+
+def reseed(llh, samples, seed, llh_args):
+    """ Gives a cached LLH and its seasonal LLHs (samples) the random states
+    they get when they are built with seed. With scramble in llh_args, the
+    right ascensions of the events of every season are drawn again from its
+    new random state, as when it is built with scramble=True.
+    """
+    llh.random = np.random.RandomState(seed)
+    for sample, sample_seed in zip(samples, sample_seeds(seed, len(samples), llh_args)):
+        sample.random = np.random.RandomState(sample_seed)
+        if llh_args.get('scramble', False):
+            sample.exp['ra'] = sample.random.uniform(0., 2.*np.pi, len(sample.exp))
+    return llh
+
 def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
-                 absorption=False, llh_args={'scramble':False}, model_args={}):
+                 absorption=False, llh_args=None, model_args=None, cache=False):
     """ Creates a MultiTemplateLLH object from the final cut level gamma-ray
     analysis event files
 
@@ -32,6 +84,22 @@ def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
         The random number seed.
     alpha: float
         The spectral index to fix to in the template likelihood.
+    llh_args: dict
+        Extra arguments of the seasonal LLHs, default {'scramble':False}.
+    model_args: dict
+        Extra arguments of the EnergyLLH models.
+    cache: bool
+        Opt in to reusing the LLH built by an earlier cached call with the
+        same arguments (other than seed) in this process, reseeded with
+        seed (see reseed). The same object is returned to every such call,
+        so whatever a caller changes on it (llh.ncpu, sample weights, ...)
+        is seen by the next one. Arguments that are not hashable once
+        frozen (see freeze) raise a TypeError. Reseeding has only been
+        checked against stub LLHs (check_dataset_cache.py), not yet against
+        skylab, so the default builds a new LLH on every call.
+        The seasonal LLHs of a cached LLH are seeded from seed (see
+        sample_seeds), so its scrambles and trials differ from those of an
+        uncached LLH with the same seed.
 
     Returns
     ----------
@@ -39,6 +107,30 @@ def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
 
     """
 
+    # Copies, so the arguments of one call never leak into the next.
+    llh_args = {'scramble':False} if llh_args is None else dict(llh_args)
+    model_args = {} if model_args is None else dict(model_args)
+
+    key = dataset_key(name, ncpu, alpha, template_name, absorption,
+                      llh_args, model_args)
+    if cache and key in dataset_cache:
+        llh, samples = dataset_cache[key]
+        return reseed(llh, samples, seed, llh_args)
+
+    llh, samples = build_dataset(name, ncpu, seed, alpha, template_name,
+                                 absorption, llh_args, model_args,
+                                 pin_seeds=cache)
+    if cache:
+        dataset_cache[key] = (llh, samples)
+    return llh
+
+def build_dataset(name, ncpu, seed, alpha, template_name,
+                  absorption, llh_args, model_args, pin_seeds=False):
+    """ Builds the LLH of load_dataset and its seasonal LLHs. With pin_seeds
+    the seasonal LLHs are seeded with sample_seeds, otherwise they get
+    llh_args only.
+    """
+
     if name in ['point_source']:
         dataset = 'GammaRays5yr_PointSrc'
     elif name in ['galactic_plane', 'HESE']:
@@ -49,6 +141,8 @@ def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
     llh_args['ncpu'] = ncpu
 
     years = ['2011', '2012', '2013', '2014', '2015']
+    if pin_seeds:
+        seeds = sample_seeds(seed, len(years), llh_args)
 
     if name == 'point_source':
         llh = MultiPointSourceLLH(seed=seed, ncpu=ncpu)
@@ -59,6 +153,7 @@ def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
         model_args['bounds'] = [alpha, alpha]
         model_args['fix_index'] = True
 
+    samples = []
     for i, year in enumerate(years):
         season = 'IC86.'+year
         exp, mc, livetime = Datasets[dataset].season(season)
@@ -74,21 +169,23 @@ def load_dataset(name, ncpu=1, seed=1, alpha=2.0, template_name=None,
         if absorption:
             mc['ow'] *= apply_source_absorption(mc['trueE']*10**-3, absorption)
 
+        year_args = dict(llh_args, seed=seeds[i]) if pin_seeds else llh_args
         if name == 'point_source':
-            llh_year = PointSourceLLH(exp, mc, livetime, llh_model, **llh_args)
+            llh_year = PointSourceLLH(exp, mc, livetime, llh_model, **year_args)
         else:
             template = Template((prefix+'/template/'+year+
                                  '/'+template_name+'_exp.npy'), reduced=True)
             llh_year = TemplateLLH(exp, mc, livetime, llh_model,
-                                   template=template, **llh_args)
+                                   template=template, **year_args)
 
         llh.add_sample(year, llh_year)
+        samples.append(llh_year)
 
-    return llh
+    return llh, samples
 
 def load_systematic_dataset(name, systematic, year='2012', index=3.0,
-                            seed=1, ncpu=1, llh_args={'scramble':False},
-                            model_args={}):
+                            seed=1, ncpu=1, llh_args=None,
+                            model_args=None):
     """ Creates a MultiTemplateLLH object from the final cut level gamma-ray
     analysis event files
 
@@ -131,6 +228,8 @@ def load_systematic_dataset(name, systematic, year='2012', index=3.0,
         exp = np.load(prefix+'/resources/datasets/{}_exp_{}.npy'.format(year, sel[name]))
         livetime = livetimes[year]*1.157*10**-5 # days
 
+    llh_args = {'scramble':False} if llh_args is None else dict(llh_args)
+    model_args = {} if model_args is None else dict(model_args)
     llh_args['ncpu'] = ncpu
     llh_args['seed'] = seed
     if name == 'point_source':